@@ -3,6 +3,8 @@ Benchmarking utility for testing different bot configurations
 """
 
 import asyncio
+import random
+import statistics
 import time
 import json
 from typing import Dict, List, Any, Tuple, Optional
@@ -11,13 +13,61 @@ import discord
 
 from context_optimization import optimize_context
 from context_manager import ContextManager
-from topic_detection import detect_message_topic
+from token_counter import count_tokens
+from streaming import ResponseBuffer
+from prompts import get_default_prompt
+from log_writer import log
+
+# Metrics summarized over repeated trials of a configuration
+TRIAL_METRICS = (
+    "tokens_per_second",
+    "prompt_tokens_per_second",
+    "time_to_first_token",
+    "time_to_first_answer_token",
+    "generation_time",
+    "tokens_generated"
+)
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """
+    Summarize the measurements of a metric
+
+    Args:
+        values: The measurements
+
+    Returns:
+        Dictionary with n, mean, p50, p95 and stddev
+    """
+    if not values:
+        return {"n": 0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "stddev": 0.0}
+
+    ordered = sorted(values)
+
+    def percentile(fraction: float) -> float:
+        # Linear interpolation, trials are few so nearest-rank would be too coarse
+        position = fraction * (len(ordered) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+    return {
+        "n": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "stddev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+    }
+
+def format_seconds(seconds: Optional[float]) -> str:
+    """Format a latency for the results embed, "-" if it wasn't measured"""
+    return f"{seconds:.2f}s" if seconds is not None else "-"
 
 class BenchmarkResult:
     """Store and analyze benchmark results"""
     
     def __init__(self):
         self.results: List[Dict[str, Any]] = []
+        self.load_tests: List[Dict[str, Any]] = []
         
     def add_result(self, 
                   config_name: str, 
@@ -25,8 +75,30 @@ class BenchmarkResult:
                   tokens_generated: int,
                   tokens_per_second: float,
                   context_size: int,
-                  prompt_type: str):
-        """Add a benchmark result"""
+                  prompt_type: str,
+                  prompt_tokens: int = 0,
+                  prompt_tokens_per_second: float = 0.0,
+                  load_time: float = 0.0,
+                  time_to_first_token: Optional[float] = None,
+                  time_to_first_answer_token: Optional[float] = None,
+                  mode: str = "sequential"):
+        """
+        Add a benchmark result
+
+        Args:
+            config_name: Name of the configuration
+            generation_time: Wall-clock seconds from request to the last chunk
+            tokens_generated: Tokens generated, as counted by Ollama
+            tokens_per_second: Generation throughput, excluding prompt processing and model load
+            context_size: Tokens in the prompt messages
+            prompt_type: Type of system prompt used
+            prompt_tokens: Prompt tokens Ollama had to evaluate (cached prefixes are skipped)
+            prompt_tokens_per_second: Prompt processing throughput
+            load_time: Seconds Ollama spent loading the model
+            time_to_first_token: Seconds until the first streamed token
+            time_to_first_answer_token: Seconds until the first token after the thinking block
+            mode: "sequential" for isolated trials, "concurrent" for requests of a load test
+        """
         self.results.append({
             "config_name": config_name,
             "generation_time": generation_time,
@@ -34,8 +106,63 @@ class BenchmarkResult:
             "tokens_per_second": tokens_per_second,
             "context_size": context_size,
             "prompt_type": prompt_type,
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_per_second": prompt_tokens_per_second,
+            "load_time": load_time,
+            "time_to_first_token": time_to_first_token,
+            "time_to_first_answer_token": time_to_first_answer_token,
+            "mode": mode,
+            "timestamp": time.time()
+        })
+
+    def add_load_test(self,
+                      config_name: str,
+                      concurrency: int,
+                      wall_time: float,
+                      tokens_generated: int,
+                      latencies: List[float]):
+        """
+        Add the result of a concurrent load test
+
+        Args:
+            config_name: Name of the configuration
+            concurrency: Number of requests run at the same time
+            wall_time: Seconds until every request finished
+            tokens_generated: Tokens generated by all requests together
+            latencies: Seconds each request took
+        """
+        self.load_tests.append({
+            "config_name": config_name,
+            "concurrency": concurrency,
+            "wall_time": wall_time,
+            "tokens_generated": tokens_generated,
+            "aggregate_tokens_per_second": tokens_generated / wall_time if wall_time > 0 else 0,
+            "latency": summarize(latencies),
             "timestamp": time.time()
         })
+
+    def get_config_summaries(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Summarize the isolated trials of every configuration
+
+        Returns:
+            Dictionary mapping each configuration to its prompt type and the summary of every metric
+        """
+        trials: Dict[str, List[Dict[str, Any]]] = {}
+        for result in self.results:
+            if result.get("mode", "sequential") == "sequential":
+                trials.setdefault(result["config_name"], []).append(result)
+
+        return {
+            name: {
+                "prompt_type": results[0]["prompt_type"],
+                **{
+                    metric: summarize([r[metric] for r in results if r.get(metric) is not None])
+                    for metric in TRIAL_METRICS
+                }
+            }
+            for name, results in trials.items()
+        }
         
     def get_best_config(self, priority: str = "speed") -> Optional[str]:
         """
@@ -47,89 +174,117 @@ class BenchmarkResult:
         Returns:
             Name of the best configuration or None if no results
         """
-        if not self.results:
+        summaries = self.get_config_summaries()
+        if not summaries:
             return None
             
         if priority == "speed":
-            # Sort by tokens per second (higher is better)
-            sorted_results = sorted(self.results, key=lambda x: x["tokens_per_second"], reverse=True)
+            # Sort by mean generation speed (higher is better)
+            key = lambda name: summaries[name]["tokens_per_second"]["mean"]
         else:
             # Sort by tokens generated (higher is better) then by speed (higher is better)
-            sorted_results = sorted(self.results, 
-                                    key=lambda x: (x["tokens_generated"], x["tokens_per_second"]), 
-                                    reverse=True)
+            key = lambda name: (summaries[name]["tokens_generated"]["mean"], summaries[name]["tokens_per_second"]["mean"])
             
-        return sorted_results[0]["config_name"]
+        return max(summaries, key=key)
 
     def get_summary_embed(self) -> discord.Embed:
         """Create a Discord embed with benchmark results summary"""
+        summaries = self.get_config_summaries()
+        trials = max((summary["tokens_per_second"]["n"] for summary in summaries.values()), default=0)
+
         embed = discord.Embed(
             title="Benchmark Results",
-            description=f"Tested {len(self.results)} configurations",
+            description=f"Tested {len(summaries)} configurations, {trials} trials each, one at a time in random order",
             color=discord.Color.blue()
         )
         
-        if not self.results:
+        if not summaries and not self.load_tests:
             embed.add_field(name="No Results", value="Run some benchmarks first", inline=False)
             return embed
-            
-        # Find fastest config
-        fastest = max(self.results, key=lambda x: x["tokens_per_second"])
-        
-        # Find config that generated most tokens
-        most_tokens = max(self.results, key=lambda x: x["tokens_generated"])
-        
-        # Add fields for the top results
-        embed.add_field(
-            name="Fastest Configuration",
-            value=f"**{fastest['config_name']}**\n"
-                  f"Speed: {fastest['tokens_per_second']:.2f} tokens/sec\n"
-                  f"Tokens: {fastest['tokens_generated']}\n"
-                  f"Prompt: {fastest['prompt_type']}",
-            inline=True
-        )
-        
-        embed.add_field(
-            name="Most Detailed Configuration",
-            value=f"**{most_tokens['config_name']}**\n"
-                  f"Tokens: {most_tokens['tokens_generated']}\n"
-                  f"Speed: {most_tokens['tokens_per_second']:.2f} tokens/sec\n"
-                  f"Prompt: {most_tokens['prompt_type']}",
-            inline=True
-        )
-        
-        # Add all results in a compact format
-        all_results = ""
-        sorted_results = sorted(self.results, key=lambda x: x["tokens_per_second"], reverse=True)
-        
-        for result in sorted_results:
-            all_results += f"**{result['config_name']}**: " \
-                          f"{result['tokens_per_second']:.2f} t/s, " \
-                          f"{result['tokens_generated']} tokens, " \
-                          f"{result['generation_time']:.2f}s\n"
-                          
-        embed.add_field(
-            name="All Test Results (Sorted by Speed)",
-            value=all_results,
-            inline=False
-        )
+
+        if summaries:
+            fastest_name = self.get_best_config("speed")
+            fastest = summaries[fastest_name]
+            most_tokens_name = self.get_best_config("tokens_efficiency")
+            most_tokens = summaries[most_tokens_name]
+
+            # Add fields for the top results
+            embed.add_field(
+                name="Fastest Configuration",
+                value=f"**{fastest_name}**\n"
+                      f"Generation: {fastest['tokens_per_second']['mean']:.2f} ± {fastest['tokens_per_second']['stddev']:.2f} tokens/sec\n"
+                      f"Prompt processing: {fastest['prompt_tokens_per_second']['mean']:.0f} tokens/sec\n"
+                      f"First token: p50 {format_seconds(fastest['time_to_first_token']['p50'])}, "
+                      f"p95 {format_seconds(fastest['time_to_first_token']['p95'])}\n"
+                      f"First answer token: p50 {format_seconds(fastest['time_to_first_answer_token']['p50'])}, "
+                      f"p95 {format_seconds(fastest['time_to_first_answer_token']['p95'])}\n"
+                      f"Tokens: {fastest['tokens_generated']['mean']:.0f}\n"
+                      f"Prompt: {fastest['prompt_type']}",
+                inline=True
+            )
+
+            embed.add_field(
+                name="Most Detailed Configuration",
+                value=f"**{most_tokens_name}**\n"
+                      f"Tokens: {most_tokens['tokens_generated']['mean']:.0f}\n"
+                      f"Speed: {most_tokens['tokens_per_second']['mean']:.2f} tokens/sec\n"
+                      f"Prompt: {most_tokens['prompt_type']}",
+                inline=True
+            )
+
+            # Add all results in a compact format
+            all_results = ""
+            for name in sorted(summaries, key=lambda name: summaries[name]["tokens_per_second"]["mean"], reverse=True):
+                summary = summaries[name]
+                all_results += f"**{name}**: " \
+                              f"{summary['tokens_per_second']['mean']:.2f} ± {summary['tokens_per_second']['stddev']:.2f} gen t/s " \
+                              f"(p50 {summary['tokens_per_second']['p50']:.2f}, p95 {summary['tokens_per_second']['p95']:.2f}), " \
+                              f"{summary['prompt_tokens_per_second']['mean']:.0f} prompt t/s, " \
+                              f"TTFT p50 {format_seconds(summary['time_to_first_token']['p50'])}, " \
+                              f"{summary['tokens_generated']['mean']:.0f} tokens\n"
+
+            embed.add_field(
+                name="All Test Results (Sorted by Speed)",
+                value=all_results[:1024],
+                inline=False
+            )
+
+        if self.load_tests:
+            load_results = ""
+            for test in self.load_tests:
+                load_results += f"**{test['config_name']}** x{test['concurrency']}: " \
+                                f"{test['aggregate_tokens_per_second']:.2f} t/s aggregate, " \
+                                f"latency p50 {format_seconds(test['latency']['p50'])}, " \
+                                f"p95 {format_seconds(test['latency']['p95'])}\n"
+
+            embed.add_field(
+                name="Concurrent Load",
+                value=load_results[:1024],
+                inline=False
+            )
         
         return embed
         
     def save_to_file(self, filename: str = "benchmark_results.json"):
         """Save benchmark results to file"""
         with open(filename, "w") as f:
-            json.dump(self.results, f, indent=2)
+            json.dump({"results": self.results, "load_tests": self.load_tests}, f, indent=2)
             
     def load_from_file(self, filename: str = "benchmark_results.json") -> bool:
         """Load benchmark results from file"""
         try:
             with open(filename, "r") as f:
-                self.results = json.load(f)
-            return True
+                data = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
             return False
 
+        # Older files only have the list of results
+        if isinstance(data, list):
+            data = {"results": data}
+        self.results = data.get("results", [])
+        self.load_tests = data.get("load_tests", [])
+        return True
+
 class Benchmarker:
     """Run benchmarks with different configurations"""
     
@@ -139,7 +294,7 @@ class Benchmarker:
         
         Args:
             model: The model name to benchmark
-            client: Ollama AsyncClient instance
+            client: Ollama AsyncClient or OllamaPool instance
         """
         self.model = model
         self.client = client
@@ -154,9 +309,10 @@ class Benchmarker:
                           config_name: str,
                           prompt: str,
                           history: List[Dict[str, Any]] = None,
-                          system_prompt_type: str = "optimized",
+                          system_prompt_type: str = "default",
                           context_optimizer = None,
-                          model_params: Dict[str, Any] = None) -> Dict[str, Any]:
+                          model_params: Dict[str, Any] = None,
+                          mode: Optional[str] = "sequential") -> Dict[str, Any]:
         """
         Run a single benchmark
         
@@ -164,23 +320,20 @@ class Benchmarker:
             config_name: Name of this configuration
             prompt: The prompt to use for benchmarking
             history: Optional conversation history
-            system_prompt_type: Type of system prompt to use
+            system_prompt_type: Type of system prompt to use, only "default" exists
             context_optimizer: Optional context optimizer to use
             model_params: Optional model parameters to use
+            mode: "sequential" or "concurrent", recorded with the result; None for warmup runs that aren't recorded
             
         Returns:
             Dictionary with benchmark results
         """
         # Prepare the prompt
-        if system_prompt_type == "default":
-            system_prompt = get_default_prompt()
-        elif system_prompt_type == "focused":
-            topic, _ = detect_message_topic(prompt)
-            system_prompt = get_focused_prompt(topic)
-        else:
-            system_prompt = get_default_prompt()
+        if system_prompt_type != "default":
+            raise ValueError(f"Unknown system prompt type: {system_prompt_type}")
+        system_prompt = {'role': 'system', 'content': get_default_prompt()}
 
-    # Format the user prompt
+        # Format the user prompt
         user_msg = {'role': 'user', 'content': f'Benchmark: {prompt}'}
         
         # Process history if provided
@@ -198,7 +351,7 @@ class Benchmarker:
             params.update(model_params)
             
         # Run the benchmark
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         response = await self.client.chat(
             model=self.model,
@@ -207,21 +360,51 @@ class Benchmarker:
             options=params
         )
         
-        # Collect response tokens
-        tokens_generated = 0
-        generated_text = ""
+        # Collect response tokens, the thinking state tells when the actual answer starts
+        buffer = ResponseBuffer()
+        chunks = 0
+        first_token_time = None
+        first_answer_time = None
+        final = None
         
-        async for token in response:
-            token_content = token['message']['content']
-            generated_text += token_content
-            tokens_generated += 1
+        async for chunk in response:
+            token_content = chunk['message']['content']
+            now = time.perf_counter()
+
+            if token_content:
+                chunks += 1
+                buffer.feed(token_content)
+
+                if first_token_time is None:
+                    first_token_time = now - start_time
+                if first_answer_time is None and not buffer.thinking and buffer.answer.strip():
+                    first_answer_time = now - start_time
+
+            # The last chunk carries Ollama's own timings
+            if chunk.get('done'):
+                final = chunk
             
-        end_time = time.time()
-        generation_time = end_time - start_time
+        generation_time = time.perf_counter() - start_time
+        buffer.finish()
+        generated_text = buffer.text
         
-        # Calculate metrics
-        tokens_per_second = tokens_generated / generation_time if generation_time > 0 else 0
-        context_size = sum(len(msg["content"]) // 4 for msg in messages)  # Rough estimate
+        # Calculate metrics from Ollama's stats, durations are in nanoseconds
+        def stat(name):
+            return (final.get(name) if final is not None else None) or 0
+
+        tokens_generated = stat('eval_count') or chunks
+        eval_seconds = stat('eval_duration') / 1e9
+        prompt_tokens = stat('prompt_eval_count')
+        prompt_seconds = stat('prompt_eval_duration') / 1e9
+
+        if eval_seconds > 0:
+            tokens_per_second = tokens_generated / eval_seconds
+        else:
+            # No stats from the server, fall back to wall-clock time
+            tokens_per_second = tokens_generated / generation_time if generation_time > 0 else 0
+        prompt_tokens_per_second = prompt_tokens / prompt_seconds if prompt_seconds > 0 else 0
+        load_time = stat('load_duration') / 1e9
+        context_size = sum(count_tokens(msg["content"]) for msg in messages)
         
         # Store the result
         result = {
@@ -231,92 +414,158 @@ class Benchmarker:
             "tokens_per_second": tokens_per_second,
             "context_size": context_size,
             "prompt_type": system_prompt_type,
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_per_second": prompt_tokens_per_second,
+            "load_time": load_time,
+            "time_to_first_token": first_token_time,
+            "time_to_first_answer_token": first_answer_time,
             "generated_text": generated_text
         }
         
         # Add to results collection
+        if mode is None:
+            return result
+
         self.results.add_result(
             config_name=config_name,
             generation_time=generation_time,
             tokens_generated=tokens_generated,
             tokens_per_second=tokens_per_second,
             context_size=context_size,
-            prompt_type=system_prompt_type
+            prompt_type=system_prompt_type,
+            prompt_tokens=prompt_tokens,
+            prompt_tokens_per_second=prompt_tokens_per_second,
+            load_time=load_time,
+            time_to_first_token=first_token_time,
+            time_to_first_answer_token=first_answer_time,
+            mode=mode
         )
         
         return result
 
-    async def run_compare_benchmarks(self, 
-                                    prompt: str,
-                                    history: List[Dict[str, Any]] = None) -> discord.Embed:
-        """
-        Run a series of benchmarks with different configurations in parallel
-        
-        Args:
-            prompt: The prompt to use for benchmarking
-            history: Optional conversation history
-            
-        Returns:
-            Discord embed with comparison results
-        """
-        # Define configurations to test
-        configs = [
+    def get_configs(self) -> List[Dict[str, Any]]:
+        """Configurations compared by run_compare_benchmarks"""
+        return [
             {
                 "name": "Default",
                 "system_prompt": "default",
                 "context_optimizer": None,
                 "params": {"temperature": 0.7, "mirostat": 0}
             },
-            {
-                "name": "Optimized",
-                "system_prompt": "optimized",
-                "context_optimizer": None,
-                "params": {"temperature": 0.7, "mirostat": 0}
-            },
-            {
-                "name": "Topic-Focused",
-                "system_prompt": "focused",
-                "context_optimizer": None,
-                "params": {"temperature": 0.7, "mirostat": 0}
-            },
             {
                 "name": "Context-Optimized",
-                "system_prompt": "optimized",
+                "system_prompt": "default",
                 "context_optimizer": ContextManager(),
                 "params": {"temperature": 0.7, "mirostat": 0}
             },
             {
                 "name": "Low Temperature",
-                "system_prompt": "optimized",
+                "system_prompt": "default",
                 "context_optimizer": ContextManager(),
                 "params": {"temperature": 0.3, "mirostat": 0}
             },
             {
                 "name": "Mirostat Enabled",
-                "system_prompt": "optimized",
+                "system_prompt": "default",
                 "context_optimizer": ContextManager(),
                 "params": {"temperature": 0.7, "mirostat": 2.0}
             }
         ]
+
+    async def run_config(self,
+                         config: Dict[str, Any],
+                         prompt: str,
+                         history: List[Dict[str, Any]] = None,
+                         mode: Optional[str] = "sequential") -> Dict[str, Any]:
+        """Run a single benchmark of a configuration from get_configs"""
+        return await self.run_benchmark(
+            config_name=config["name"],
+            prompt=prompt,
+            history=history,
+            system_prompt_type=config["system_prompt"],
+            context_optimizer=config["context_optimizer"],
+            model_params=config["params"],
+            mode=mode
+        )
+
+    async def run_load_test(self,
+                            config: Dict[str, Any],
+                            prompt: str,
+                            history: List[Dict[str, Any]] = None,
+                            concurrency: int = 4) -> Dict[str, Any]:
+        """
+        Run the same configuration several times at once to measure throughput under load
         
-        # Create tasks for all benchmarks to run in parallel
-        tasks = []
-        for config in configs:
-            print(f"Queuing benchmark for configuration: {config['name']}")
+        The requests compete for the model, so per-request speeds say little here;
+        what counts is the aggregate throughput and the latency of each request.
+        
+        Args:
+            config: Configuration from get_configs
+            prompt: The prompt to use for benchmarking
+            history: Optional conversation history
+            concurrency: Number of requests to run at the same time
             
-            task = self.run_benchmark(
-                config_name=config["name"],
-                prompt=prompt,
-                history=history,
-                system_prompt_type=config["system_prompt"],
-                context_optimizer=config["context_optimizer"],
-                model_params=config["params"]
-            )
-            tasks.append(task)
+        Returns:
+            Dictionary with the load test results
+        """
+        log(f"Running {concurrency} concurrent benchmarks of {config['name']}...")
+        start_time = time.perf_counter()
+        results = await asyncio.gather(*(
+            self.run_config(config, prompt, history, mode="concurrent")
+            for _ in range(concurrency)
+        ))
+        wall_time = time.perf_counter() - start_time
+
+        self.results.add_load_test(
+            config_name=config["name"],
+            concurrency=concurrency,
+            wall_time=wall_time,
+            tokens_generated=sum(result["tokens_generated"] for result in results),
+            latencies=[result["generation_time"] for result in results]
+        )
+        return self.results.load_tests[-1]
+
+    async def run_compare_benchmarks(self, 
+                                    prompt: str,
+                                    history: List[Dict[str, Any]] = None,
+                                    trials: int = 3,
+                                    warmup_runs: int = 1,
+                                    concurrency: int = 0,
+                                    seed: Optional[int] = None) -> discord.Embed:
+        """
+        Compare configurations, running one request at a time
+        
+        Every configuration runs in isolation so the measurements aren't skewed
+        by requests competing for the model. The trials are shuffled, so slow
+        drift (thermal throttling, the prompt cache, other load on the host)
+        doesn't always favour the same configuration.
         
-        # Run all benchmarks in parallel
-        print(f"Running {len(tasks)} benchmarks in parallel...")
-        await asyncio.gather(*tasks)
+        Args:
+            prompt: The prompt to use for benchmarking
+            history: Optional conversation history
+            trials: Number of measured runs per configuration
+            warmup_runs: Number of unrecorded runs first, so model loading isn't measured
+            concurrency: Also run a load test with this many concurrent requests, 0 to skip it
+            seed: Seed of the trial order, None for a random order
+            
+        Returns:
+            Discord embed with comparison results
+        """
+        configs = self.get_configs()
+
+        for i in range(warmup_runs):
+            log(f"Warmup run {i + 1}/{warmup_runs}...")
+            await self.run_config(configs[0], prompt, history, mode=None)
+
+        schedule = [config for config in configs for _ in range(trials)]
+        random.Random(seed).shuffle(schedule)
+
+        for i, config in enumerate(schedule):
+            log(f"Trial {i + 1}/{len(schedule)}: {config['name']}")
+            await self.run_config(config, prompt, history)
+
+        if concurrency > 0:
+            await self.run_load_test(configs[1], prompt, history, concurrency)
             
         # Save results
         self.results.save_to_file()
@@ -1,26 +1,65 @@
 from benchmark import Benchmarker, BENCHMARK_PROMPTS
 from topic_detection import detect_message_topic
-from context_manager import ContextManager
+from context_manager import ContextManager, ASSEMBLY_MODES, annotate_message, get_message_features
+from context_optimization import estimate_tokens
+from token_counter import count_tokens, get_token_counter, load_tokenizer
+from history_store import HistoryJournal
+from sqlite_store import SQLiteHistoryStore
+from ollama_pool import OllamaPool
+from request_queue import RequestQueue
+from response_cache import ResponseCache
+from retrieval import EmbeddingIndex, HashingEmbedder, OllamaEmbedder
+from stats_tracker import StatsTracker
+from warmup import ModelWarmup
+from streaming import EditThrottle, ResponseBuffer, fit_embed_description, render_stream
+from log_writer import LogWriter, LEVELS, DEBUG, INFO, ERROR, set_default_writer
+from scraper import ChannelScraper, ScrapeState, normalize_mentions, unseen_messages
+from tracing import NULL_TRACE, Tracer
+from compaction import HistoryCompactor
+from private_store import PrivateHistoryStore
+from message_record import Message, Role
+from prompts import get_default_prompt
 from discord import app_commands
 import subprocess
+import traceback
 import asyncio
 import discord
-import ollama
 import json
-import time
 import os
 
-stats = json.load(open('stats.json'))
-
 os.system('cls||clear')
 
-try: os.chdir('/home/omena0/bot')
+# CHATBOT_DIR runs the bot with another set of history and settings files, like the load test does
+try: os.chdir(os.environ.get('CHATBOT_DIR', '/home/omena0/bot'))
 except: os.chdir(f'{os.path.dirname(os.path.abspath(__file__))}')
 
-ai:ollama.AsyncClient = ollama.AsyncClient()
+# Counters live in memory, stats.json and the bio are only updated when they change
+stats = StatsTracker(
+    'stats.json',
+    flush_interval=30,      # Seconds between writes of stats.json
+    publish_interval=300    # Minimum seconds between bio updates
+)
+
+# Ollama hosts to dispatch generations to, max_concurrency should match each host's OLLAMA_NUM_PARALLEL
+ollama_hosts = [
+    {'host': os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434'), 'max_concurrency': int(os.environ.get('OLLAMA_NUM_PARALLEL', 1))}
+]
+
+# Load the host list if it exists
+try:
+    with open('ollama_hosts.json', 'r') as f:
+        ollama_hosts = json.load(f)
+        print(f"Loaded {len(ollama_hosts)} Ollama hosts")
+except (FileNotFoundError, json.JSONDecodeError):
+    print("No Ollama host list found, using the local instance")
+
+ai:OllamaPool = OllamaPool.from_config(ollama_hosts)
 
 model = 'deepseek-r1:1.5b'
 
+# Timings of every stage of handling a message, TRACING=0 turns it off
+tracer = Tracer(window=500, enabled=os.environ.get('TRACING', '1') != '0')
+
 bio = """
 The Achievement SMP's new AI ChatBot!
 Ping me and I'll try to help!
@@ -31,15 +70,19 @@ Discord: https://discord.gg/8MrQAhDdbM
 ------------------
 """.strip()
 
-sysPrompt = """You are a helpful assistant named ChatBot V2 inside a chat platform (Discord).
-The server you're in is about a Minecraft server called the Achievement SMP. To get in it you have to apply by submitting a form.
-In the achievement smp you gain points when you complete Minecraft achievements and you can use those to buy spells."""
+sysPrompt = get_default_prompt()
 
 history = []
-privHistory = {}
 
-generating = False
-preloading = False
+# Each user's DMs live in their own file, loaded on their first DM and unloaded when they go quiet
+private_store = PrivateHistoryStore('private_history', capacity=49, max_loaded=256, idle_timeout=1800)
+
+# Newest message ingested from each channel, scrapes only fetch what came after it
+scrape_state = ScrapeState('scrape_state.json')
+scrape_state.load()
+
+# Responses to repeated public questions, cleared when the prompt or model settings change
+response_cache = ResponseCache(max_entries=256, ttl=3600)
 
 # Context optimization settings
 context_settings = {
@@ -47,16 +90,21 @@ context_settings = {
     'remove_thinking': True,  # Remove thinking parts from context
     'recency_weight': 0.6,    # Weight for message recency in scoring (0-1)
     'relevance_weight': 0.4,  # Weight for topic relevance in scoring (0-1)
+    'assembly_mode': 'stable',  # "stable" keeps the prompt prefix identical between requests, "scored" orders by importance
+    'retrieval_k': 24,        # Messages retrieved by embedding similarity per prompt (0 to disable)
+    'embed_model': '',        # Ollama embedding model, empty for the local hashing embedder
+    'tokenizer_path': 'tokenizer.json',  # Hugging Face tokenizer of the model, token counts are estimated without it
+    'token_scale': 1.0,       # Correction of estimated token counts, fitted to the tokenizer whenever it is loaded
+    'response_reserve': 512,  # Tokens of num_ctx kept free for the answer
+    'compaction': True,       # Summarize old history while the model is idle
+    'compaction_keep_recent': 500,  # Newest public messages that are never summarized
+    'compaction_keep_recent_tokens': 75_000,  # Newest public tokens that are never summarized, the prompt's budget
+    'compaction_run_length': 50,    # Old messages of a channel rolled into one summary
+    'retention_tokens': 250_000,    # Tokens of public history kept in memory, the least important messages beyond it are pruned
+    'history_backend': 'sqlite',    # "sqlite" keeps an indexed archive, "json" a snapshot + journal
+    'candidate_channel_messages': 100,  # Latest messages of the prompt's channel considered in scored assembly
 }
 
-# Initialize the context manager
-context_manager = ContextManager(
-    max_tokens=context_settings['max_tokens'],
-    recency_weight=context_settings['recency_weight'],
-    relevance_weight=context_settings['relevance_weight'],
-    remove_thinking=context_settings['remove_thinking']
-)
-
 # Default model parameters
 model_params = {
     'temperature': 0.75,
@@ -85,6 +133,64 @@ except (FileNotFoundError, json.JSONDecodeError):
     with open('context_settings.json', 'w') as f:
         json.dump(context_settings, f)
 
+# New messages are appended to a journal, the full history is only rewritten on compaction
+journal = HistoryJournal('message_history.json', 'message_history.journal', compact_every=1000)
+if context_settings['history_backend'] == 'sqlite':
+    # New messages are inserted in batches, and the JSON history is migrated on first load
+    history_store = SQLiteHistoryStore('message_history.db', legacy=journal, batch_size=64, flush_delay=1.0)
+else:
+    history_store = journal
+
+# Count tokens with the model's real vocabulary if it is available
+if load_tokenizer(context_settings['tokenizer_path']):
+    print(f"Loaded tokenizer from {context_settings['tokenizer_path']}")
+else:
+    # Estimates keep the correction last fitted to the tokenizer
+    get_token_counter().scale = context_settings['token_scale']
+    print(f"No tokenizer found, estimating token counts ({get_token_counter().name})")
+
+def context_budget(max_tokens:int) -> int:
+    """
+    Token budget for history, leaving room in num_ctx for the system prompt and the answer
+
+    Args:
+        max_tokens: Budget to use when the context window is large enough
+
+    Returns:
+        The token budget
+    """
+    if 'num_ctx' not in model_params:
+        return max_tokens
+
+    available = model_params['num_ctx'] - count_tokens(sysPrompt) - context_settings['response_reserve']
+    return max(256, min(max_tokens, available))
+
+# Initialize the context manager
+context_manager = ContextManager(
+    max_tokens=context_settings['max_tokens'],
+    recency_weight=context_settings['recency_weight'],
+    relevance_weight=context_settings['relevance_weight'],
+    remove_thinking=context_settings['remove_thinking'],
+    assembly_mode=context_settings['assembly_mode'],
+    channel_messages=context_settings['candidate_channel_messages'],
+    retention_tokens=context_settings['retention_tokens']
+)
+
+# Rolls old messages into summaries while no requests are waiting
+compactor = HistoryCompactor(
+    ai,
+    model,
+    count_tokens,
+    keep_recent=context_settings['compaction_keep_recent'],
+    keep_recent_tokens=context_settings['compaction_keep_recent_tokens'],
+    run_length=context_settings['compaction_run_length']
+)
+
+# Public messages are embedded as they come in, so relevant ones can be retrieved per prompt
+retrieval_index = EmbeddingIndex(
+    OllamaEmbedder(ai, context_settings['embed_model']) if context_settings['embed_model'] else HashingEmbedder()
+)
+
 devId = 665320537223987229
 
 intents = discord.Intents.default().all()
@@ -96,12 +202,19 @@ guild = discord.Object(id=1287014795303845919)
 try: os.remove('bot.log')
 except: ...
 
-print_ = print
+# Log lines are written to bot.log in batches by a background thread
+log = LogWriter(
+    'bot.log',
+    level=LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), INFO),  # DEBUG also logs every generated token
+    max_bytes=5_000_000,
+    backups=3
+)
+
+# The other modules log through log_writer.log, which writes here too
+set_default_writer(log)
 
-def print(*args, end='\n', flush=False):
-    print_(*args, end=end,flush=flush)
-    with open('bot.log', 'a', encoding='utf-8') as f:
-        f.write(' '.join(map(str, args))+end)
+def print(*args, end='\n', flush=False, level=INFO):
+    log.write(' '.join(map(str, args))+end, level, flush)
 
 async def thinking_animation(message_obj, is_embed=True, title="Response [V2]"):
     """
@@ -127,169 +240,59 @@ async def thinking_animation(message_obj, is_embed=True, title="Response [V2]"):
         dots = dots % 4 + 1  # Cycle through 1-4 dots
         await asyncio.sleep(0.7)  # Update animation every 0.7 seconds
 
-def estimate_tokens(text):
-    """
-    Estimate the number of tokens in text
-    A rough approximation of 4 characters per token
-
-    Args:
-        text: The text to estimate tokens for
-
-    Returns:
-        Estimated token count
-    """
-    if not text:
-        return 0
-    return len(text) // 4  # Simple approximation of tokens
-
 skip_channels = ['partners', '✨・controls', 'discord-spam']
 priority_channels = ['announcements', 'updates']
 
-async def scrape_channel_history(guild:discord.Guild, target_tokens=25_000, messages_per_channel=200):
+async def scrape_channel_history(guild:discord.Guild, target_tokens=25_000, messages_per_channel=200, incremental=False, new_channels=True):
     """
     Scrape message history from all accessible channels. Priority channels are fully scraped
-    regardless of token count, then regular channels are scraped up to the token limit.
-    Messages are sorted by creation date across all channels (oldest first, newest last).
+    regardless of token count, then regular channels share the rest of the token budget.
+    Channels are fetched concurrently and merged by creation date (oldest first, newest last).
 
     Args:
         guild: Discord guild to scrape
-        target_tokens: Approximate number of tokens to collect (applies only to regular channels)
+        target_tokens: Approximate number of tokens to collect
         messages_per_channel: Maximum number of messages to fetch per channel
+        incremental: Only fetch messages newer than the last one ingested from each channel
+        new_channels: Scrape channels that were never scraped, otherwise they are only marked at their newest message
 
     Returns:
-        List of messages in history format (oldest first)
+        Tuple of (messages in history format (oldest first), token count)
     """
-    global history
-    all_messages = []  # List to store message data with timestamps
     print(f"Scraping channels - priority channels fully, then regular channels up to ~{target_tokens} tokens...")
-    
-    # Current token count (only relevant for regular channels)
-    current_tokens = 0
-
-    # Get all text channels in the guild
-    all_text_channels = [channel for channel in guild.channels if isinstance(channel, discord.TextChannel)]
-
-    # Organize channels by priority
-    priority_text_channels = [c for c in all_text_channels if c.name in priority_channels]
-    regular_text_channels = [c for c in all_text_channels if c.name not in priority_channels and c.name not in skip_channels]
-
-    # Sort each group by position for more natural order
-    priority_text_channels.sort(key=lambda c: c.position)
-    regular_text_channels.sort(key=lambda c: c.position)
 
-    # First scrape all priority channels completely
-    for channel in priority_text_channels:
-        # Check if the bot has permissions to read the channel
-        if not channel.permissions_for(guild.default_role).read_messages:
-            continue
-
-        print(f"Scraping PRIORITY channel #{channel.name} (no token limit)")
-        
-        try:
-            async for message in channel.history(limit=messages_per_channel):
-                # Skip messages from the bot itself
-                if message.author == client.user:
-                    continue
-
-                author = message.author
-                msg = message.content
-
-                if not msg:
-                    continue
-
-                # Convert mentions, channels, and roles
-                for mention in message.mentions:
-                    msg = msg.replace(f'<@{mention.id}>', f'@{mention.display_name}')
-                for ch in message.channel_mentions:
-                    msg = msg.replace(f'<#{ch.id}>', f'#{ch.name}')
-                for role in message.role_mentions:
-                    msg = msg.replace(f'<@&{role.id}>', f'@{role.name}')
-
-                # Calculate tokens for this message
-                msg_tokens = estimate_tokens(msg)
-                current_tokens += msg_tokens
-                
-                # Store message with timestamp and channel information
-                all_messages.append({
-                    'author': author.name,
-                    'content': msg,
-                    'timestamp': message.created_at,
-                    'channel': channel.name,
-                    'tokens': msg_tokens
-                })
-                    
-        except discord.errors.Forbidden:
-            print(f"Cannot access channel #{channel.name}")
-            continue
-    
-    print(f"Scraped {len(all_messages)} messages from priority channels ({current_tokens} tokens)")
-    
-    # Then scrape regular channels up to the target token limit
-    for channel in regular_text_channels:
-        # Check if the bot has permissions to read the channel
-        if not channel.permissions_for(guild.default_role).read_messages:
-            continue
-
-        print(f"Scraping regular channel #{channel.name}")
-        
-        try:
-            async for message in channel.history(limit=messages_per_channel):
-                # Skip messages from the bot itself
-                if message.author == client.user:
-                    continue
-
-                author = message.author
-                msg = message.content
-
-                if not msg:
-                    continue
-
-                # Convert mentions, channels, and roles
-                for mention in message.mentions:
-                    msg = msg.replace(f'<@{mention.id}>', f'@{mention.display_name}')
-                for ch in message.channel_mentions:
-                    msg = msg.replace(f'<#{ch.id}>', f'#{ch.name}')
-                for role in message.role_mentions:
-                    msg = msg.replace(f'<@&{role.id}>', f'@{role.name}')
-
-                # Calculate tokens for this message
-                msg_tokens = estimate_tokens(msg)
-                current_tokens += msg_tokens
-                
-                # Store message with timestamp and channel information
-                all_messages.append({
-                    'author': author.name,
-                    'content': msg,
-                    'timestamp': message.created_at,
-                    'channel': channel.name,
-                    'tokens': msg_tokens
-                })
-                
-                # If we've reached our target for regular channels, stop collecting messages
-                if current_tokens >= target_tokens:
-                    print(f"Reached target token count for regular channels ({current_tokens}/{target_tokens})")
-                    break
-                    
-        except discord.errors.Forbidden:
-            print(f"Cannot access channel #{channel.name}")
-            continue
-            
-        # If we've reached our target, stop collecting messages from more channels
-        if current_tokens >= target_tokens:
-            break
-
-    # Sort messages by timestamp (oldest first)
-    all_messages.sort(key=lambda m: m['timestamp'].timestamp())
+    # Only channels everyone can read, otherwise the bot could leak sensitive information
+    text_channels = [
+        channel for channel in guild.channels
+        if isinstance(channel, discord.TextChannel)
+        and channel.name not in skip_channels
+        and channel.permissions_for(guild.default_role).read_messages
+    ]
+    text_channels.sort(key=lambda c: c.position)
+
+    # A full scrape replaces the history, so every channel starts over
+    if not incremental:
+        scrape_state.reset()
+
+    scraper = ChannelScraper(estimate_tokens, max_concurrency=4, ignore_author=client.user)
+    messages, tokens = await scraper.scrape(
+        [c for c in text_channels if c.name in priority_channels],
+        [c for c in text_channels if c.name not in priority_channels],
+        target_tokens,
+        messages_per_channel,
+        state=scrape_state,
+        new_channels=new_channels
+    )
 
     # Convert to the format used by our history
     scraped_history = [
-        {'role': 'user', 'content': f"[#{msg['channel']}] {msg['author']}: {msg['content']}"}
-        for msg in all_messages
+        annotate_message(Message(Role.USER, msg['content'], f"#{msg['channel']}", msg['author'], msg['id'], msg['timestamp'].timestamp()))
+        for msg in messages
     ]
 
-    print(f"Scraped {len(scraped_history)} messages total: {current_tokens}/{target_tokens} tokens.")
+    print(f"Scraped {len(scraped_history)} messages total: {tokens}/{target_tokens} tokens.")
 
-    return scraped_history, current_tokens
+    return scraped_history, tokens
 
 async def check_perms(interaction,message='You do not have permission to execute this command.'):
     if interaction.user.id != devId:
@@ -297,30 +300,84 @@ async def check_perms(interaction,message='You do not have permission to execute
         return False
     return True
 
-def save():
-    json.dump(stats,open('stats.json','w'))
-
 def save_history():
-    """Save message history to a file"""
-    history_data = {
-        "public": history,
-        "private": privHistory
-    }
-    with open('message_history.json', 'w') as f:
-        json.dump(history_data, f)
+    """Write the public history to the history store"""
+    history_store.compact(history)
+    scrape_state.save()
+
+def append_history(msg, user=None):
+    """
+    Add a message to the public or a private history and persist it
+
+    Args:
+        msg: The history message to add
+        user: The user of the private conversation, or None for public history
+    """
+    # Derived features are computed once here and persisted with the message
+    annotate_message(msg)
+
+    if user is not None:
+        private_store.append(user.id, msg, user.name)
+        return
+
+    history.append(msg)
+    retrieval_index.add(msg)
+    history_store.append(msg)
+
+    # The JSON backend folds its journal into the snapshot once it grows large, off the event loop
+    if history_store.needs_compaction:
+        client.loop.create_task(history_store.compact_in_background(history))
+
+def merge_history(messages):
+    """
+    Append scraped messages that aren't in the public history yet
+
+    Args:
+        messages: Scraped messages, oldest first
+
+    Returns:
+        Number of messages added
+    """
+    unseen = unseen_messages(history, messages)
+    for msg in unseen:
+        append_history(msg)
+    return len(unseen)
 
 def load_history():
-    """Load message history from file or scrape channels if file doesn't exist"""
-    global history, privHistory
+    """Load message history from the history store, or scrape channels if there is none"""
+    global history
 
     try:
-        with open('message_history.json', 'r') as f:
-            history_data = json.load(f)
-            history = history_data.get("public", [])
-            privHistory = history_data.get("private", {})
-            print(f"Loaded {len(history)} public messages and {len(privHistory)} private conversations from file")
-    except (FileNotFoundError, json.JSONDecodeError):
-        print("No history file found or file corrupted. Will scrape channels when connected.")
+        history, legacy_private = history_store.load()
+        retrieval_index.rebuild(history)
+        print(f"Loaded {len(history)} public messages from file")
+    except FileNotFoundError:
+        print("No history file found. Will scrape channels when connected.")
+        return
+
+    # Older versions kept private history in the snapshot, keyed by user name
+    if legacy_private:
+        private_store.import_legacy(legacy_private)
+        save_history()
+        print(f"Moved {len(legacy_private)} private conversations to {private_store.directory}")
+
+    calibrate_token_estimates()
+
+def calibrate_token_estimates():
+    """Fit the token estimator to the loaded tokenizer on recent history, for runs without the tokenizer"""
+    counter = get_token_counter()
+    if counter.tokenizer is None or not history:
+        return
+
+    scale = round(counter.calibrate([msg['content'] for msg in history[-2000:]], counter.tokenizer), 3)
+    if scale == context_settings['token_scale']:
+        return
+
+    # Only a changed scale is saved, startup doesn't rewrite the settings file
+    context_settings['token_scale'] = scale
+    with open('context_settings.json', 'w') as f:
+        json.dump(context_settings, f)
+    print(f"Calibrated token estimates to the tokenizer (scale {scale:.3f})")
 
 async def setBio():
     global token
@@ -336,58 +393,148 @@ async def setBio():
     )
 
 async def setGenerating(state):
-    global generating
-    generating = state
     if state:
         await client.change_presence(activity=discord.CustomActivity(name='Generating...'))
     else:
         await client.change_presence(activity=discord.CustomActivity(name='Ready'))
 
-async def privatePrompt(user,prompt,send_message,edit_message):
+async def onQueueBusy(state):
+    # A request needs the model, a summary being written gives up its slot
+    if state:
+        compactor.interrupt()
+    await setGenerating(state)
+
+async def setWarmupState(state):
+    if state == ModelWarmup.READY:
+        await client.change_presence(activity=discord.CustomActivity(name='Ready'))
+    elif state == ModelWarmup.FAILED:
+        await client.change_presence(activity=discord.CustomActivity(name='Model failed to load'),status='dnd')
+    else:
+        await client.change_presence(activity=discord.CustomActivity(name='Loading...'),status='dnd')
+
+# Every mention, DM and /prompt is a job, scheduled fairly between users
+request_queue = RequestQueue(ai.capacity, max_pending_per_user=3, on_busy_change=onQueueBusy)
+
+# Loads the model in the background and tells requests when it is ready, retries included
+warmup = ModelWarmup(ai, model, on_state_change=setWarmupState)
+
+def response_embed(buffer:ResponseBuffer, title:str='Response [V2.0]') -> discord.Embed:
+    """
+    Render the current state of a streamed response
+
+    Args:
+        buffer: The response being streamed
+        title: Title of the embed
+
+    Returns:
+        Embed showing the thinking animation or the answer so far
+    """
+    if buffer.thinking:
+        return discord.Embed(title=title, description='Thinking' + '.' * (buffer.tokens % 4))
+
+    return discord.Embed(title=title, description=fit_embed_description(buffer.answer))
+
+def trace_model_stats(trace, chunk):
+    """Add Ollama's own timings from the last chunk of a stream to a trace"""
+    if chunk is None:
+        return
+
+    trace.set(
+        prompt_eval_count=chunk.prompt_eval_count,
+        prompt_eval_ms=(chunk.prompt_eval_duration or 0) / 1e6,
+        eval_count=chunk.eval_count,
+        eval_ms=(chunk.eval_duration or 0) / 1e6,
+        load_ms=(chunk.load_duration or 0) / 1e6
+    )
+
+async def queueRequest(user, send_message, edit_message, title, run, trace=NULL_TRACE):
+    """
+    Queue a generation job for a user and tell them their position in the queue
+
+    Args:
+        user: The user that made the request
+        send_message: Coroutine function sending the initial reply
+        edit_message: Coroutine function editing that reply
+        title: Title of the response embed
+        run: Coroutine function that generates the response
+        trace: Trace of the request, finished when the job is done
+    """
+    with trace.span('send_reply'):
+        await send_message(embed=discord.Embed(title=title, description='Loading...'), ephemeral=True)
+
+    queue_wait = trace.span('queue_wait')
+
+    async def run_when_ready():
+        queue_wait.end()
+        try:
+            # Requests that arrive while the model is loading wait for it
+            with trace.span('model_ready'):
+                ready = await warmup.wait_ready()
+            if not ready:
+                await edit_message(embed=discord.Embed(title=title, description='The model failed to load, try again later.'))
+                return
+            return await run()
+        except Exception as e:
+            print(f'[QUEUE] Request for {user.name} failed: {type(e).__name__}: {e}', level=ERROR)
+            print(traceback.format_exc(), level=DEBUG)
+            trace.set(error=type(e).__name__)
+            try:
+                await edit_message(embed=discord.Embed(title=title, description='Something went wrong while generating the response, try again later.'))
+            except discord.DiscordException as edit_error:
+                print(f'[QUEUE] Could not show the error to {user.name}: {edit_error}', level=ERROR)
+            raise
+        finally:
+            trace.finish()
+
+    try:
+        job = request_queue.submit(user.id, run_when_ready)
+    except asyncio.QueueFull:
+        trace.set(rejected=True)
+        trace.finish()
+        await edit_message(embed=discord.Embed(
+            title=title,
+            description='You already have too many requests queued, wait for them to finish first.'
+        ))
+        return
+
+    position = request_queue.position(job)
+    if position:
+        await edit_message(embed=discord.Embed(title=title, description=f'Queued (position {position})...'))
+    elif not warmup.ready:
+        await edit_message(embed=discord.Embed(title=title, description='Waiting for the model to load...'))
+
+async def privatePrompt(user,prompt,send_message,edit_message,trace=NULL_TRACE):
     if not prompt: return
 
-    # Start generating
-    await setGenerating(True)
+    await queueRequest(
+        user, send_message, edit_message, 'Response [V2]',
+        lambda: generatePrivate(user, prompt, edit_message, trace),
+        trace
+    )
 
-    # Send response embed
-    response_message = await send_message(
-        embed=discord.Embed(
-            title='Response [V2]',
-            description='Thinking...'
-        ),ephemeral=True
-    )    # Detect topic of the prompt
-    topic, confidence = detect_message_topic(prompt)
+async def generatePrivate(user,prompt,edit_message,trace=NULL_TRACE):
+    # Detect topic of the prompt
+    with trace.span('detect_topic'):
+        topic, confidence = detect_message_topic(prompt)
     print(f"[TOPIC] Detected topic: {topic} (confidence: {confidence:.2f})")
-      # Add prompt to history with DM marker
-    msg = {'role':'user','content':f'[DM] {user.name}: {prompt}'}
 
-    # If there is no history for this user, then create a new list with the prompt in it
-    if user.name not in privHistory:
-        privHistory[user.name] = [msg]
-    else:
-    # Otherwise just add it
-        privHistory[user.name].append(msg)
-
-    # Use topic-specific focused prompt for high confidence topics
-    if confidence > 0.6 and topic in ["minecraft", "discord"]:
-        current_prompt = get_focused_prompt(topic)
-        print(f"[PROMPT] Using focused prompt for topic: {topic}")
-    else:
-        current_prompt = sysPrompt
+    # Add prompt to history with DM marker
+    msg = Message(Role.USER, prompt, 'DM', user.name)
+    with trace.span('append_history'):
+        append_history(msg, user)
 
     # Optimize private history context using enhanced context manager
-    optimized_history = context_manager.optimize_context(
-        privHistory[user.name],
-        max_messages=None if len(privHistory[user.name]) < 30 else 20
-    )
+    with trace.span('optimize_context'):
+        optimized_history = context_manager.optimize_context(
+            list(private_store.get(user.id)),
+            max_tokens=context_budget(context_manager.max_tokens),
+            key=f'dm:{user.id}'
+        )
 
     # Start with system prompt and add optimized history
-    history = [current_prompt] + optimized_history
+    history = [{"role": "system", "content": sysPrompt}] + optimized_history
 
-    stats['total'] += 1
-    stats['private'] += 1
-    save()
-    await setBio()
+    stats.increment('total', 'private')
 
     # Start generating tokens
     response_stream = await ai.chat(
@@ -401,18 +548,21 @@ async def privatePrompt(user,prompt,send_message,edit_message):
     print(f'[PRIVATE] {user.display_name}: {prompt}')
     print('[PRIVATE] [AI] ',end='',flush=True)
 
+    buffer, chunk = await render_stream(
+        response_stream,
+        lambda buffer: edit_message(embed=response_embed(buffer, 'Response [V2]')),
+        EditThrottle(min_interval=0.25),
+        on_token=lambda token: print(token,end='',level=DEBUG),
+        trace=trace
+    )
+    trace_model_stats(trace, chunk)
 
+    resp = buffer.text
     print('\n<end>\n')
 
-    # Clean up history
-    while len(privHistory[user.name]) > 49:
-        privHistory[user.name].pop(0)
-
-    # Save history to file
-    save_history()
-
-    # Stop generating
-    await setGenerating(False)
+    # The ring buffer drops the oldest turns by itself
+    with trace.span('append_history'):
+        append_history(Message(Role.ASSISTANT, resp, 'DM', 'ChatBot V2'), user)
 
 @tree.command(name='system', description='Execute a console command', guild=guild)
 async def system(interaction:discord.Interaction, command:str):
@@ -463,14 +613,17 @@ async def reboot(interaction:discord.Interaction):
 
 @tree.command(name="wipe_memory", description="Give the bot dementia", guild=guild)
 async def wipe_memory(interaction:discord.Interaction):
-    global history, privHistory
+    global history
     if not await check_perms(interaction):
         return
 
     print('wiping memory')
     await interaction.response.send_message('wiping memory...',ephemeral=True)
     history = []
-    privHistory = {}
+    private_store.clear()
+    history_store.clear()  # The SQLite archive would still remember everything
+    context_manager.reset_stable_context()
+    retrieval_index.rebuild(history)
     save_history()  # Save empty history to file
 
 @tree.command(name="save_history", description="Save message history to file", guild=guild)
@@ -488,45 +641,64 @@ async def history_stats(interaction:discord.Interaction):
         return
 
     # Calculate token statistics
-    total_public_tokens = sum(estimate_tokens(msg['content']) for msg in history)
+    total_public_tokens = sum(get_message_features(msg)['tokens'] for msg in history)
+    # Only conversations in memory are counted, loading every shard would defeat the point
+    loaded_private = private_store.loaded()
     total_private_tokens = sum(
-        sum(estimate_tokens(msg['content']) for msg in user_history)
-        for user_history in privHistory.values()
+        sum(get_message_features(msg)['tokens'] for msg in user_history)
+        for user_history in loaded_private.values()
     )
 
     # Count message numbers
     total_public_messages = len(history)
-    total_private_conversations = len(privHistory)
-    total_private_messages = sum(len(user_history) for user_history in privHistory.values())
+    archived = f" ({history_store.count(active=False)} more archived)" if isinstance(history_store, SQLiteHistoryStore) else ''
+    total_private_conversations = private_store.count()
+    total_private_messages = sum(len(user_history) for user_history in loaded_private.values())
 
-    # Get current topic from context manager
+    # Get current topic and prompt prefix reuse from context manager
     current_topic, topic_confidence = context_manager.get_current_topic()
+    prefix_stats = context_manager.get_prefix_stats()
+    cache_stats = response_cache.get_stats()
 
     stats_embed = discord.Embed(
         title="Message History Stats",
-        description=f"Public messages: {total_public_messages} (~{total_public_tokens} tokens)\n"
+        description=f"Public messages: {total_public_messages} (~{total_public_tokens} tokens){archived}\n"
                    f"Private conversations: {total_private_conversations}\n"
                    f"Private messages: {total_private_messages} (~{total_private_tokens} tokens)\n"
                    f"Total stored messages: {total_public_messages + total_private_messages}\n"
-                   f"Estimated total tokens: {total_public_tokens + total_private_tokens}\n"
-                   f"Current topic: {current_topic} (confidence: {topic_confidence:.2f})"
+                   f"Total tokens: {total_public_tokens + total_private_tokens} (counted with {get_token_counter().name})\n"
+                   f"Current topic: {current_topic} (confidence: {topic_confidence:.2f})\n"
+                   f"Context assembly: {context_manager.assembly_mode} "
+                   f"({prefix_stats['rebases']} rebases over {prefix_stats['requests']} requests)\n"
+                   f"Prompt tokens saved: ~{prefix_stats['avg_reused_tokens']:.0f} per request "
+                   f"({prefix_stats['reuse_ratio']:.0%} of prompt tokens)\n"
+                   f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                   f"({cache_stats['hit_rate']:.0%} hit rate, {cache_stats['entries']} entries)"
     )
 
     await interaction.response.send_message(embed=stats_embed, ephemeral=True)
 
 @tree.command(name="run_benchmark", description="Run performance benchmark tests", guild=guild)
-async def run_benchmark(interaction:discord.Interaction, prompt_type: str = "general", custom_prompt: str = None):
+async def run_benchmark(interaction:discord.Interaction, prompt_type: str = "general", custom_prompt: str = None, trials: int = 3, concurrency: int = 0):
     """
     Run a benchmark to test different model configurations
 
     Args:
         prompt_type: Type of prompt to benchmark (general, minecraft, discord, factual, creative, coding)
         custom_prompt: Optional custom prompt to use instead of predefined ones
+        trials: Number of runs per configuration, one request at a time
+        concurrency: Also measure throughput with this many requests at once, 0 to skip
     """
     if not await check_perms(interaction):
         return
 
-    await interaction.response.send_message("Starting benchmark, this may take a minute...", ephemeral=True)
+    trials = max(1, min(trials, 10))
+    concurrency = max(0, min(concurrency, 16))
+
+    await interaction.response.send_message(
+        f"Starting benchmark with {trials} trials per configuration, this may take a few minutes...",
+        ephemeral=True
+    )
 
     # Initialize benchmarker
     benchmarker = Benchmarker(model, ai)
@@ -544,7 +716,17 @@ async def run_benchmark(interaction:discord.Interaction, prompt_type: str = "gen
             prompt_source = "general (default)"
 
     # Run the benchmark comparisons
-    results_embed = await benchmarker.run_compare_benchmarks(benchmark_prompt, history[-20:] if history else None)
+    try:
+        results_embed = await benchmarker.run_compare_benchmarks(
+            benchmark_prompt,
+            history[-20:] if history else None,
+            trials=trials,
+            concurrency=concurrency
+        )
+    except Exception as e:
+        print(f'Benchmark failed: {type(e).__name__}: {e}', level=ERROR)
+        await interaction.followup.send(f"Benchmark failed: {str(e)}", ephemeral=True)
+        return
 
     # Add prompt information to the embed
     results_embed.add_field(
@@ -611,22 +793,45 @@ async def set_model_params(interaction:discord.Interaction, temperature: float =
         ephemeral=True
     )
 
-@tree.command(name="rescrape", description="Rescrape messages from all channels", guild=guild)
-async def rescrape(interaction:discord.Interaction, token_limit: int = 10000, messages_per_channel: int = 200):
+@tree.command(name="rescrape", description="Fetch new messages from all channels, or rescrape everything", guild=guild)
+async def rescrape(interaction:discord.Interaction, token_limit: int = 10000, messages_per_channel: int = 200, full: bool = False):
+    """
+    Scrape channels into the public history
+
+    Args:
+        token_limit: Approximate number of tokens to collect from channels scraped for the first time
+        messages_per_channel: Maximum number of messages to fetch per channel scraped for the first time
+        full: Throw away the history and scrape every channel from scratch
+    """
     if not await check_perms(interaction):
         return
 
+    if not full:
+        await interaction.response.send_message("Fetching messages sent since the last scrape...", ephemeral=True)
+
+        new_messages, tokens = await scrape_channel_history(interaction.guild, token_limit, messages_per_channel, incremental=True)
+        added = merge_history(new_messages)
+        save_history()
+
+        await interaction.followup.send(
+            f"Added {added} new messages with approximately {tokens} tokens.",
+            ephemeral=True
+        )
+        return
+
     await interaction.response.send_message(f"Scraping messages with token limit: {token_limit}, messages per channel: {messages_per_channel}...", ephemeral=True)
 
     global history
 
     # Create a backup of current history
     old_history = history.copy()
+    old_marks = dict(scrape_state.marks)
     history = []
 
     try:
         # Scrape messages
         history, tokens = await scrape_channel_history(interaction.guild, token_limit, messages_per_channel)
+        retrieval_index.rebuild(history)
 
         # Save the new history
         save_history()
@@ -640,6 +845,8 @@ async def rescrape(interaction:discord.Interaction, token_limit: int = 10000, me
     except Exception as e:
         # Restore old history if there was an error
         history = old_history
+        scrape_state.marks = old_marks
+        retrieval_index.rebuild(history)
         await interaction.followup.send(f"Error scraping messages: {str(e)}\n\nRestored old history.", ephemeral=True)
 
     del old_history
@@ -649,13 +856,13 @@ async def get_log(interaction:discord.Interaction):
     if not await check_perms(interaction):
         return
 
-    with open('bot.log') as f:
-        log = f.read()
+    # Embed descriptions are limited to 4096 characters, only the end of the log fits
+    tail = await asyncio.to_thread(log.tail, 4000)
 
     await interaction.response. send_message(
         embed=discord.Embed(
             title='Bot log',
-            description=log
+            description=tail or '<Empty log>'
         ), ephemeral=True
     )
 
@@ -703,12 +910,11 @@ async def help_cmd(interaction:discord.Interaction):
             value="/set_model_params - Adjust model generation parameters\n"
                   "/set_response_mode - Change how responses are displayed (progressive/thinking/typing)\n"
                   "/context_settings - Configure context optimization settings\n"
-                  "/set_prompt_style - Change the system prompt style\n"
                   "/history_stats - View message history statistics\n"
                   "/save_history - Manually save message history\n"
                   "/run_benchmark - Test different model configurations\n"
                   "/wipe_memory - Clear bot's memory\n"
-                  "/rescrape - Re-collect messages from channels\n"
+                  "/rescrape - Fetch new messages from channels (full to start over)\n"
                   "/show_log - View the bot's log\n"
                   "/reboot - Restart the bot",
             inline=False
@@ -742,16 +948,6 @@ async def help_cmd(interaction:discord.Interaction):
 
 @tree.command(name='prompt',description='Privately prompt the AI', guild=guild)
 async def prompt(interaction:discord.Interaction, prompt:str):
-    # Dont let multiple people generating crash the system
-    if generating:
-        await interaction.reply("I'm already generating a response!")
-        return
-
-    # Wait until model is loaded
-    if preloading:
-        await interaction.reply('Loading... Try again later.')
-        return
-
     await privatePrompt(
         interaction.user,
         prompt,
@@ -761,7 +957,7 @@ async def prompt(interaction:discord.Interaction, prompt:str):
 
 @tree.command(name="context_settings", description="Adjust context optimization settings", guild=guild)
 async def set_context_settings(interaction:discord.Interaction, max_tokens: int = None, remove_thinking: bool = None,
-                               recency_weight: float = None, relevance_weight: float = None):
+                               recency_weight: float = None, relevance_weight: float = None, assembly_mode: str = None):
     """
     Adjust context optimization settings to improve model performance
 
@@ -770,6 +966,7 @@ async def set_context_settings(interaction:discord.Interaction, max_tokens: int
         remove_thinking: Whether to remove thinking parts from model context
         recency_weight: Weight for message recency in scoring (0-1)
         relevance_weight: Weight for topic relevance in scoring (0-1)
+        assembly_mode: "stable" (keep prompt prefix for cache reuse) or "scored"
     """
     global context_settings, context_manager
 
@@ -810,6 +1007,16 @@ async def set_context_settings(interaction:discord.Interaction, max_tokens: int
             await interaction.response.send_message("Relevance weight must be between 0 and 1", ephemeral=True)
             return
 
+    if assembly_mode is not None:
+        if assembly_mode.lower() in ASSEMBLY_MODES:
+            context_settings['assembly_mode'] = assembly_mode.lower()
+            context_manager.assembly_mode = assembly_mode.lower()
+            context_manager.reset_stable_context()
+            changes_made = True
+        else:
+            await interaction.response.send_message(f"Assembly mode must be one of: {', '.join(ASSEMBLY_MODES)}", ephemeral=True)
+            return
+
     if changes_made:
         # Save settings to file
         with open('context_settings.json', 'w') as f:
@@ -821,7 +1028,8 @@ async def set_context_settings(interaction:discord.Interaction, max_tokens: int
                 description=f"Max tokens: {context_settings['max_tokens']}\n"
                           f"Remove thinking parts: {context_settings['remove_thinking']}\n"
                           f"Recency weight: {context_settings['recency_weight']}\n"
-                          f"Relevance weight: {context_settings['relevance_weight']}"
+                          f"Relevance weight: {context_settings['relevance_weight']}\n"
+                          f"Assembly mode: {context_settings['assembly_mode']}"
             ),
             ephemeral=True
         )
@@ -832,7 +1040,8 @@ async def set_context_settings(interaction:discord.Interaction, max_tokens: int
                 description=f"Max tokens: {context_settings['max_tokens']}\n"
                           f"Remove thinking parts: {context_settings['remove_thinking']}\n"
                           f"Recency weight: {context_settings['recency_weight']}\n"
-                          f"Relevance weight: {context_settings['relevance_weight']}"
+                          f"Relevance weight: {context_settings['relevance_weight']}\n"
+                          f"Assembly mode: {context_settings['assembly_mode']}"
             ),
             ephemeral=True
         )
@@ -872,76 +1081,77 @@ async def set_response_mode(interaction:discord.Interaction, mode: str):
             ephemeral=True
         )
 
-@tree.command(name="set_prompt_style", description="Change the system prompt style", guild=guild)
-async def set_prompt_style(interaction:discord.Interaction, style: str = "optimized", topic: str = None):
-    """
-    Change the system prompt style to optimize for different use cases
+async def autosave_task():
+    """Background task to periodically save message history"""
+    await client.wait_until_ready()
+    while not client.is_closed():
+        await asyncio.sleep(300)  # Save every 5 minutes
+        print("Auto-saving message history...")
+        await history_store.compact_in_background(history)
+        scrape_state.save()
 
-    Args:
-        style: "default", "optimized", or "focused"
-        topic: Topic to focus on when using the "focused" style (minecraft or discord)
-    """
-    global sysPrompt
+        unloaded = private_store.evict_idle()
+        if unloaded:
+            print(f"Unloaded {unloaded} idle private conversations")
 
-    if not await check_perms(interaction):
-        return
+async def compaction_task():
+    """Background task summarizing old history whenever the model is idle"""
+    await client.wait_until_ready()
+    while not client.is_closed():
+        await asyncio.sleep(60)
+        if not context_settings['compaction'] or not warmup.ready or not request_queue.idle:
+            continue
 
-    old_style = "default"
-      # Determine the current style
-    current_content = sysPrompt['content']
-    if "helpful and concise" in current_content and len(current_content) < 200:
-        old_style = "optimized"
-    elif "Focus on" in current_content:
-        old_style = "focused"
-      # Set the new prompt style
-    if style.lower() == "default":
-        sysPrompt = get_default_prompt()
-        new_style = "default (comprehensive)"
-    elif style.lower() == "optimized":
-        sysPrompt = get_optimized_prompt()
-        new_style = "optimized (terse)"
-    elif style.lower() == "focused":
-        valid_topics = ["minecraft", "discord"]
-        if topic and topic.lower() in valid_topics:
-            sysPrompt = get_focused_prompt(topic.lower())
-            new_style = f"focused on {topic.lower()}"
-        else:
-            await interaction.response.send_message(
-                f"When using 'focused' style, please specify a valid topic: {', '.join(valid_topics)}",
-                ephemeral=True
-            )
-            return
-    else:
-        await interaction.response.send_message(
-            "Invalid style. Use 'default', 'optimized', or 'focused'.",
-            ephemeral=True
-        )
+        # A failed summary request is retried on the next pass
+        try:
+            await compact_history()
+        except Exception as e:
+            print(f"[COMPACT] Pass failed: {type(e).__name__}: {e}", level=ERROR)
+            print(traceback.format_exc(), level=DEBUG)
+
+async def compact_history():
+    """Summarize old public and private history once"""
+    summaries = await compactor.compact_public(lambda: history, lambda: request_queue.idle, max_runs=10)
+    private = await compactor.compact_private(private_store.loaded(), lambda: request_queue.idle)
+    if not summaries and not private:
         return
 
-    await interaction.response.send_message(
-        embed=discord.Embed(
-            title="System prompt updated",
-            description=f"Changed from '{old_style}' to '{new_style}' style\n"
-                       f"New prompt length: {len(sysPrompt['content'])} characters"
-        ),
-        ephemeral=True
-    )
+    # Private summaries replaced turns in place, their shards have to be rewritten
+    for user_id in private:
+        private_store.rewrite(user_id)
 
-async def autosave_task():
-    """Background task to periodically save message history"""
+    # The summarized messages are gone, so the frozen prompt prefixes have to be rebuilt.
+    # The index keeps them, a prompt about their details can still retrieve them.
+    for summary in summaries:
+        retrieval_index.add(summary)
+    context_manager.reset_stable_context()
+
+    print(f"[COMPACT] Wrote {len(summaries)} channel summaries and {len(private)} conversation summaries")
+    await history_store.compact_in_background(history)
+
+async def tracing_task():
+    """Background task to periodically export traces for local scrapers"""
     await client.wait_until_ready()
     while not client.is_closed():
-        await asyncio.sleep(300)  # Save every 5 minutes
-        print("Auto-saving message history...")
-        save_history()
+        await asyncio.sleep(15)
+        await tracer.export_in_background('traces.jsonl', 'metrics.prom')
+
+# Set once the history is loaded and the background tasks run
+started = False
 
 @client.event
 async def on_ready():
-    global preloading, history, privHistory
+    global history, started
     print(f'Logged in as {client.user}.')
 
     await tree.sync(guild=discord.Object(id=1287014795303845919))
 
+    # discord.py fires on_ready again after every reconnect, the rest only runs once
+    if started:
+        await catch_up_history()
+        return
+    started = True
+
     # Load message history from file
     load_history()
       # If no history file was found, scrape channels
@@ -949,26 +1159,55 @@ async def on_ready():
         main_guild = client.get_guild(guild.id)
         if main_guild:
             print("No message history found, scraping channels...")
-            history = await scrape_channel_history(main_guild, target_tokens=10000, messages_per_channel=200)
+            history, _ = await scrape_channel_history(main_guild, target_tokens=10000, messages_per_channel=200)
+            retrieval_index.rebuild(history)
             save_history()  # Save the scraped history
 
-    # Start autosave task
+    # Catch up on messages sent while the bot was offline
+    else:
+        await catch_up_history()
+
+    # Embed the loaded history in the background
+    client.loop.create_task(retrieval_index.flush())
+
+    # Start autosave and stats flushing tasks
     client.loop.create_task(autosave_task())
+    client.loop.create_task(stats.run(setBio))
+    client.loop.create_task(tracing_task())
+    client.loop.create_task(ai.run_health_checks())
+    client.loop.create_task(compaction_task())
+
+    # Load the model in the background, the gateway stays responsive meanwhile
+    client.loop.create_task(warm_up_model())
 
-    preloading = True
+async def catch_up_history():
+    """Merge the messages sent while the bot was offline or disconnected"""
+    if not client.guilds:
+        return
+
+    main_guild = client.get_guild(guild.id)
+    if main_guild:
+        # Old messages of channels never scraped (or of every channel after upgrading
+        # from a version without marks) would land after newer history, so they're skipped
+        missed, _ = await scrape_channel_history(main_guild, target_tokens=10000, messages_per_channel=200, incremental=True, new_channels=False)
+        print(f"Caught up on {merge_history(missed)} messages sent while offline")
+        scrape_state.save()
+
+async def warm_up_model():
+    """Load the model on every Ollama host, requests wait for it instead of being rejected"""
     print(f'Preloading {model}...')
-    await client.change_presence(activity=discord.CustomActivity(name='Loading...'),status='dnd')
-    ollama.chat(model=model,keep_alive=-1)
 
-    preloading = False
-    print('Preloaded.')
-    await client.change_presence(activity=discord.CustomActivity(name='Ready'))
-    await setBio()
+    # The presence follows the warmup state, see setWarmupState
+    if await warmup.start():
+        print('Preloaded.')
+    else:
+        print(f'Failed to load {model} on any Ollama host')
+
+    await stats.publish(setBio, force=True)
 
 
 @client.event
 async def on_message(message:discord.Message):
-    global generating, preloading, history
 
     # Ignore messages sent by the bot
     if message.author == client.user:
@@ -980,28 +1219,27 @@ async def on_message(message:discord.Message):
 
     if not msg: return
 
-    # Convert mentions <@{id}> -> @{display_name}
-    for mention in message.mentions:
-        msg = msg.replace(f'<@{mention.id}>', f'@{mention.display_name}')
-
-    # Convert channels <#{id}> -> #{name}
-    for channel in message.channel_mentions:
-        msg = msg.replace(f'<#{channel.id}>', f'#{channel.name}')
+    if not message.guild:
+        trace = tracer.start('private', user=author.id)
+    elif client.user in message.mentions:
+        trace = tracer.start('public', channel=channel.name, user=author.id)
+    else:
+        trace = tracer.start('plain', channel=channel.name)
 
-    # Convert roles <@&id> -> @role_name>
-    for role in message.role_mentions:
-        msg = msg.replace(f'<@&{role.id}>', f'@{role.name}')
+    # Convert mentions, channels and roles to readable names
+    with trace.span('normalize_mentions'):
+        msg = normalize_mentions(message)
 
     # Is in dms
     if not message.guild:
+        response = None
         async def send(*args, **kwargs):
-            global response
+            nonlocal response
             kwargs.pop('ephemeral')
             response = await message.reply(*args,**kwargs)
         async def edit(*args, **kwargs):
-            global response
             await response.edit(*args,**kwargs)
-        await privatePrompt(author,msg,send,edit)
+        await privatePrompt(author,msg,send,edit,trace)
 
         return
 
@@ -1010,58 +1248,85 @@ async def on_message(message:discord.Message):
     if not channel.permissions_for(message.guild.default_role).read_messages:
         return
 
-    stats['seen'] += 1
-    save()
-    await setBio()
+    stats.increment('seen')
     print(f'[#{channel.name}] {author.display_name}: {msg}')
 
-    history.append({'role':'user','content':f'[#{channel.name}] {author.name}: {msg}'})
-    save_history()
+    with trace.span('append_history'):
+        append_history(Message(Role.USER, msg, f'#{channel.name}', author.name, message.id))
+    scrape_state.update(channel.id, message.id)
 
     # Not prompting the bot to respond
     if client.user not in message.mentions:
         print('not mentioned', message.mentions)
+        trace.finish()
         return
 
-    # Dont let multiple people generating crash the system
-    if generating:
-        await message.reply("I'm already generating a response!")
-        return
+    response = None
+    async def send(*args, **kwargs):
+        nonlocal response
+        kwargs.pop('ephemeral')
+        response = await message.reply(*args,**kwargs)
+    async def edit(*args, **kwargs):
+        await response.edit(*args,**kwargs)
+
+    await queueRequest(
+        author, send, edit, 'Response [V2.0]',
+        lambda: generatePublic(message, msg, response, trace),
+        trace
+    )
 
-    # Wait until model is loaded
-    if preloading:
-        await message.reply('Loading... Try again later.')
-        return
+async def generatePublic(message:discord.Message, msg, response:discord.Message, trace=NULL_TRACE):
+    global history
+
+    channel = message.channel
 
     # Detect topic of the message
-    topic, confidence = detect_message_topic(msg)
+    with trace.span('detect_topic'):
+        topic, confidence = detect_message_topic(msg)
     print(f"[TOPIC] Detected topic: {topic} (confidence: {confidence:.2f})")
 
+    stats.increment('total', 'public')
+
+    # Answer repeated questions from the cache
+    response_cache.validate(model, sysPrompt, model_params)
+    cache_key = response_cache.make_key(msg, ignore=[f'@{client.user.display_name}'], channel=channel.name, author=message.author.id)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        print(f'[CACHE] Hit for {cache_key}')
+        trace.set(cached=True)
+        await response.edit(embed=discord.Embed(
+            title='Response [V2.0]',
+            description=fit_embed_description(cached.split('</think>')[-1].strip() if '</think>' in cached else cached)
+        ))
+        append_history(Message(Role.ASSISTANT, cached, channel.name, 'ChatBot V2'))
+        return
+
+    # Find the messages most similar to the prompt
+    retrieved = None
+    if context_settings['retrieval_k']:
+        try:
+            with trace.span('retrieval'):
+                retrieved = await retrieval_index.search(msg, context_settings['retrieval_k'])
+        except Exception as e:
+            print(f'[RETRIEVAL] Search failed, using the whole history: {e}')
+
     # Use topic-aware context optimization
-    optimized_history = context_manager.optimize_context(
-        history,
-        max_tokens=75_000
-    )
+    with trace.span('optimize_context'):
+        candidates = history
+        if context_manager.assembly_mode == 'scored' and isinstance(history_store, SQLiteHistoryStore):
+            # Scored assembly only needs a bounded set of messages, stable assembly keeps its prefix from the whole history
+            candidates = context_manager.gather_candidates(history_store, channel.name, retrieved)
+            retrieved = None
+        optimized_history = context_manager.optimize_context(
+            candidates,
+            max_tokens=context_budget(75_000),
+            key='public',
+            retrieved=retrieved
+        )
 
     # Start with system prompt and add optimized history
     h = [{"role": "system", "content": sysPrompt}] + optimized_history
 
-    stats['total'] += 1
-    stats['public'] += 1
-    save()
-    await setBio()
-
-    # Start generating
-    await setGenerating(True)
-
-    # Send the response embed with initial thinking message
-    embed = discord.Embed(
-        title='Response [V2.0]',
-        description='Loading...'
-    )
-
-    response = await message.reply(embed=embed)
-
     # Start typing and generating tokens
     async with channel.typing():
         print('[AI] ',end='',flush=True)
@@ -1075,53 +1340,39 @@ async def on_message(message:discord.Message):
             keep_alive=-1
         )
 
-        resp = ''
-        dot_count = 0
-        last_updated = time.time()
-        async for token in stream:
-            token = token.message.content
-            print(token,end='')
-
-            resp += token
-            # Started thinking but didn't end yet
-            thinking = '<think>' in resp and '</think>' not in resp
-
-            if thinking:
-                dot_count += 1
-                if dot_count > 3:
-                    dot_count = 0
-
-                embed = discord.Embed(
-                   title='Response [V2.0]',
-                   description=f'Thinking{'.'*dot_count}'
-                )
-
-            else:
-                embed = discord.Embed(
-                    title='Response [V2.0]',
-                    description=resp.split('</think>')[-1].strip() if '</think>' in resp else resp
-                )
-
-            if time.time() - last_updated > 0.25:
-                await response.edit(embed=embed)
-                last_updated = time.time()
+        # The stream is drained at full speed, edits show the newest state whenever Discord is ready
+        buffer, chunk = await render_stream(
+            stream,
+            lambda buffer: response.edit(embed=response_embed(buffer)),
+            EditThrottle(min_interval=0.25),
+            on_token=lambda token: print(token,end='',level=DEBUG),
+            trace=trace
+        )
+        trace_model_stats(trace, chunk)
 
+        resp = buffer.text
         print('\n<end>\n')
 
-        await response.edit(embed=embed)
-
-        history.append({'role':'assistant','content':f'[{channel.name}] ChatBot V2: {resp}'})
+        # The final chunk has Ollama's own count of prompt tokens it had to evaluate
+        if resp:
+            prefix_stats = context_manager.get_prefix_stats()
+            print(f"[CONTEXT] Reused ~{prefix_stats['last_reused_tokens']} prompt tokens, "
+                  f"Ollama evaluated {chunk.prompt_eval_count} prompt tokens")
 
-    # Use the context manager to handle pruning
-    history = context_manager.optimize_context(history)
+        with trace.span('append_history'):
+            append_history(Message(Role.ASSISTANT, resp, channel.name, 'ChatBot V2'))
+        response_cache.put(cache_key, resp)
 
-    # Save history to file
-    save_history()
+    # Use the context manager to handle pruning, pruned messages stay in the retrieval index
+    with trace.span('prune_history'):
+        history = context_manager.prune_history(history, key='public')
 
-    # Stop generating
-    await setGenerating(False)
+    # Pruning rewrote the history, so snapshot it in the background
+    with trace.span('save_history'):
+        await history_store.compact_in_background(history)
 
 
-with open('token.txt', 'rt') as f: token = f.read()
+if __name__ == '__main__':
+    with open('token.txt', 'rt') as f: token = f.read()
 
-client.run(token)
+    client.run(token)
@@ -0,0 +1,304 @@
+"""
+History compaction
+Rolls runs of old messages of a channel, and old turns of a private
+conversation, into short summaries written by the model. A summary takes the
+place of the messages it covers, so the context can reach much further back for
+a few hundred tokens. Meant to run while no requests are waiting for the model,
+a summary being written is cancelled with interrupt() when one comes in.
+"""
+
+from typing import Any, Callable, Dict, List, MutableSequence, Optional
+import asyncio
+import re
+
+from context_manager import annotate_message, get_message_features
+from context_optimization import remove_thinking_parts
+from message_record import Message
+from log_writer import log
+
+# '[#channel] author: text' for users, '[channel] ChatBot V2: text' for the bot, '[DM] name: text' in private
+_CHANNEL_RE = re.compile(r'^\[#?([^\]]+)\]')
+
+SUMMARY_PROMPT = """You summarize chat history for a Discord bot's memory.
+Summarize the messages below in at most {sentences} sentences.
+Keep who said what, questions and their answers, decisions and facts about the server.
+Reply with the summary only."""
+
+def message_channel(msg: Dict[str, Any]) -> Optional[str]:
+    """The channel name in the prefix of a history message, or None if it has none"""
+    match = _CHANNEL_RE.match(msg.get('content', ''))
+    return match.group(1) if match else None
+
+def is_summary(msg: Dict[str, Any]) -> bool:
+    return 'summary' in msg
+
+class HistoryCompactor:
+    """Replaces runs of old messages with model-written summaries"""
+
+    def __init__(self,
+                 client: Any,
+                 model: str,
+                 count_tokens: Callable[[str], int],
+                 keep_recent: int = 500,
+                 keep_recent_tokens: int = 75_000,
+                 run_length: int = 50,
+                 keep_recent_private: int = 20,
+                 private_run_length: int = 20,
+                 max_input_tokens: int = 4000,
+                 sentences: int = 3,
+                 options: Optional[Dict[str, Any]] = None):
+        """
+        Initialize the compactor
+
+        Args:
+            client: Ollama AsyncClient or OllamaPool writing the summaries
+            model: Name of the model
+            count_tokens: Function counting the tokens of a text
+            keep_recent: Number of newest public messages never compacted
+            keep_recent_tokens: Tokens of newest public messages never compacted, the prompt's budget,
+                                so summarizing doesn't rewrite the messages a prompt is built from
+            run_length: Number of old messages of a channel rolled into one summary
+            keep_recent_private: Number of newest turns of a private conversation never compacted
+            private_run_length: Minimum number of old private turns to summarize
+            max_input_tokens: Maximum tokens of messages summarized at once, runs are cut short beyond it
+            sentences: Length of the summaries in sentences
+            options: Model options of the summary requests
+        """
+        self.client = client
+        self.model = model
+        self.count_tokens = count_tokens
+        self.keep_recent = keep_recent
+        self.keep_recent_tokens = keep_recent_tokens
+        self.run_length = run_length
+        self.keep_recent_private = keep_recent_private
+        self.private_run_length = private_run_length
+        self.max_input_tokens = max_input_tokens
+        self.sentences = sentences
+        # Thinking counts towards num_predict, so it has to leave room for it
+        self.options = options or {'temperature': 0.3, 'num_predict': 1024}
+        self._summary_task: Optional[asyncio.Task] = None
+
+    def _cut(self, run: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The longest start of a run that fits in max_input_tokens, at least one message"""
+        tokens = 0
+        for i, msg in enumerate(run):
+            features = get_message_features(msg)
+            tokens += features.get('stripped_tokens', features['tokens'])
+            if tokens > self.max_input_tokens and i > 0:
+                return run[:i]
+        return run
+
+    def find_public_runs(self, messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """
+        Find runs of old messages to summarize, oldest first
+
+        Args:
+            messages: Public history, oldest first
+
+        Returns:
+            Full runs of run_length messages of the same channel, outside the newest keep_recent
+            messages and keep_recent_tokens tokens
+        """
+        recent = 0
+        tokens = 0
+        for msg in reversed(messages):
+            features = get_message_features(msg)
+            tokens += features.get('stripped_tokens', features['tokens'])
+            if tokens > self.keep_recent_tokens:
+                break
+            recent += 1
+        end = max(0, len(messages) - max(self.keep_recent, recent))
+
+        by_channel: Dict[str, List[Dict[str, Any]]] = {}
+        for msg in messages[:end]:
+            channel = message_channel(msg)
+            if channel is not None and not is_summary(msg):
+                by_channel.setdefault(channel, []).append(msg)
+
+        runs = []
+        for channel_messages in by_channel.values():
+            for start in range(0, len(channel_messages) - self.run_length + 1, self.run_length):
+                runs.append(self._cut(channel_messages[start:start + self.run_length]))
+
+        # Oldest runs first, by the position of their last message
+        positions = {id(msg): i for i, msg in enumerate(messages)}
+        runs.sort(key=lambda run: positions[id(run[-1])])
+        return runs
+
+    def find_private_run(self, messages: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        """
+        Find the old turns of a private conversation to summarize
+
+        Args:
+            messages: The conversation, oldest first
+
+        Returns:
+            The turns outside the newest keep_recent_private, or None if there are too few
+        """
+        old = [msg for msg in messages[:max(0, len(messages) - self.keep_recent_private)] if not is_summary(msg)]
+        if len(old) < self.private_run_length:
+            return None
+        return self._cut(old)
+
+    async def summarize(self, run: List[Dict[str, Any]]) -> str:
+        """
+        Have the model summarize messages
+
+        Args:
+            run: The messages to summarize
+
+        Returns:
+            The summary, without the model's thinking
+        """
+        transcript = '\n'.join(get_message_features(msg).get('stripped', msg['content']) for msg in run)
+        response = await self.client.chat(
+            self.model,
+            [
+                {'role': 'system', 'content': SUMMARY_PROMPT.format(sentences=self.sentences)},
+                {'role': 'user', 'content': transcript}
+            ],
+            options=self.options,
+            keep_alive=-1
+        )
+        return remove_thinking_parts(response['message']['content']).strip()
+
+    def interrupt(self) -> None:
+        """Cancel the summary being written, so its model slot is free for a request"""
+        if self._summary_task is not None:
+            self._summary_task.cancel()
+
+    async def _summarize_interruptible(self, run: List[Dict[str, Any]]) -> Optional[str]:
+        """Summarize a run, None if interrupt() cancelled the summary"""
+        task = asyncio.ensure_future(self.summarize(run))
+        self._summary_task = task
+        try:
+            await asyncio.wait([task])
+        finally:
+            self._summary_task = None
+            task.cancel()
+
+        if task.cancelled():
+            return None
+        return task.result()
+
+    def make_summary(self, run: List[Dict[str, Any]], text: str, prefix: str) -> Dict[str, Any]:
+        """
+        Create the history message replacing a run
+
+        Args:
+            run: The summarized messages
+            text: Their summary
+            prefix: Channel prefix of the message, like '[#general]' or '[DM]'
+
+        Returns:
+            The annotated summary message
+        """
+        ids = [msg['id'] for msg in run if 'id' in msg]
+        summary = Message.from_dict({
+            'role': 'user',
+            'content': f'{prefix} Summary of {len(run)} earlier messages: {text}',
+            'summary': {
+                'messages': len(run),
+                'tokens': self.count_tokens(text),
+                'source_tokens': sum(get_message_features(msg)['tokens'] for msg in run),
+                'first_id': ids[0] if ids else None,
+                'last_id': ids[-1] if ids else None
+            }
+        })
+        return annotate_message(summary)
+
+    @staticmethod
+    def replace_run(messages: MutableSequence[Dict[str, Any]], run: List[Dict[str, Any]], summary: Dict[str, Any]) -> bool:
+        """
+        Replace a run with its summary in place, at the position of the run's last message
+
+        Args:
+            messages: The history containing the run, a list or a deque
+            run: The summarized messages
+            summary: The summary message
+
+        Returns:
+            False if part of the run is no longer in the history, which is left unchanged
+        """
+        members = {id(msg) for msg in run}
+        if sum(id(msg) in members for msg in messages) != len(members):
+            return False
+
+        last = id(run[-1])
+        compacted = []
+        for msg in messages:
+            if id(msg) == last:
+                compacted.append(summary)
+            elif id(msg) not in members:
+                compacted.append(msg)
+        messages.clear()
+        messages.extend(compacted)
+        return True
+
+    async def compact_public(self,
+                             get_messages: Callable[[], List[Dict[str, Any]]],
+                             is_idle: Callable[[], bool],
+                             max_runs: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Summarize old runs of the public history while the model is idle, stopping when a summary is interrupted
+
+        Args:
+            get_messages: Returns the current public history, which may be replaced while a summary is written
+            is_idle: Whether the model has nothing else to do, checked before every summary
+            max_runs: Maximum number of runs to summarize, None for all of them
+
+        Returns:
+            The summaries that replaced runs
+        """
+        summaries = []
+        for run in self.find_public_runs(get_messages())[:max_runs]:
+            if not is_idle():
+                break
+
+            text = await self._summarize_interruptible(run)
+            if text is None:
+                break
+            if not text:
+                continue
+
+            channel = message_channel(run[-1])
+            summary = self.make_summary(run, text, f'[#{channel}]')
+            if self.replace_run(get_messages(), run, summary):
+                summaries.append(summary)
+                log(f"[COMPACT] #{channel}: {len(run)} messages ({summary['summary']['source_tokens']} tokens) "
+                      f"-> {summary['summary']['tokens']} tokens")
+        return summaries
+
+    async def compact_private(self,
+                              conversations: Dict[Any, MutableSequence[Dict[str, Any]]],
+                              is_idle: Callable[[], bool]) -> List[Any]:
+        """
+        Summarize the old turns of private conversations while the model is idle, stopping when a summary is interrupted
+
+        Args:
+            conversations: Private histories by user
+            is_idle: Whether the model has nothing else to do, checked before every summary
+
+        Returns:
+            The users whose conversations were compacted
+        """
+        compacted = []
+        for user in list(conversations):
+            run = self.find_private_run(list(conversations[user]))
+            if run is None:
+                continue
+            if not is_idle():
+                break
+
+            text = await self._summarize_interruptible(run)
+            if text is None:
+                break
+            messages = conversations.get(user)
+            if not text or messages is None:
+                continue
+
+            summary = self.make_summary(run, text, '[DM]')
+            if self.replace_run(messages, run, summary):
+                compacted.append(user)
+                log(f"[COMPACT] DM {user}: {len(run)} turns -> {summary['summary']['tokens']} tokens")
+        return compacted
@@ -3,11 +3,81 @@ Advanced context management with topic awareness
 Helps prioritize relevant messages in limited context windows
 """
 
+from collections import OrderedDict
 from typing import List, Dict, Any, Tuple, Optional
 import time
 
 from context_optimization import estimate_tokens, remove_thinking_parts
-from topic_detection import detect_message_topic, score_message_relevance
+from token_counter import get_token_counter
+from topic_detection import (
+    count_keyword_hits, count_topic_matches, detect_topic_from_hits, relevance_from_matches
+)
+
+# Bump when the cached features change shape so stored ones get recomputed
+FEATURES_VERSION = 2
+
+def extract_message_text(content: str) -> str:
+    """Extract the actual message from the <|user|> ... <|end|> format, if present"""
+    if '<|user|>' in content and '<|end|>' in content:
+        parts = content.split('<|user|>')
+        if len(parts) > 1:
+            return parts[1].split('<|end|>')[0].strip()
+    return content
+
+def annotate_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compute and cache the derived features of a history message
+
+    The features are stored under msg['features'] and persisted with the history:
+    token estimates, the thinking-stripped content and per-topic keyword matches.
+
+    Args:
+        msg: History message to annotate (modified in place)
+
+    Returns:
+        The same message
+    """
+    content = msg.get('content', '')
+    hits = count_keyword_hits(extract_message_text(content))
+    stripped = remove_thinking_parts(content)
+
+    features = {
+        'v': FEATURES_VERSION,
+        'counter': get_token_counter().name,
+        'tokens': estimate_tokens(content),
+        'topics': count_topic_matches(hits),
+        'topic': list(detect_topic_from_hits(hits))
+    }
+
+    # Only keep a second copy of the content when stripping changed it
+    if stripped != content:
+        features['stripped'] = stripped
+        features['stripped_tokens'] = estimate_tokens(stripped)
+
+    msg['features'] = features
+    return msg
+
+def get_message_features(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the cached features of a message, computing them if missing or stale"""
+    features = msg.get('features')
+    if (not features or features.get('v') != FEATURES_VERSION
+            or features.get('counter') != get_token_counter().name):
+        features = annotate_message(msg)['features']
+    return features
+
+ASSEMBLY_MODES = ('scored', 'stable')
+
+class _StableContext:
+    """Frozen prefix of one conversation's context in stable assembly mode"""
+
+    def __init__(self):
+        self.frozen: List[Dict[str, Any]] = []       # Rendered messages of the frozen block
+        self.frozen_records: List[Dict[str, Any]] = []  # History messages they came from
+        self.frozen_tokens = 0
+        self.anchor: Optional[Tuple[str, str]] = None  # (role, content) of the last message covered by the frozen block
+        self.anchor_index = -1
+        self.last_prompt: List[Dict[str, Any]] = []
+        self.last_tokens: List[int] = []
 
 class ContextManager:
     """Manages conversation context with topic awareness"""
@@ -16,7 +86,13 @@ class ContextManager:
                  max_tokens: int = 100_000,
                  recency_weight: float = 0.6,
                  relevance_weight: float = 0.4,
-                 remove_thinking: bool = True):
+                 remove_thinking: bool = True,
+                 assembly_mode: str = 'scored',
+                 frozen_ratio: float = 0.6,
+                 max_conversations: int = 64,
+                 recent_messages: int = 20,
+                 channel_messages: int = 100,
+                 retention_tokens: int = 250_000):
         """
         Initialize the context manager
 
@@ -25,23 +101,51 @@ class ContextManager:
             recency_weight: Weight for message recency in scoring (0-1)
             relevance_weight: Weight for topic relevance in scoring (0-1)
             remove_thinking: Whether to remove thinking parts from assistant responses
+            assembly_mode: "scored" orders messages by importance, "stable" keeps a frozen
+                           prefix and only appends new messages so the model can reuse its cache
+            frozen_ratio: Share of the token budget the frozen block may use in stable mode
+            max_conversations: Number of conversations whose frozen prefix is remembered
+            recent_messages: Number of latest messages always considered alongside retrieved ones
+            channel_messages: Number of latest messages of the prompt's channel queried from a history store
+            retention_tokens: Tokens of history kept in memory by prune_history, independent of the prompt budget
         """
         self.max_tokens = max_tokens
         self.recency_weight = recency_weight
         self.relevance_weight = relevance_weight
         self.remove_thinking = remove_thinking
+        self.assembly_mode = assembly_mode
+        self.frozen_ratio = frozen_ratio
+        self.max_conversations = max_conversations
+        self.recent_messages = recent_messages
+        self.channel_messages = channel_messages
+        self.retention_tokens = retention_tokens
         self.current_topic = "general"
         self.topic_confidence = 0.0
 
+        self._stable: OrderedDict[Any, _StableContext] = OrderedDict()
+        self.prefix_stats = {
+            'requests': 0,
+            'rebases': 0,
+            'prompt_tokens': 0,
+            'reused_tokens': 0,
+            'last_reused_tokens': 0
+        }
+
     def optimize_context(self,
                         history: List[Dict[str, Any]],
-                        max_tokens: Optional[int] = None) -> List[Dict[str, Any]]:
+                        max_tokens: Optional[int] = None,
+                        key: Any = 'public',
+                        retrieved: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
         """
         Optimize conversation history for small language models using topic awareness
 
         Args:
             history: List of conversation messages
             max_tokens: Maximum number of tokens to keep
+            key: Conversation the history belongs to, used by stable assembly
+            retrieved: Messages retrieved as relevant to the prompt, most relevant first.
+                       When given, only these and the latest messages are candidates.
+                       They may include messages already pruned from the history.
 
         Returns:
             Optimized conversation history
@@ -52,78 +156,321 @@ class ContextManager:
         # Update current topic based on recent messages
         self._update_current_topic(history)
 
-        # Create a working copy
-        optimized = []
+        if self.assembly_mode == 'stable':
+            return self._assemble_stable(history, max_tokens, key, retrieved)
+
+        candidates = history
+        if retrieved is not None:
+            retrieved_ids = {id(msg) for msg in retrieved}
+            recent_start = len(history) - self.recent_messages
+            candidates = [
+                msg for i, msg in enumerate(history)
+                if i >= recent_start or id(msg) in retrieved_ids
+            ]
+
+            # Pruned messages are older than anything still in the history
+            history_ids = {id(msg) for msg in history}
+            pruned = [msg for msg in retrieved if id(msg) not in history_ids]
+            pruned.sort(key=lambda msg: msg.get('timestamp', 0))
+            candidates = pruned + candidates
+
+        # Return messages in the format the model expects
+        return [
+            {'role': msg.get('role', ''), 'content': content}
+            for msg, content in self._select_messages(candidates, max_tokens)
+        ]
+
+    def gather_candidates(self,
+                          store: Any,
+                          channel: Optional[str] = None,
+                          retrieved: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        Query a bounded set of candidate messages from a history store
+
+        The latest messages, the latest messages of the prompt's channel (including
+        ones pruned from memory) and the retrieved ones. Pass the result to
+        optimize_context instead of the whole history.
+
+        Args:
+            store: SQLiteHistoryStore holding the history
+            channel: Channel of the prompt
+            retrieved: Messages retrieved as relevant to the prompt
+
+        Returns:
+            The candidates in chronological order
+        """
+        return store.candidates(channel, self.recent_messages, self.channel_messages, retrieved)
+
+    def _render(self, msg: Dict[str, Any]) -> Tuple[str, int]:
+        """Get the content to send for a message and its token count"""
+        features = get_message_features(msg)
+
+        if msg.get('role') == 'assistant' and self.remove_thinking and 'stripped' in features:
+            # For assistant messages, remove any thinking parts if enabled
+            return features['stripped'], features['stripped_tokens']
+
+        # User and system messages are kept intact
+        return msg.get('content', ''), features['tokens']
+
+    def _find_anchor(self, history: List[Dict[str, Any]], state: _StableContext) -> int:
+        """Find the index of the frozen block's last message in the history, or -1"""
+        if state.anchor is None:
+            return -1
+
+        role, content = state.anchor
+
+        # Messages are only appended or dropped from the front, so look back from the old index
+        for i in range(min(state.anchor_index, len(history) - 1), -1, -1):
+            msg = history[i]
+            if msg.get('content') == content and msg.get('role') == role:
+                return i
+
+        return -1
+
+    def _rebase(self, history: List[Dict[str, Any]], budget: int, state: _StableContext) -> None:
+        """
+        Freeze a new prefix from the most important messages of the history
+
+        The latest message is left out, it always goes last in the context. Its
+        tokens must be budgeted for before calling this.
+        """
+        earlier = history[:-1]
+        frozen_budget = int(budget * self.frozen_ratio)
+        selected = self._select_messages(earlier, frozen_budget, limit=frozen_budget) if frozen_budget > 0 else []
+
+        # The frozen block is kept in chronological order
+        order = {id(msg): i for i, msg in enumerate(earlier)}
+        selected.sort(key=lambda item: order[id(item[0])])
+
+        state.frozen = [{'role': msg.get('role', ''), 'content': content} for msg, content in selected]
+        state.frozen_records = [msg for msg, _ in selected]
+        state.frozen_tokens = sum(self._render(msg)[1] for msg in state.frozen_records)
+
+        if earlier:
+            last = earlier[-1]
+            state.anchor = (last.get('role', ''), last.get('content', ''))
+            state.anchor_index = len(earlier) - 1
+        else:
+            state.anchor = None
+            state.anchor_index = -1
+
+        self.prefix_stats['rebases'] += 1
+
+    def _assemble_stable(self,
+                         history: List[Dict[str, Any]],
+                         max_tokens: Optional[int],
+                         key: Any,
+                         retrieved: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        Build the context from a frozen prefix followed by every newer message
+
+        The frozen block stays byte-identical between requests, so the model only has
+        to evaluate the new messages at the end. It is only rebuilt (rebased) when the
+        history it was built from is gone or the new messages no longer fit the budget.
+        Retrieved messages go right before the latest message, so everything
+        in front of them stays reusable too. The latest message always goes last.
+        """
+        budget = min(self.max_tokens, max_tokens) if max_tokens else self.max_tokens
+
+        latest = history[-1]
+        latest_content, latest_tokens = self._render(latest)
+
+        state = self._stable.get(key)
+        if state is None:
+            state = self._stable[key] = _StableContext()
+            while len(self._stable) > self.max_conversations:
+                self._stable.popitem(last=False)
+        self._stable.move_to_end(key)
+
+        anchor_index = self._find_anchor(history, state)
+
+        # Render everything between the frozen block and the latest message
+        tail = []
+        tail_tokens = 0
+        if 0 <= anchor_index < len(history) - 1:
+            for msg in history[anchor_index + 1:-1]:
+                content, tokens = self._render(msg)
+                if content:
+                    tail.append(({'role': msg.get('role', ''), 'content': content}, tokens))
+                    tail_tokens += tokens
+
+        if (anchor_index < 0 or anchor_index >= len(history) - 1
+                or state.frozen_tokens + tail_tokens + latest_tokens > budget):
+            self._rebase(history, max(budget - latest_tokens, 0), state)
+            anchor_index = state.anchor_index
+            tail = []
+            tail_tokens = 0
+        else:
+            state.anchor_index = anchor_index
+
+        last = [({'role': latest.get('role', ''), 'content': latest_content}, latest_tokens)] if latest_content else []
+
+        # Retrieved messages that aren't in the context yet, least relevant first
+        extra = []
+        if retrieved:
+            remaining = budget - state.frozen_tokens - tail_tokens - latest_tokens
+            present = {id(msg) for msg in state.frozen_records}
+            present.update(id(msg) for msg in history[anchor_index + 1:])
+            for msg in retrieved:
+                if id(msg) in present:
+                    continue
+                content, tokens = self._render(msg)
+                if not content or tokens > remaining:
+                    continue
+                extra.append(({'role': msg.get('role', ''), 'content': content}, tokens))
+                remaining -= tokens
+            extra.reverse()
+
+        body = tail + extra + last
+        prompt = state.frozen + [msg for msg, _ in body]
+        tokens = [self._render(msg)[1] for msg in state.frozen_records] + [t for _, t in body]
+
+        self._record_prefix_reuse(state, prompt, tokens)
+        return prompt
+
+    def _record_prefix_reuse(self, state: _StableContext, prompt: List[Dict[str, Any]], tokens: List[int]) -> None:
+        """Count the tokens this prompt shares as a prefix with the previous one"""
+        reused = 0
+        for previous, current, count in zip(state.last_prompt, prompt, tokens):
+            if previous != current:
+                break
+            reused += count
+
+        state.last_prompt = prompt
+        state.last_tokens = tokens
+
+        self.prefix_stats['requests'] += 1
+        self.prefix_stats['prompt_tokens'] += sum(tokens)
+        self.prefix_stats['reused_tokens'] += reused
+        self.prefix_stats['last_reused_tokens'] = reused
+
+    def reset_stable_context(self, key: Any = None) -> None:
+        """
+        Forget the frozen prefix of a conversation so the next request rebases
+
+        Args:
+            key: Conversation to reset, or None to reset all of them
+        """
+        if key is None:
+            self._stable.clear()
+        else:
+            self._stable.pop(key, None)
+
+    def get_prefix_stats(self) -> Dict[str, Any]:
+        """
+        Get prompt prefix reuse statistics for stable assembly
+
+        Returns:
+            Dictionary with request, rebase and token counts, plus the average
+            number of prompt-eval tokens saved per request
+        """
+        stats = dict(self.prefix_stats)
+        requests = stats['requests']
+        stats['avg_reused_tokens'] = stats['reused_tokens'] / requests if requests else 0
+        stats['reuse_ratio'] = stats['reused_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0
+        return stats
+
+    def prune_history(self,
+                      history: List[Dict[str, Any]],
+                      max_tokens: Optional[int] = None,
+                      key: Any = 'public') -> List[Dict[str, Any]]:
+        """
+        Drop the least important messages from a history once it outgrows the retention budget
+
+        The budget is separate from the prompt budget, so messages outside the
+        current prompt stay available for later ones. Unlike optimize_context, the
+        original messages (with their cached features) are kept and returned in
+        chronological order.
+
+        Args:
+            history: List of conversation messages
+            max_tokens: Maximum number of tokens to keep, retention_tokens if not given
+            key: Conversation the history belongs to, used by stable assembly
+
+        Returns:
+            Pruned conversation history
+        """
+        if not history:
+            return history
+
+        budget = max_tokens or self.retention_tokens
+        self._update_current_topic(history)
+        kept = {id(msg) for msg, _ in self._select_messages(history, budget, limit=budget)}
+
+        anchor = None
+        if self.assembly_mode == 'stable' and key in self._stable:
+            # The frozen prefix and everything after it are always kept, so the prefix survives
+            state = self._stable[key]
+            anchor_index = self._find_anchor(history, state)
+            if anchor_index >= 0:
+                anchor = history[anchor_index]
+                kept.update(id(msg) for msg in state.frozen_records)
+                kept.update(id(msg) for msg in history[anchor_index:])
+
+        pruned = [msg for msg in history if id(msg) in kept]
+        if anchor is not None:
+            state.anchor_index = next(i for i, msg in enumerate(pruned) if msg is anchor)
+        return pruned
+
+    def _select_messages(self,
+                         history: List[Dict[str, Any]],
+                         max_tokens: Optional[int] = None,
+                         limit: Optional[int] = None) -> List[Tuple[Dict[str, Any], str]]:
+        """
+        Pick the most important messages that fit in the token budget
+
+        Args:
+            history: List of conversation messages
+            max_tokens: Maximum number of tokens to keep
+            limit: Hard token limit, the context's max_tokens if not given
+
+        Returns:
+            List of (message, optimized content) tuples in order of importance
+        """
+        selected = []
         current_tokens = 0
+        limit = limit or self.max_tokens
 
         # Score and sort messages by importance
         scored_messages = self._score_messages(history)
 
         # Process messages in order of importance
         for msg, _ in scored_messages:
-            role = msg.get('role', '')
-            content = msg.get('content', '')
-
-            # Skip empty messages
-            if not content:
-                continue
-
-            # Estimate token count for this message
-            message_tokens = estimate_tokens(content)
-
-            # Apply role-specific optimizations
-            if role == 'user':
-                # For user messages, keep them intact - they provide important context
-                optimized_content = content
-                message_tokens = estimate_tokens(optimized_content)
-            elif role == 'assistant':
-                # For assistant messages, remove any thinking parts if enabled
-                optimized_content = remove_thinking_parts(content) if self.remove_thinking else content
-                message_tokens = estimate_tokens(optimized_content)
-            else:
-                # For system messages, keep intact
-                optimized_content = content
+            optimized_content, message_tokens = self._render(msg)
 
             # If adding this message exceeds the token limit and we have at least some context
             # then stop adding more messages
-            if current_tokens + message_tokens > self.max_tokens and optimized:
+            if current_tokens + message_tokens > limit and selected:
                 break
 
-            # Add the optimized message to our context
-            optimized.append({
-                'role': role,
-                'content': optimized_content
-            })
+            selected.append((msg, optimized_content))
             current_tokens += message_tokens
 
             # If we've reached max_tokens, stop
             if max_tokens and current_tokens >= max_tokens:
                 break
 
-        # Return in chronological order
-        return optimized
+        return selected
 
     def _update_current_topic(self, history: List[Dict[str, Any]]) -> None:
         """Update the current conversation topic based on recent messages"""
         # Extract recent user messages (last 5)
-        recent_messages = []
+        recent_topics = []
         for msg in reversed(history):
-            if msg.get('role') == 'user' and len(recent_messages) < 5:
+            if len(recent_topics) >= 5:
+                break
+            if msg.get('role') == 'user':
                 content = msg.get('content', '')
-                # Extract the actual message from the format
+                # Only messages in the <|user|> format are considered
                 if '<|user|>' in content and '<|end|>' in content:
-                    parts = content.split('<|user|>')
-                    if len(parts) > 1:
-                        msg_content = parts[1].split('<|end|>')[0].strip()
-                        recent_messages.append(msg_content)
+                    recent_topics.append(get_message_features(msg)['topic'])
 
-        # If we have recent messages, detect their topics
-        if recent_messages:
+        # If we have recent messages, use their cached topics
+        if recent_topics:
             topic_counts = {}
             total_confidence = 0
 
-            for message in recent_messages:
-                topic, confidence = detect_message_topic(message)
+            for topic, confidence in recent_topics:
                 topic_counts[topic] = topic_counts.get(topic, 0) + confidence
                 total_confidence += confidence
 
@@ -159,18 +506,9 @@ class ContextManager:
             # Calculate recency score (0-1) - more recent = higher score
             recency_score = i / history_length if history_length > 0 else 0
 
-            # Calculate relevance score for this message
-            relevance_score = 0.5  # Default medium relevance
-
-            # Extract the actual message from the format
-            clean_content = content
-            if '<|user|>' in content and '<|end|>' in content:
-                parts = content.split('<|user|>')
-                if len(parts) > 1:
-                    clean_content = parts[1].split('<|end|>')[0].strip()
-
-            # Score relevance based on topic
-            relevance_score = score_message_relevance(clean_content, self.current_topic)
+            # Score relevance from the cached keyword matches
+            matches = get_message_features(msg)['topics'].get(self.current_topic, 0)
+            relevance_score = relevance_from_matches(matches, self.current_topic)
 
             # Combine scores - weight recency and relevance appropriately
             combined_score = (
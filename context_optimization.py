@@ -3,6 +3,8 @@ Context optimization for small language models
 This module helps with context pruning and optimization for small LLMs
 """
 
+from token_counter import count_tokens
+
 def optimize_context(history, max_tokens=100_000, max_messages=None):
     """
     Optimizes conversation history for small language models by:
@@ -91,15 +93,13 @@ def remove_thinking_parts(text):
 
 def estimate_tokens(text):
     """
-    Estimate the number of tokens in text
-    A rough approximation of 4 characters per token
+    Count the number of tokens in text
+    Uses the shared token counter, see token_counter.py
     
     Args:
-        text: The text to estimate tokens for
+        text: The text to count tokens for
         
     Returns:
-        Estimated token count
+        Token count
     """
-    if not text:
-        return 0
-    return len(text) // 4  # Simple approximation of tokens
+    return count_tokens(text)
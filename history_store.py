@@ -0,0 +1,225 @@
+"""
+Append-only persistence for message history
+New messages are appended to a journal file as single JSON lines, and the full
+history is only rewritten into a snapshot when the journal is compacted
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import threading
+import asyncio
+import shutil
+import json
+import os
+
+from message_record import Message, json_default
+from log_writer import log, WARNING
+
+class HistoryJournal:
+    """Snapshot + journal storage for public and private message history"""
+
+    def __init__(self,
+                 snapshot_path: str = 'message_history.json',
+                 journal_path: str = 'message_history.journal',
+                 compact_every: int = 1000):
+        """
+        Initialize the history journal
+
+        Args:
+            snapshot_path: File holding the last full snapshot of the history
+            journal_path: File that new messages are appended to
+            compact_every: Number of journal records after which a compaction is due
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.rotated_path = journal_path + '.1'
+        self.compact_every = compact_every
+
+        self.seq = 0          # Sequence number of the last record written
+        self.pending = 0      # Records written since the last compaction
+        self.compacting = False
+        self._file = None
+        self._snapshot_seq = 0
+        self._lock = threading.RLock()
+
+    def load(self) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        """
+        Load the snapshot and replay every journal record written after it
+
+        Returns:
+            Tuple of (public history, private history by user)
+
+        Raises:
+            FileNotFoundError: If neither a snapshot nor a journal exists
+        """
+        public = []
+        private = {}
+        snapshot_seq = 0
+        found = False
+
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                data = json.load(f)
+            public = [Message.from_dict(msg) for msg in data.get('public', [])]
+            private = data.get('private', {})
+            snapshot_seq = data.get('seq', 0)
+            found = True
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            # A half-written snapshot is never renamed into place, so this
+            # only happens to files written by an older version of the bot
+            log(f'Snapshot {self.snapshot_path} is corrupted, replaying journal only', level=WARNING)
+
+        self.seq = snapshot_seq
+        self._snapshot_seq = snapshot_seq
+
+        # A rotated journal is left behind if the bot died mid-compaction
+        for path in (self.rotated_path, self.journal_path):
+            try:
+                f = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+
+            found = True
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn write at the end of the file
+                        continue
+
+                    if record['seq'] <= snapshot_seq:
+                        continue
+
+                    self._apply(record, public, private)
+                    self.seq = max(self.seq, record['seq'])
+                    self.pending += 1
+
+        if not found:
+            raise FileNotFoundError(self.snapshot_path)
+
+        return public, private
+
+    @staticmethod
+    def _apply(record: Dict[str, Any],
+               public: List[Dict[str, Any]],
+               private: Dict[str, List[Dict[str, Any]]]) -> None:
+        """Apply a single journal record to the in-memory history"""
+        user = record.get('user')
+        if user is None:
+            public.append(Message.from_dict(record['msg']))
+        else:
+            private.setdefault(user, []).append(record['msg'])
+
+    def append(self, msg: Dict[str, Any], user: Optional[str] = None) -> None:
+        """
+        Append a single message to the journal
+
+        Args:
+            msg: The history message that was just added
+            user: Private conversation the message belongs to, or None for public history
+        """
+        if self._file is None:
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+
+        self.seq += 1
+        self.pending += 1
+
+        record = {'seq': self.seq, 'msg': msg}
+        if user is not None:
+            record['user'] = user
+
+        self._file.write(json.dumps(record, default=json_default) + '\n')
+        self._file.flush()
+
+    @property
+    def needs_compaction(self) -> bool:
+        """Whether enough records have piled up in the journal to compact it"""
+        return self.pending >= self.compact_every and not self.compacting
+
+    def _rotate(self) -> int:
+        """Move the current journal aside so new appends go to a fresh file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.rotated_path):
+                # A previous compaction hasn't finished yet, keep its records too
+                with open(self.journal_path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.rotated_path)
+
+        self.pending = 0
+        return self.seq
+
+    def _write_snapshot(self,
+                        public: List[Dict[str, Any]],
+                        private: Optional[Dict[str, List[Dict[str, Any]]]],
+                        seq: int) -> None:
+        """Atomically write a snapshot and drop the journal records it covers"""
+        with self._lock:
+            # A newer snapshot was written while this one was waiting
+            if seq < self._snapshot_seq:
+                return
+
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'seq': seq, 'public': public, 'private': private or {}}, f, default=json_default)
+            os.replace(tmp_path, self.snapshot_path)
+            self._snapshot_seq = seq
+
+            try: os.remove(self.rotated_path)
+            except FileNotFoundError: ...
+
+    def compact(self,
+                public: List[Dict[str, Any]],
+                private: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> None:
+        """
+        Write a full snapshot of the history and truncate the journal
+
+        Args:
+            public: Public message history
+            private: Private message history by user, None if it is stored elsewhere
+        """
+        with self._lock:
+            seq = self._rotate()
+            self._write_snapshot(public, private, seq)
+
+    async def compact_in_background(self,
+                                    public: List[Dict[str, Any]],
+                                    private: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> None:
+        """
+        Compact the journal without blocking the event loop
+
+        The history is copied and the journal rotated synchronously, so messages
+        appended while the snapshot is being written land in the new journal.
+
+        Args:
+            public: Public message history
+            private: Private message history by user, None if it is stored elsewhere
+        """
+        if self.compacting:
+            return
+
+        self.compacting = True
+        try:
+            public = list(public)
+            private = {user: list(msgs) for user, msgs in (private or {}).items()}
+            seq = self._rotate()
+            await asyncio.to_thread(self._write_snapshot, public, private, seq)
+        finally:
+            self.compacting = False
+
+    def clear(self) -> None:
+        """Replace the stored history with an empty one"""
+        self.compact([])
+
+    def close(self) -> None:
+        """Close the journal file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,389 @@
+"""
+Load test of the whole bot pipeline without Discord or a real model
+Starts the mock Ollama server, imports the bot against it and fires synthetic
+mentions, DMs and plain messages from many users across many channels through
+on_message at a configurable rate. Reports end-to-end latency of prompts,
+ingestion throughput of plain messages and event-loop lag.
+
+The bot runs in a temporary directory (or --workdir), so the real history and
+settings are never touched.
+
+Usage: python loadtest.py [--rate 20] [--duration 30] [--mention-ratio 0.05] [--dm-ratio 0.02] [--output FILE]
+"""
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from mock_ollama import MockOllama
+from pipeline_benchmark import FILLER, make_history, percentile
+from topic_detection import TOPICS
+
+# Descriptions of the embeds shown before the answer starts
+PLACEHOLDERS = ('Loading', 'Queued', 'Waiting', 'Thinking')
+
+class Event:
+    """A synthetic message and what happened to it"""
+
+    def __init__(self, kind: str, message: Any, sent_at: float):
+        self.kind = kind              # 'plain', 'mention' or 'dm'
+        self.message = message
+        self.sent_at = sent_at        # When the event was due to be dispatched
+        self.handled: Optional[float] = None       # Seconds on_message took
+        self.first_answer: Optional[float] = None  # Seconds until an edit showed part of the answer
+        self.done: Optional[float] = None          # Seconds until the request finished
+        self.job = None
+        self.error: Optional[str] = None
+
+# The event whose on_message call is running, so queued jobs can be matched to their event
+current_event: ContextVar[Optional[Event]] = ContextVar('current_event', default=None)
+
+class SyntheticDiscord:
+    """Builds stand-ins for the discord.py objects on_message uses"""
+
+    def __init__(self, bot_user: Any, channels: int, users: int, edit_latency: float, seed: int):
+        """
+        Initialize the synthetic guild
+
+        Args:
+            bot_user: The bot's own user, mentioned by prompts
+            channels: Number of text channels
+            users: Number of users sending messages
+            edit_latency: Seconds each reply and edit takes, like a Discord REST call
+            seed: Random seed of the messages
+        """
+        self.bot_user = bot_user
+        self.edit_latency = edit_latency
+        self.rng = random.Random(seed)
+        self.vocabulary = [kw for topic_info in TOPICS.values() for kw in topic_info['keywords']] + FILLER
+        self.next_id = 10**17
+
+        everyone = SimpleNamespace(id=1, name='@everyone')
+        self.guild = SimpleNamespace(id=1287014795303845919, name='Synthetic', default_role=everyone)
+        self.channels = [self._channel(f'channel-{i}', self.guild) for i in range(channels)]
+        self.users = [
+            SimpleNamespace(id=10**16 + i, name=f'user{i}', display_name=f'User {i}', bot=False)
+            for i in range(users)
+        ]
+
+    def _new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _channel(self, name: str, guild: Any) -> SimpleNamespace:
+        @asynccontextmanager
+        async def typing():
+            yield
+
+        return SimpleNamespace(
+            id=self._new_id(),
+            name=name,
+            guild=guild,
+            permissions_for=lambda role: SimpleNamespace(read_messages=True),
+            typing=typing
+        )
+
+    def _reply(self, event_ref: List[Event]) -> Any:
+        """message.reply for a synthetic message, recording when the answer becomes visible"""
+        latency = self.edit_latency
+
+        def record(kwargs):
+            event = event_ref[0]
+            embed = kwargs.get('embed')
+            description = (embed.description or '') if embed is not None else kwargs.get('content', '')
+            if event.first_answer is None and description and not description.startswith(PLACEHOLDERS):
+                event.first_answer = time.perf_counter() - event.sent_at
+
+        async def edit(**kwargs):
+            await asyncio.sleep(latency)
+            record(kwargs)
+
+        async def reply(*args, **kwargs):
+            await asyncio.sleep(latency)
+            record(kwargs)
+            return SimpleNamespace(id=self._new_id(), edit=edit)
+
+        return reply
+
+    def message(self, kind: str) -> Event:
+        """
+        Create a synthetic message
+
+        Args:
+            kind: 'plain' for a message the bot only ingests, 'mention' for a prompt
+                  in a channel, 'dm' for a private prompt
+
+        Returns:
+            The event, with sent_at still to be set
+        """
+        author = self.rng.choice(self.users)
+        words = ' '.join(self.rng.choice(self.vocabulary) for _ in range(self.rng.randint(3, 30)))
+        message_id = self._new_id()
+        # Unique text, so the response cache doesn't answer the prompts
+        content = f'{words} #{message_id % 100_000}'
+
+        mentions = []
+        if kind == 'mention':
+            content = f'<@{self.bot_user.id}> {content}'
+            mentions = [self.bot_user]
+
+        if kind == 'dm':
+            guild = None
+            channel = SimpleNamespace(id=self._new_id(), name=f'dm-{author.name}')
+        else:
+            guild = self.guild
+            channel = self.rng.choice(self.channels)
+
+        event_ref: List[Event] = []
+        message = SimpleNamespace(
+            id=message_id,
+            content=content,
+            author=author,
+            channel=channel,
+            guild=guild,
+            mentions=mentions,
+            channel_mentions=[],
+            role_mentions=[],
+            reply=self._reply(event_ref)
+        )
+        event = Event(kind, message, 0.0)
+        event_ref.append(event)
+        return event
+
+async def monitor_loop_lag(lags: List[float], interval: float = 0.01) -> None:
+    """Measure how late the event loop wakes up from a sleep, in seconds"""
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+def describe(values: List[float], scale: float = 1.0) -> Dict[str, float]:
+    """Count, mean, p50, p95, p99 and max of measurements, multiplied by scale"""
+    if not values:
+        return {'n': 0}
+
+    ordered = sorted(value * scale for value in values)
+    return {
+        'n': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': percentile(ordered, 0.50),
+        'p95': percentile(ordered, 0.95),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1]
+    }
+
+def format_stats(stats: Dict[str, float], unit: str) -> str:
+    if not stats['n']:
+        return 'no samples'
+    return (f"n={stats['n']}  mean {stats['mean']:.1f}{unit}  p50 {stats['p50']:.1f}{unit}  "
+            f"p95 {stats['p95']:.1f}{unit}  p99 {stats['p99']:.1f}{unit}  max {stats['max']:.1f}{unit}")
+
+async def dispatch(bot: Any, event: Event) -> None:
+    """Run on_message like discord.py does and wait for the request it queued"""
+    current_event.set(event)
+    started = time.perf_counter()
+    try:
+        await bot.on_message(event.message)
+    except Exception as e:
+        event.error = f'{type(e).__name__}: {e}'
+    event.handled = time.perf_counter() - started
+
+    if event.job is not None:
+        try:
+            await event.job
+        except Exception as e:
+            event.error = f'{type(e).__name__}: {e}'
+        event.done = time.perf_counter() - event.sent_at
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mock = MockOllama(
+        port=0,
+        token_rate=args.token_rate,
+        first_token_delay=args.first_token_delay,
+        prompt_rate=args.prompt_rate,
+        think_tokens=args.think_tokens,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        stream_error_rate=args.stream_error_rate,
+        parallel=args.parallel,
+        seed=args.seed
+    )
+    await mock.start()
+    print(f'Mock Ollama listening on {mock.url}')
+
+    # The bot reads its configuration from the environment and working directory on import
+    workdir = args.workdir or tempfile.mkdtemp(prefix='chatbot-loadtest-')
+    os.environ['CHATBOT_DIR'] = workdir
+    os.environ['OLLAMA_HOST'] = mock.url
+    os.environ['OLLAMA_NUM_PARALLEL'] = str(args.parallel)
+    os.environ['LOG_LEVEL'] = args.log_level
+    # The bot keeps using relative paths, so the working directory stays there
+    import bot
+    print(f'Bot running in {workdir}')
+
+    # What discord.py would have set up after logging in
+    bot_user = SimpleNamespace(id=1, name='ChatBot V2', display_name='ChatBot V2', bot=True)
+    bot.client.loop = asyncio.get_running_loop()
+    bot.client._connection.user = bot_user
+
+    async def change_presence(**kwargs):
+        pass
+    bot.client.change_presence = change_presence
+
+    # Remember which event queued each job
+    submit = bot.request_queue.submit
+    def submit_and_record(user_id, run):
+        job = submit(user_id, run)
+        event = current_event.get()
+        if event is not None:
+            event.job = job
+        return job
+    bot.request_queue.submit = submit_and_record
+
+    if args.history:
+        data = make_history(args.history, args.seed)
+        bot.history.extend(bot.annotate_message(bot.Message.from_dict(msg)) for msg in data['public'])
+        bot.private_store.import_legacy(data['private'])
+        bot.retrieval_index.rebuild(bot.history)
+        await bot.retrieval_index.flush()
+        print(f'Loaded {len(bot.history)} synthetic history messages')
+
+    if not await bot.warmup.start():
+        raise RuntimeError('The bot could not warm up against the mock server')
+
+    discord_stub = SyntheticDiscord(bot_user, args.channels, args.users, args.edit_latency, args.seed)
+    rng = random.Random(args.seed)
+    lags: List[float] = []
+    lag_monitor = asyncio.create_task(monitor_loop_lag(lags))
+
+    # Open-loop arrivals, the rate doesn't drop when the bot falls behind
+    events: List[Event] = []
+    tasks = []
+    started = time.perf_counter()
+    next_at = started
+    while next_at - started < args.duration:
+        roll = rng.random()
+        kind = 'mention' if roll < args.mention_ratio else 'dm' if roll < args.mention_ratio + args.dm_ratio else 'plain'
+        event = discord_stub.message(kind)
+
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        event.sent_at = time.perf_counter()
+        events.append(event)
+        tasks.append(asyncio.create_task(dispatch(bot, event)))
+        next_at += rng.expovariate(args.rate)
+
+    sending_time = time.perf_counter() - started
+    print(f'Sent {len(events)} events in {sending_time:.1f}s, waiting for the requests to finish...')
+    _, unfinished = await asyncio.wait(tasks, timeout=args.drain_timeout)
+    for task in unfinished:
+        task.cancel()
+    total_time = time.perf_counter() - started
+
+    lag_monitor.cancel()
+    bot.log.flush()
+
+    plain = [event for event in events if event.kind == 'plain']
+    prompts = [event for event in events if event.kind != 'plain']
+    handled = [event.handled for event in plain if event.handled is not None]
+
+    report = {
+        'config': vars(args),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'events': {
+            'total': len(events),
+            'plain': len(plain),
+            'mentions': sum(event.kind == 'mention' for event in events),
+            'dms': sum(event.kind == 'dm' for event in events),
+            'achieved_rate': len(events) / sending_time if sending_time > 0 else 0
+        },
+        'requests': {
+            'queued': sum(event.job is not None for event in prompts),
+            'rejected': sum(event.job is None and event.error is None for event in prompts),
+            'completed': sum(event.done is not None and event.error is None for event in prompts),
+            'failed': sum(event.error is not None for event in prompts),
+            'unfinished': len(unfinished),
+            'throughput': sum(event.done is not None for event in prompts) / total_time
+        },
+        'end_to_end_ms': describe([event.done for event in prompts if event.done is not None and event.error is None], 1000),
+        'first_answer_ms': describe([event.first_answer for event in prompts if event.first_answer is not None], 1000),
+        'ingestion': {
+            'handler_ms': describe(handled, 1000),
+            # Plain messages per second on_message could keep up with if it had the loop to itself
+            'capacity_per_sec': len(handled) / sum(handled) if handled and sum(handled) > 0 else 0
+        },
+        'loop_lag_ms': describe(lags, 1000),
+        # Where the time of each kind of message went, from the bot's own traces
+        'stages_ms': {
+            kind: {
+                stage: {key: value * 1000 if key != 'count' else value for key, value in stats.items()}
+                for stage, stats in stages.items()
+            }
+            for kind, stages in bot.tracer.summary().items()
+        },
+        'mock': dict(mock.stats)
+    }
+
+    await mock.close()
+    return report
+
+def print_report(report: Dict[str, Any]) -> None:
+    events, requests = report['events'], report['requests']
+    print(f"Events:        {events['total']} ({events['plain']} plain, {events['mentions']} mentions, "
+          f"{events['dms']} DMs) at {events['achieved_rate']:.1f}/s")
+    print(f"Requests:      {requests['completed']} completed, {requests['failed']} failed, "
+          f"{requests['rejected']} rejected, {requests['unfinished']} unfinished, {requests['throughput']:.2f}/s")
+    print(f"End to end:    {format_stats(report['end_to_end_ms'], 'ms')}")
+    print(f"First answer:  {format_stats(report['first_answer_ms'], 'ms')}")
+    print(f"Ingestion:     {format_stats(report['ingestion']['handler_ms'], 'ms')}, "
+          f"capacity {report['ingestion']['capacity_per_sec']:.0f} messages/s")
+    print(f"Loop lag:      {format_stats(report['loop_lag_ms'], 'ms')}")
+
+    for kind, stages in sorted(report['stages_ms'].items()):
+        print(f'Stages of {kind} messages:')
+        for stage, stats in sorted(stages.items(), key=lambda item: -item[1]['sum']):
+            print(f"  {stage:<20} n={stats['count']:<6} p50 {stats['0.5']:>9.1f}ms  "
+                  f"p90 {stats['0.9']:>9.1f}ms  p99 {stats['0.99']:>9.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=20.0, help='Events per second')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to send events for')
+    parser.add_argument('--mention-ratio', type=float, default=0.05, help='Fraction of events mentioning the bot')
+    parser.add_argument('--dm-ratio', type=float, default=0.02, help='Fraction of events that are DMs')
+    parser.add_argument('--channels', type=int, default=20, help='Number of channels')
+    parser.add_argument('--users', type=int, default=200, help='Number of users')
+    parser.add_argument('--history', type=int, default=1000, help='Synthetic public history messages to start with')
+    parser.add_argument('--edit-latency', type=float, default=0.05, help='Seconds each Discord reply or edit takes')
+    parser.add_argument('--drain-timeout', type=float, default=120.0, help='Seconds to wait for requests after sending')
+    parser.add_argument('--token-rate', type=float, default=40.0, help='Tokens per second of the mock model')
+    parser.add_argument('--first-token-delay', type=float, default=0.3, help='Seconds before the mock model\'s first token')
+    parser.add_argument('--prompt-rate', type=float, default=0.0, help='Prompt tokens per second of the mock model, 0 to ignore')
+    parser.add_argument('--think-tokens', type=int, default=20, help='Tokens in the mock model\'s <think> block')
+    parser.add_argument('--response-tokens', type=int, default=60, help='Tokens of the mock model\'s answer')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of mock requests failing with HTTP 500')
+    parser.add_argument('--stream-error-rate', type=float, default=0.0, help='Fraction of mock streams failing halfway')
+    parser.add_argument('--parallel', type=int, default=1, help='Requests the mock model generates at the same time')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the events and the mock model')
+    parser.add_argument('--workdir', default=None, help='Directory the bot runs in, defaults to a new temporary directory')
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the bot')
+    parser.add_argument('--output', default=None, help='JSON file to write the report to')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved report to {args.output}')
+
+if __name__ == '__main__':
+    main()
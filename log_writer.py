@@ -0,0 +1,228 @@
+"""
+Buffered log writer
+Log lines are queued and written to the log file in batches by a background
+thread, so logging never blocks the event loop on file I/O. The file is
+rotated by size, and the tail can be read without loading the whole file.
+Modules log through log(), which goes to the writer installed with
+set_default_writer, or to stdout when none is installed.
+"""
+
+from typing import List, Optional
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+
+class LogWriter:
+    """Log file writer with a background thread, batched flushes and size-based rotation"""
+
+    def __init__(self,
+                 path: str = 'bot.log',
+                 level: int = INFO,
+                 max_bytes: int = 5_000_000,
+                 backups: int = 3,
+                 flush_interval: float = 1.0,
+                 echo: bool = True):
+        """
+        Initialize the log writer and start its thread
+
+        Args:
+            path: Path of the log file
+            level: Minimum level of messages that are logged
+            max_bytes: Size at which the log file is rotated
+            backups: Number of rotated files kept (bot.log.1, bot.log.2, ...)
+            flush_interval: Seconds between batched writes
+            echo: Whether messages are also written to stdout
+        """
+        self.path = path
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.echo = echo
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+        atexit.register(self.close)
+
+    def enabled(self, level: int) -> bool:
+        """Whether messages of a level are logged"""
+        return level >= self.level
+
+    def write(self, text: str, level: int = INFO, flush: bool = False) -> None:
+        """
+        Queue text for the log file
+
+        Args:
+            text: The text to log, including its line ending
+            level: Level of the message
+            flush: Whether to flush stdout right away
+        """
+        if level < self.level or self._closed:
+            return
+
+        if self.echo:
+            sys.stdout.write(text)
+            if flush:
+                sys.stdout.flush()
+
+        self._queue.put(text)
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """
+        Block until everything queued so far is written
+
+        Args:
+            timeout: Maximum seconds to wait
+        """
+        if self._closed:
+            return
+
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait(timeout)
+
+    def close(self) -> None:
+        """Write what is left and stop the writer thread"""
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(5)
+
+    def tail(self, max_bytes: int = 4000) -> str:
+        """
+        Read the end of the log file
+
+        Args:
+            max_bytes: Maximum number of bytes to read
+
+        Returns:
+            The last lines of the log that fit in max_bytes
+        """
+        self.flush(self.flush_interval * 5)
+
+        data = b''
+        # Right after a rotation the current file is short, continue into the previous one
+        for path in (self.path, f'{self.path}.1'):
+            remaining = max_bytes - len(data)
+            if remaining <= 0:
+                break
+
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - remaining))
+                    data = f.read() + data
+            except FileNotFoundError:
+                continue
+
+        text = data.decode('utf-8', errors='ignore')
+
+        # Drop the partial first line
+        if len(data) >= max_bytes and '\n' in text:
+            text = text.split('\n', 1)[1]
+        return text
+
+    def _rotate(self) -> None:
+        """Shift bot.log to bot.log.1, bot.log.1 to bot.log.2, ..."""
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def _run(self) -> None:
+        """Writer thread: collect everything queued, write it in one go, then wait for more"""
+        file = open(self.path, 'a', encoding='utf-8')
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            texts: List[str] = []
+            waiting: List[threading.Event] = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    texts.append(item)
+
+            if texts:
+                try:
+                    file.write(''.join(texts))
+                    file.flush()
+
+                    if file.tell() >= self.max_bytes:
+                        file.close()
+                        self._rotate()
+                        file = open(self.path, 'a', encoding='utf-8')
+                except OSError as e:
+                    sys.stderr.write(f'Failed to write {self.path}: {e}\n')
+
+            for event in waiting:
+                event.set()
+
+            # Let the next batch build up, unless someone is waiting for it
+            if running and not waiting:
+                time.sleep(self.flush_interval)
+
+        file.close()
+
+_default_writer: Optional[LogWriter] = None
+
+def set_default_writer(writer: Optional[LogWriter]) -> None:
+    """
+    Install the writer that log() goes to
+
+    Args:
+        writer: The log writer, or None to log to stdout
+    """
+    global _default_writer
+    _default_writer = writer
+
+def get_default_writer() -> Optional[LogWriter]:
+    """The writer that log() goes to, None if it goes to stdout"""
+    return _default_writer
+
+def log(*args, end: str = '\n', flush: bool = False, level: int = INFO) -> None:
+    """
+    Log a message like print, through the installed writer
+
+    Args:
+        args: Values to log, separated by spaces
+        end: Text appended after the last value
+        flush: Whether to flush stdout right away
+        level: Level of the message
+    """
+    text = ' '.join(map(str, args)) + end
+    writer = _default_writer
+    if writer is None:
+        sys.stdout.write(text)
+        if flush:
+            sys.stdout.flush()
+        return
+    writer.write(text, level, flush)
@@ -0,0 +1,111 @@
+"""
+Memory benchmark of the in-memory history representation
+Loads synthetic histories the way the bot does, once as plain dicts and once as
+Message records, and compares the memory they hold, how long loading takes and
+how long building a prompt from them takes. Results are saved as JSON so they
+can be compared between commits.
+
+Usage: python memory_benchmark.py [--sizes 10000,100000] [--output FILE]
+"""
+
+import argparse
+import gc
+import json
+import platform
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from context_manager import ContextManager, annotate_message
+from message_record import Message, json_default
+from pipeline_benchmark import git_commit, make_history
+import message_record
+
+REPRESENTATIONS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    'dict': lambda msg: msg,
+    'record': Message.from_dict
+}
+
+def load(raw: str, convert: Callable[[Dict[str, Any]], Any]) -> List[Any]:
+    """Decode a stored history and annotate it, like loading message_history.json"""
+    return [annotate_message(convert(msg)) for msg in json.loads(raw)]
+
+def run_size(size: int, seed: int) -> List[Dict[str, Any]]:
+    """Compare the representations on a history of the given size"""
+    raw = json.dumps(make_history(size, seed)['public'], default=json_default)
+
+    results = []
+    for name, convert in REPRESENTATIONS.items():
+        # Memory still held once loading is done, measured on its own since tracing slows everything down.
+        # Shared features from earlier runs would otherwise not be counted.
+        for shared in (message_record._shared_features, message_record._shared_topics, message_record._shared_topic):
+            shared.clear()
+        gc.collect()
+        tracemalloc.start()
+        history = load(raw, convert)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del history
+        gc.collect()
+
+        started = time.perf_counter()
+        history = load(raw, convert)
+        load_time = time.perf_counter() - started
+
+        # Prompt building reads every rendered content, which records produce on demand
+        manager = ContextManager(max_tokens=100_000, assembly_mode='scored')
+        started = time.perf_counter()
+        for _ in range(5):
+            manager.optimize_context(history, max_tokens=75_000, key='public')
+        assemble_time = (time.perf_counter() - started) / 5
+
+        started = time.perf_counter()
+        json.dumps(history, default=json_default)
+        save_time = time.perf_counter() - started
+
+        result = {
+            'representation': name,
+            'size': size,
+            'held_mib': held / 2**20,
+            'peak_mib': peak / 2**20,
+            'bytes_per_message': held / size,
+            'load_ms': load_time * 1000,
+            'optimize_context_ms': assemble_time * 1000,
+            'save_ms': save_time * 1000
+        }
+        print(f"{name:<8} {size:>7}  held {result['held_mib']:>8.1f} MiB ({result['bytes_per_message']:>6.0f} B/msg)  "
+              f"peak {result['peak_mib']:>8.1f} MiB  load {result['load_ms']:>8.1f} ms  "
+              f"optimize_context {result['optimize_context_ms']:>7.1f} ms  save {result['save_ms']:>7.1f} ms")
+        results.append(result)
+        del history
+
+    dicts, records = results
+    print(f"{'':<8} {size:>7}  records hold {1 - records['held_mib'] / dicts['held_mib']:.0%} less memory")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000', help='Comma-separated history sizes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic histories')
+    parser.add_argument('--output', default=None, help='JSON file to write, defaults to memory_benchmark_<commit>.json')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': []
+    }
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        report['results'].extend(run_size(size, args.seed))
+
+    output = args.output or f'memory_benchmark_{commit}.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved results to {output}')
+
+if __name__ == '__main__':
+    main()
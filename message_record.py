@@ -0,0 +1,222 @@
+"""
+Compact history messages
+A history message is a slotted record instead of a dict: the role is an enum,
+channel and author are interned strings shared by every message that has them,
+and the '[#channel] author: ' prefix is only put in front of the text when the
+content is read, which happens when a prompt is built. Records still behave like
+the dicts they replace, so code reading msg['content'] or msg.get('role') works
+with either.
+"""
+
+from enum import Enum
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import time
+import sys
+import re
+
+# '[#channel] author: text' for users, '[channel] ChatBot V2: text' for the bot, '[DM] name: text' in private
+_PREFIX_RE = re.compile(r'^\[([^\]]+)\] ([^:\n]+?): ', re.DOTALL)
+
+# Milliseconds between the Unix epoch and the Discord epoch
+DISCORD_EPOCH = 1420070400000
+
+# Keys that have their own slot, everything else goes to extra
+_FIELDS = ('role', 'content', 'id', 'timestamp', 'features')
+
+# Cached features are never modified once computed, and short messages often have
+# equal ones, so equal features (or their topic parts) share one object
+_shared_features: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+_shared_topics: Dict[Tuple[Tuple[str, int], ...], Dict[str, int]] = {}
+_shared_topic: Dict[Tuple[str, float], List[Any]] = {}
+
+def snowflake_time(message_id: int) -> float:
+    """Unix time a Discord message was sent, from its ID"""
+    return ((message_id >> 22) + DISCORD_EPOCH) / 1000
+
+def _share_features(features: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """An equal shared copy of cached features, or the features with shared topic parts"""
+    if features is None:
+        return None
+
+    topics = features.get('topics')
+    if topics is not None:
+        features['topics'] = _shared_topics.setdefault(tuple(topics.items()), topics)
+    topic = features.get('topic')
+    if topic is not None:
+        features['topic'] = _shared_topic.setdefault(tuple(topic), topic)
+
+    # Features with a stripped copy of the content are as unique as the content
+    if 'stripped' in features or not isinstance(topics, dict) or not isinstance(topic, list):
+        return features
+    key = (features.get('v'), features.get('counter'), features.get('tokens'), id(features['topics']), id(features['topic']), len(features))
+    return _shared_features.setdefault(key, features)
+
+class Role(str, Enum):
+    SYSTEM = 'system'
+    USER = 'user'
+    ASSISTANT = 'assistant'
+
+class Message:
+    """A history message, readable and writable like the dict it replaces"""
+
+    __slots__ = ('role', 'channel', 'author', 'text', 'id', 'timestamp', 'features', 'extra')
+
+    def __init__(self,
+                 role: Role,
+                 text: str,
+                 channel: Optional[str] = None,
+                 author: Optional[str] = None,
+                 id: Optional[int] = None,
+                 timestamp: Optional[float] = None,
+                 features: Optional[Dict[str, Any]] = None,
+                 extra: Optional[Dict[str, Any]] = None):
+        """
+        Initialize the message
+
+        Args:
+            role: Who sent the message
+            text: The message without its prefix
+            channel: Bracketed part of the prefix, like '#general' for users, 'general' for the bot or 'DM'.
+                     None for a message without a prefix.
+            author: Name in the prefix
+            id: Discord message ID
+            timestamp: Unix time the message was sent, taken from the ID or the current time if not given
+            features: Cached derived features, see context_manager.annotate_message
+            extra: Any other keys, like 'summary'
+        """
+        self.role = Role(role)
+        self.text = text
+        self.channel = sys.intern(channel) if channel is not None else None
+        self.author = sys.intern(author) if author is not None else None
+        self.id = id
+        if timestamp is None:
+            timestamp = snowflake_time(id) if isinstance(id, int) else time.time()
+        self.timestamp = timestamp
+        self.features = _share_features(features)
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, msg: Dict[str, Any]) -> 'Message':
+        """
+        Create a record from a history message dict, records are returned as they are
+
+        Args:
+            msg: The message, with at least 'role' and 'content'
+
+        Returns:
+            The record
+        """
+        if isinstance(msg, Message):
+            return msg
+
+        content = msg.get('content', '')
+        channel = author = None
+        match = _PREFIX_RE.match(content)
+        if match:
+            channel, author = match.group(1), match.group(2)
+            content = content[match.end():]
+
+        extra = {key: value for key, value in msg.items() if key not in _FIELDS}
+        return cls(msg['role'], content, channel, author, msg.get('id'), msg.get('timestamp'), msg.get('features'), extra)
+
+    @property
+    def content(self) -> str:
+        """The text with its '[#channel] author: ' prefix, rendered on every read"""
+        if self.channel is None:
+            return self.text
+        return f'[{self.channel}] {self.author}: {self.text}'
+
+    @content.setter
+    def content(self, content: str) -> None:
+        parsed = Message.from_dict({'role': self.role, 'content': content})
+        self.channel, self.author, self.text = parsed.channel, parsed.author, parsed.text
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The message as a plain dict, like it is stored"""
+        msg = {'role': self.role._value_, 'content': self.content}
+        if self.id is not None:
+            msg['id'] = self.id
+        msg['timestamp'] = self.timestamp
+        if self.features is not None:
+            msg['features'] = self.features
+        if self.extra:
+            msg.update(self.extra)
+        return msg
+
+    # Dict compatibility
+
+    def keys(self) -> Iterator[str]:
+        yield 'role'
+        yield 'content'
+        if self.id is not None:
+            yield 'id'
+        yield 'timestamp'
+        if self.features is not None:
+            yield 'features'
+        if self.extra:
+            yield from self.extra
+
+    __iter__ = keys
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return iter(self.to_dict().items())
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'role':
+            return self.role._value_
+        if key == 'content':
+            return self.content
+        if key in ('id', 'timestamp', 'features'):
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        # Prompt building reads these for every message, so they skip __getitem__
+        if key == 'content':
+            return self.content
+        if key == 'role':
+            return self.role._value_
+        if key == 'features':
+            return self.features if self.features is not None else default
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: object) -> bool:
+        if key in ('role', 'content', 'timestamp'):
+            return True
+        if key in ('id', 'features'):
+            return getattr(self, key) is not None
+        return bool(self.extra) and key in self.extra
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key == 'role':
+            self.role = Role(value)
+        elif key == 'content':
+            self.content = value
+        elif key == 'features':
+            self.features = _share_features(value)
+        elif key in ('id', 'timestamp'):
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.keys())
+
+    def __repr__(self) -> str:
+        return f'Message({self.to_dict()!r})'
+
+def json_default(obj: Any) -> Dict[str, Any]:
+    """Serialize records with json.dump(..., default=json_default)"""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -0,0 +1,300 @@
+"""
+Stand-in Ollama server for load testing
+Serves /api/chat, /api/generate and /api/embed with deterministic responses
+streamed at a configurable token rate after a configurable first-token delay,
+optionally wrapped in a <think> block, and can inject errors. Only the standard
+library is used, so it runs anywhere the bot does.
+
+Usage: python mock_ollama.py [--port 11435] [--token-rate 40] [--first-token-delay 0.3] [--think-tokens 20] [--error-rate 0.0]
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+
+WORDS = [
+    'the', 'a', 'you', 'can', 'to', 'in', 'it', 'and', 'of', 'is', 'minecraft', 'server', 'discord',
+    'achievement', 'points', 'spells', 'apply', 'form', 'build', 'craft', 'night', 'first', 'survive',
+    'role', 'channel', 'help', 'try', 'should', 'with', 'your', 'get', 'that', 'for', 'on', 'this'
+]
+
+class MockOllama:
+    """Asyncio HTTP server speaking enough of the Ollama API for the bot"""
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 11435,
+                 token_rate: float = 40.0,
+                 first_token_delay: float = 0.3,
+                 prompt_rate: float = 0.0,
+                 think_tokens: int = 20,
+                 response_tokens: int = 60,
+                 error_rate: float = 0.0,
+                 stream_error_rate: float = 0.0,
+                 parallel: int = 1,
+                 seed: int = 0):
+        """
+        Initialize the server
+
+        Args:
+            host: Address to listen on
+            port: Port to listen on, 0 picks a free port
+            token_rate: Tokens streamed per second, 0 for no delay between tokens
+            first_token_delay: Seconds before the first token, like prompt evaluation
+            prompt_rate: Prompt tokens evaluated per second on top of the first token delay, 0 to ignore prompt length
+            think_tokens: Tokens inside the <think> block, 0 for no thinking
+            response_tokens: Tokens of the answer after the thinking block
+            error_rate: Fraction of requests answered with HTTP 500
+            stream_error_rate: Fraction of streams failing halfway through
+            parallel: Requests generated at the same time, like OLLAMA_NUM_PARALLEL
+            seed: Seed of the generated tokens and injected errors
+        """
+        self.host = host
+        self.port = port
+        self.token_rate = token_rate
+        self.first_token_delay = first_token_delay
+        self.prompt_rate = prompt_rate
+        self.think_tokens = think_tokens
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.seed = seed
+
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'stream_errors': 0,
+            'tokens': 0,
+            'active': 0,
+            'max_active': 0
+        }
+
+        self._slots = asyncio.Semaphore(max(1, parallel))
+        self._errors = random.Random(seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self) -> None:
+        """Start listening, the port is known afterwards even if 0 was given"""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def tokens_for(self, prompt: str, max_tokens: Optional[int] = None) -> List[str]:
+        """
+        The tokens of the response to a prompt, the same prompt always gets the same response
+
+        Args:
+            prompt: The last message of the request
+            max_tokens: Maximum number of tokens, like num_predict
+
+        Returns:
+            The tokens, including the thinking block
+        """
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')) ^ self.seed)
+        tokens = []
+        if self.think_tokens:
+            tokens += ['<think>', '\n']
+            tokens += [' ' + rng.choice(WORDS) for _ in range(self.think_tokens)]
+            tokens += ['\n', '</think>', '\n\n']
+        tokens += [(' ' if i else '') + rng.choice(WORDS) for i in range(self.response_tokens)]
+        tokens[-1] += '.'
+
+        if max_tokens is not None and max_tokens >= 0:
+            tokens = tokens[:max_tokens]
+        return tokens
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, Any]]:
+        """Read a request, returning its method, path and JSON body"""
+        head = await reader.readuntil(b'\r\n\r\n')
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, path, _ = request_line.split(' ', 2)
+
+        length = 0
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+
+        body = await reader.readexactly(length) if length else b''
+        return method, path, json.loads(body) if body else {}
+
+    @staticmethod
+    def _send_json(writer: asyncio.StreamWriter, data: Dict[str, Any], status: str = '200 OK') -> None:
+        body = json.dumps(data).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+
+    @staticmethod
+    def _send_chunk(writer: asyncio.StreamWriter, data: Dict[str, Any]) -> None:
+        line = json.dumps(data).encode() + b'\n'
+        writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await self._read_request(reader)
+
+            if method == 'GET' and path in ('/', '/api/version'):
+                self._send_json(writer, {'version': '0.0.0-mock'})
+            elif method == 'GET' and path in ('/api/tags', '/api/ps'):
+                self._send_json(writer, {'models': []})
+            elif method == 'POST' and path == '/api/embed':
+                self._embed(writer, body)
+            elif method == 'POST' and path in ('/api/chat', '/api/generate'):
+                await self._generate(writer, body, chat=path == '/api/chat')
+            else:
+                self._send_json(writer, {'error': f'{method} {path} not found'}, '404 Not Found')
+
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _embed(self, writer: asyncio.StreamWriter, body: Dict[str, Any]) -> None:
+        """Deterministic 64-dimensional embeddings"""
+        texts = body.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+
+        embeddings = []
+        for text in texts:
+            rng = random.Random(zlib.crc32(text.encode('utf-8')))
+            embeddings.append([rng.uniform(-1, 1) for _ in range(64)])
+        self._send_json(writer, {'model': body.get('model', ''), 'embeddings': embeddings})
+
+    async def _generate(self, writer: asyncio.StreamWriter, body: Dict[str, Any], chat: bool) -> None:
+        """Answer a chat or generate request, streaming unless stream is false"""
+        self.stats['requests'] += 1
+        model = body.get('model', '')
+        stream = body.get('stream', True)
+
+        if chat:
+            messages = body.get('messages') or []
+            prompt = messages[-1].get('content', '') if messages else ''
+            prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4
+        else:
+            prompt = body.get('prompt', '')
+            prompt_tokens = len(prompt) // 4
+
+        def chunk(content: str, **extra) -> Dict[str, Any]:
+            data = {'model': model, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+            if chat:
+                data['message'] = {'role': 'assistant', 'content': content}
+            else:
+                data['response'] = content
+            data['done'] = False
+            data.update(extra)
+            return data
+
+        # Without a prompt Ollama only loads the model
+        if not prompt:
+            self._send_json(writer, chunk('', done=True, done_reason='load'))
+            return
+
+        if self._errors.random() < self.error_rate:
+            self.stats['errors'] += 1
+            self._send_json(writer, {'error': 'mock error'}, '500 Internal Server Error')
+            return
+        fail_at = None
+        if self._errors.random() < self.stream_error_rate:
+            fail_at = self._errors.randint(1, max(1, self.think_tokens + self.response_tokens - 1))
+
+        tokens = self.tokens_for(prompt, (body.get('options') or {}).get('num_predict'))
+
+        async with self._slots:
+            self.stats['active'] += 1
+            self.stats['max_active'] = max(self.stats['max_active'], self.stats['active'])
+            try:
+                started = time.perf_counter()
+                prompt_delay = self.first_token_delay + (prompt_tokens / self.prompt_rate if self.prompt_rate else 0)
+                await asyncio.sleep(prompt_delay)
+
+                if stream:
+                    writer.write(
+                        b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                        b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+                    )
+
+                eval_started = time.perf_counter()
+                for i, token in enumerate(tokens):
+                    if i == fail_at:
+                        self.stats['stream_errors'] += 1
+                        if stream:
+                            self._send_chunk(writer, {'error': 'mock stream error'})
+                            writer.write(b'0\r\n\r\n')
+                        else:
+                            self._send_json(writer, {'error': 'mock error'}, '500 Internal Server Error')
+                        return
+
+                    if self.token_rate:
+                        # Paced against the start, so slow writes don't slow the whole stream down
+                        await asyncio.sleep(max(0.0, eval_started + i / self.token_rate - time.perf_counter()))
+                    if stream:
+                        self._send_chunk(writer, chunk(token))
+                        await writer.drain()
+                    self.stats['tokens'] += 1
+
+                finished = time.perf_counter()
+                final = chunk(
+                    '' if stream else ''.join(tokens),
+                    done=True,
+                    done_reason='stop',
+                    total_duration=int((finished - started) * 1e9),
+                    load_duration=0,
+                    prompt_eval_count=prompt_tokens,
+                    prompt_eval_duration=int(prompt_delay * 1e9),
+                    eval_count=len(tokens),
+                    eval_duration=int((finished - eval_started) * 1e9)
+                )
+                if stream:
+                    self._send_chunk(writer, final)
+                    writer.write(b'0\r\n\r\n')
+                else:
+                    self._send_json(writer, final)
+            finally:
+                self.stats['active'] -= 1
+
+async def serve(server: MockOllama) -> None:
+    await server.start()
+    print(f'Mock Ollama listening on {server.url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=11435, help='Port to listen on')
+    parser.add_argument('--token-rate', type=float, default=40.0, help='Tokens per second, 0 for no delay')
+    parser.add_argument('--first-token-delay', type=float, default=0.3, help='Seconds before the first token')
+    parser.add_argument('--prompt-rate', type=float, default=0.0, help='Prompt tokens evaluated per second, 0 to ignore prompt length')
+    parser.add_argument('--think-tokens', type=int, default=20, help='Tokens in the <think> block, 0 for none')
+    parser.add_argument('--response-tokens', type=int, default=60, help='Tokens of the answer')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500')
+    parser.add_argument('--stream-error-rate', type=float, default=0.0, help='Fraction of streams failing halfway')
+    parser.add_argument('--parallel', type=int, default=1, help='Requests generated at the same time')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated tokens and errors')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(MockOllama(**vars(args))))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Pool of Ollama backends
+Dispatches chat requests to the least-loaded healthy Ollama host, and fails
+over to another host when one can't be reached
+"""
+
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import time
+
+import httpx
+import ollama
+
+from log_writer import log, WARNING
+
+# Errors that mean the host itself is unusable, as opposed to a bad request
+CONNECTION_ERRORS = (ConnectionError, httpx.TransportError)
+
+class NoBackendAvailable(ConnectionError):
+    """Raised when no healthy backend could serve a request"""
+
+class PooledStream:
+    """
+    A chat stream holding a slot of its backend until it is exhausted or closed
+
+    Iterate it like the stream of ollama.AsyncClient.chat. A stream that isn't read
+    to the end has to be closed with aclose(), or used with async with, to free its slot.
+    """
+
+    def __init__(self, pool: 'OllamaPool', backend: 'OllamaBackend', stream: AsyncIterator[Any], first: Any):
+        self.pool = pool
+        self.backend = backend
+        self._stream = stream
+        self._first = first
+        self._closed = False
+
+    def __aiter__(self) -> 'PooledStream':
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._closed:
+            raise StopAsyncIteration
+
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            # Exhausted or failed, either way the slot is free again
+            await self.aclose()
+            raise
+
+    async def aclose(self) -> None:
+        """Stop the stream and free its slot, safe to call more than once"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            aclose = getattr(self._stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            await self.pool._release(self.backend)
+
+    async def __aenter__(self) -> 'PooledStream':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+class OllamaBackend:
+    """A single Ollama host with its own concurrency limit"""
+
+    def __init__(self, host: str, max_concurrency: int = 1, client: Optional[ollama.AsyncClient] = None):
+        """
+        Initialize the backend
+
+        Args:
+            host: URL of the Ollama server
+            max_concurrency: Number of parallel requests the host is configured for
+            client: Optional preconfigured client for the host
+        """
+        self.host = host
+        self.max_concurrency = max(1, max_concurrency)
+        self.client = client or ollama.AsyncClient(host=host)
+
+        self.active = 0
+        self.healthy = True
+        self.failures = 0
+        self.unhealthy_since = 0.0
+
+    @property
+    def load(self) -> float:
+        """Fraction of the host's slots in use"""
+        return self.active / self.max_concurrency
+
+    def mark_unhealthy(self) -> None:
+        self.healthy = False
+        self.failures += 1
+        self.unhealthy_since = time.monotonic()
+
+    def mark_healthy(self) -> None:
+        self.healthy = True
+        self.failures = 0
+
+    def __repr__(self) -> str:
+        state = 'healthy' if self.healthy else 'unhealthy'
+        return f'<OllamaBackend {self.host} {self.active}/{self.max_concurrency} {state}>'
+
+class OllamaPool:
+    """Load-balancing client over several Ollama backends"""
+
+    def __init__(self, backends: List[OllamaBackend], retry_after: float = 30.0, health_interval: float = 30.0):
+        """
+        Initialize the pool
+
+        Args:
+            backends: The Ollama hosts to dispatch to
+            retry_after: Seconds before an unhealthy host is tried again
+            health_interval: Seconds between health checks of run_health_checks
+        """
+        if not backends:
+            raise ValueError('OllamaPool needs at least one backend')
+
+        self.backends = backends
+        self.retry_after = retry_after
+        self.health_interval = health_interval
+        self._slot_freed = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls, hosts: List[Dict[str, Any]], **kwargs) -> 'OllamaPool':
+        """
+        Create a pool from a list of {'host': ..., 'max_concurrency': ...} entries
+
+        Args:
+            hosts: Host configuration entries
+
+        Returns:
+            The configured pool
+        """
+        return cls(
+            [OllamaBackend(entry['host'], entry.get('max_concurrency', 1)) for entry in hosts],
+            **kwargs
+        )
+
+    @property
+    def capacity(self) -> int:
+        """Total number of parallel requests the pool can serve"""
+        return sum(backend.max_concurrency for backend in self.backends)
+
+    def _candidates(self, exclude: List[OllamaBackend]) -> List[OllamaBackend]:
+        """Backends that may be tried, least loaded first, falling back to the least recently failed one"""
+        now = time.monotonic()
+        remaining = [backend for backend in self.backends if backend not in exclude]
+        candidates = [
+            backend for backend in remaining
+            if backend.healthy or now - backend.unhealthy_since >= self.retry_after
+        ]
+        if not candidates and remaining:
+            # Every host is cooling down, try the one that failed longest ago
+            # rather than failing outright (a single host would otherwise be
+            # unusable for retry_after seconds after one transient error)
+            return [min(remaining, key=lambda backend: backend.unhealthy_since)]
+
+        return sorted(candidates, key=lambda backend: (not backend.healthy, backend.load))
+
+    async def _acquire(self, exclude: List[OllamaBackend]) -> OllamaBackend:
+        """Wait for a free slot on the least-loaded usable backend"""
+        async with self._slot_freed:
+            while True:
+                candidates = self._candidates(exclude)
+                if not candidates:
+                    raise NoBackendAvailable('No healthy Ollama backend available')
+
+                for backend in candidates:
+                    if backend.active < backend.max_concurrency:
+                        backend.active += 1
+                        return backend
+
+                await self._slot_freed.wait()
+
+    async def _release(self, backend: OllamaBackend) -> None:
+        backend.active -= 1
+        async with self._slot_freed:
+            self._slot_freed.notify()
+
+    async def chat(self, model: str = '', messages=None, *, stream: bool = False, **kwargs):
+        """
+        Same interface as ollama.AsyncClient.chat, dispatched to the pool
+
+        Streams are only failed over before their first chunk, after that
+        the request is bound to the backend that started answering it.
+        A stream is returned as a PooledStream.
+        """
+        if stream:
+            return await self._chat_stream(model, messages, **kwargs)
+
+        return await self._call('chat', model, messages, stream=False, **kwargs)
+
+    async def embed(self, model: str = '', input='', **kwargs):
+        """Same interface as ollama.AsyncClient.embed, dispatched to the pool"""
+        return await self._call('embed', model, input, **kwargs)
+
+    async def _call(self, method: str, *args, **kwargs):
+        """Call a non-streaming client method, failing over to another backend on connection errors"""
+        tried = []
+        while True:
+            backend = await self._acquire(tried)
+            try:
+                response = await getattr(backend.client, method)(*args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                log(f'[POOL] {backend.host} failed: {e}', level=WARNING)
+                backend.mark_unhealthy()
+                tried.append(backend)
+                continue
+            finally:
+                await self._release(backend)
+
+            backend.mark_healthy()
+            return response
+
+    async def _chat_stream(self, model: str, messages, **kwargs) -> PooledStream:
+        """Start streaming a chat response, retrying on another backend until the first chunk arrives"""
+        tried = []
+        while True:
+            backend = await self._acquire(tried)
+            try:
+                stream = await backend.client.chat(model, messages, stream=True, **kwargs)
+                # The request is only sent once the stream is iterated
+                try:
+                    first = await stream.__anext__()
+                except StopAsyncIteration:
+                    first = None
+            except CONNECTION_ERRORS as e:
+                log(f'[POOL] {backend.host} failed: {e}', level=WARNING)
+                backend.mark_unhealthy()
+                tried.append(backend)
+                await self._release(backend)
+                continue
+            except BaseException:
+                await self._release(backend)
+                raise
+
+            backend.mark_healthy()
+            pooled = PooledStream(self, backend, stream, first)
+            if first is None:
+                await pooled.aclose()
+            return pooled
+
+    async def check_health(self) -> Dict[str, bool]:
+        """
+        Probe every backend and update its health
+
+        Returns:
+            Dictionary mapping each host to whether it responded
+        """
+        async def probe(backend: OllamaBackend) -> bool:
+            try:
+                await backend.client.ps()
+            except CONNECTION_ERRORS:
+                backend.mark_unhealthy()
+                return False
+            except ollama.ResponseError:
+                pass  # The host answered, that's all a probe needs
+            backend.mark_healthy()
+            return True
+
+        results = await asyncio.gather(*(probe(backend) for backend in self.backends))
+        return {backend.host: result for backend, result in zip(self.backends, results)}
+
+    async def run_health_checks(self) -> None:
+        """Check every backend's health every health_interval seconds, logging hosts going down or coming back"""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            before = {backend.host: backend.healthy for backend in self.backends}
+            for host, healthy in (await self.check_health()).items():
+                if healthy != before[host]:
+                    log(f"[POOL] {host} is {'back up' if healthy else 'unreachable'}", level=WARNING)
@@ -0,0 +1,241 @@
+"""
+Offline benchmark of the per-request context pipeline
+Times context assembly, topic detection, relevance scoring, thinking removal,
+mention normalization and history persistence over synthetic histories,
+without Discord or Ollama. Results are saved as JSON so they can be compared
+between commits. History messages are Message records like in the bot, or plain
+dicts with --representation dict to compare with results from older commits.
+
+Usage: python pipeline_benchmark.py [--sizes 1000,10000,100000] [--min-time S] [--representation record|dict] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Sequence
+
+from context_manager import ContextManager, annotate_message
+from context_optimization import remove_thinking_parts
+from history_store import HistoryJournal
+from message_record import Message
+from scraper import normalize_mentions
+from topic_detection import TOPICS, detect_message_topic, score_message_relevance
+
+CHANNELS = ['general', 'minecraft-chat', 'announcements', 'updates', 'help', 'funni-channel', 'trailer']
+AUTHORS = ['omena0', 'char123yt', 'steve', 'alex', 'notch', 'herobrine', 'builder42', 'redstoner']
+FILLER = ['the', 'a', 'is', 'it', 'lol', 'idk', 'how', 'do', 'i', 'get', 'to', 'what', 'why', 'when', 'ok', 'yes', 'no']
+
+def sample_texts() -> List[str]:
+    """Message texts from message_history.json, used as a source of realistic wording"""
+    try:
+        with open('message_history.json', 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+    texts = []
+    for msg in data.get('public', []):
+        content = msg.get('content', '')
+        if msg.get('role') == 'user' and ': ' in content:
+            texts.append(content.split(': ', 1)[1])
+    return texts
+
+def make_history(size: int, seed: int = 0) -> Dict[str, Any]:
+    """
+    Generate a history with the shape of message_history.json
+
+    Args:
+        size: Number of public messages
+        seed: Random seed, the same seed gives the same history
+
+    Returns:
+        Dictionary with 'public' and 'private' histories
+    """
+    rng = random.Random(seed)
+    texts = sample_texts()
+    vocabulary = [kw for topic_info in TOPICS.values() for kw in topic_info['keywords']] + FILLER
+
+    def text() -> str:
+        if texts and rng.random() < 0.7:
+            return rng.choice(texts)
+        return ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 40)))
+
+    def answer() -> str:
+        thinking = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(50, 300)))
+        reply = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(20, 150)))
+        return f'<think>\n{thinking}\n</think>\n\n{reply}'
+
+    public = []
+    for i in range(size):
+        channel = rng.choice(CHANNELS)
+        # About one in a hundred messages is a bot answer, like the real history
+        if rng.random() < 0.01:
+            public.append({'role': 'assistant', 'content': f'[{channel}] ChatBot V2: {answer()}'})
+        else:
+            public.append({'role': 'user', 'content': f'[#{channel}] {rng.choice(AUTHORS)}: {text()}', 'id': 10**17 + i})
+
+    private = {}
+    for author in AUTHORS:
+        private[author] = [
+            {'role': 'user', 'content': f'[DM] {author}: {text()}'} if turn % 2 == 0
+            else {'role': 'assistant', 'content': f'[DM] ChatBot V2: {answer()}'}
+            for turn in range(rng.randint(4, 49))
+        ]
+
+    return {'public': public, 'private': private}
+
+def make_discord_message(content: str, rng: random.Random) -> SimpleNamespace:
+    """A stand-in for discord.Message with the attributes normalize_mentions reads"""
+    user = SimpleNamespace(id=rng.randrange(10**17, 10**18), display_name=rng.choice(AUTHORS))
+    channel = SimpleNamespace(id=rng.randrange(10**17, 10**18), name=rng.choice(CHANNELS))
+    role = SimpleNamespace(id=rng.randrange(10**17, 10**18), name='Member')
+    return SimpleNamespace(
+        content=f'<@{user.id}> {content} <#{channel.id}> <@&{role.id}>',
+        mentions=[user],
+        channel_mentions=[channel],
+        role_mentions=[role]
+    )
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def measure(func: Callable[[Any], object], inputs: Sequence[Any], min_time: float, max_ops: int) -> Dict[str, float]:
+    """
+    Time func over the inputs, cycling through them
+
+    Runs until max_ops calls were made, or at least min_time seconds passed
+    and every input was used once (at least three calls). Peak memory is
+    measured on a separate call since tracing allocations slows everything down.
+
+    Args:
+        func: Function to time, called with one input per operation
+        inputs: Inputs to call it with
+        min_time: Minimum seconds to keep measuring
+        max_ops: Maximum number of calls
+
+    Returns:
+        Dictionary with ops, ops_per_sec, p50_ms, p99_ms and peak_kib
+    """
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_ops:
+        before = time.perf_counter()
+        func(inputs[len(latencies) % len(inputs)])
+        latencies.append(time.perf_counter() - before)
+
+        if time.perf_counter() - started >= min_time and len(latencies) >= min(max(len(inputs), 3), max_ops):
+            break
+
+    tracemalloc.start()
+    func(inputs[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / sum(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_kib': peak / 1024
+    }
+
+def run_size(size: int, min_time: float, seed: int, representation: str = 'record') -> List[Dict[str, Any]]:
+    """Run every benchmark on a history of the given size, of Message records or plain dicts"""
+    data = make_history(size, seed)
+    convert = Message.from_dict if representation == 'record' else dict
+    public, private = [convert(msg) for msg in data['public']], data['private']
+    contents = [msg['content'] for msg in public]
+    rng = random.Random(seed)
+
+    results = []
+    def run(name: str, func: Callable[[Any], object], inputs: Sequence[Any], max_ops: int) -> None:
+        result = {'benchmark': name, 'size': size, 'representation': representation, **measure(func, inputs, min_time, max_ops)}
+        print(f"{name:<28} {size:>7}  {result['ops_per_sec']:>12.1f} ops/s  "
+              f"p50 {result['p50_ms']:>9.3f} ms  p99 {result['p99_ms']:>9.3f} ms  "
+              f"peak {result['peak_kib']:>10.1f} KiB")
+        results.append(result)
+
+    # Per-message work, done once per ingested message
+    per_message = min(size, 20_000)
+    run('annotate_message', annotate_message, public, per_message)
+    run('detect_message_topic', detect_message_topic, contents, per_message)
+    run('score_message_relevance', lambda content: score_message_relevance(content, 'minecraft'), contents, per_message)
+    run('remove_thinking_parts', remove_thinking_parts, contents, per_message)
+    messages = [make_discord_message(content, rng) for content in contents[:per_message]]
+    run('normalize_mentions', normalize_mentions, messages, per_message)
+
+    # Per-request work over the whole history, features are already cached like in the bot
+    for msg in public:
+        annotate_message(msg)
+
+    for mode in ('scored', 'stable'):
+        manager = ContextManager(max_tokens=100_000, assembly_mode=mode)
+        history = list(public)
+
+        def assemble(msg, manager=manager, history=history):
+            history.append(msg)
+            return manager.optimize_context(history, max_tokens=75_000, key='public')
+
+        prompts = [annotate_message(convert({'role': 'user', 'content': content})) for content in contents[:50]]
+        run(f'optimize_context[{mode}]', assemble, prompts, 50)
+
+    # Persistence of the whole history
+    with tempfile.TemporaryDirectory() as directory:
+        journal = HistoryJournal(
+            os.path.join(directory, 'message_history.json'),
+            os.path.join(directory, 'message_history.journal')
+        )
+        run('save_history', lambda _: journal.compact(public, private), [None], 20)
+        run('load_history', lambda _: journal.load(), [None], 20)
+        journal.close()
+
+    return results
+
+def git_commit() -> str:
+    """Short hash of the checked out commit, or 'unknown' outside a git repository"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated history sizes')
+    parser.add_argument('--min-time', type=float, default=1.0, help='Minimum seconds per measurement')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic histories')
+    parser.add_argument('--representation', choices=('record', 'dict'), default='record',
+                        help='In-memory form of history messages, records like the bot or plain dicts like older commits')
+    parser.add_argument('--output', default=None, help='JSON file to write, defaults to pipeline_benchmark_<commit>.json')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': []
+    }
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        report['results'].extend(run_size(size, args.min_time, args.seed, args.representation))
+
+    output = args.output or f'pipeline_benchmark_{commit}.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved results to {output}')
+
+if __name__ == '__main__':
+    main()
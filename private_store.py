@@ -0,0 +1,188 @@
+"""
+Private conversation storage
+Every user's private history is a fixed-size ring buffer in its own shard file,
+keyed by user ID. Shards are only loaded when the user DMs the bot, and are
+dropped from memory again after a while without messages or when too many are
+loaded, so memory scales with the users that are active.
+"""
+
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+from urllib.parse import quote
+import json
+import os
+import time
+
+from message_record import Message, json_default
+from log_writer import log
+
+class Conversation:
+    """A loaded private conversation"""
+
+    __slots__ = ('messages', 'lines', 'last_used')
+
+    def __init__(self, messages: Deque[Dict[str, Any]], lines: int):
+        self.messages = messages
+        self.lines = lines          # Lines in the shard file, it is rewritten once they pile up
+        self.last_used = time.monotonic()
+
+class PrivateHistoryStore:
+    """Ring buffers of private messages by user ID, in lazily loaded shard files"""
+
+    def __init__(self,
+                 directory: str = 'private_history',
+                 capacity: int = 49,
+                 max_loaded: int = 256,
+                 idle_timeout: float = 1800.0):
+        """
+        Initialize the store
+
+        Args:
+            directory: Directory of the shard files
+            capacity: Number of messages kept per conversation, older ones are dropped
+            max_loaded: Maximum number of conversations kept in memory
+            idle_timeout: Seconds without messages after which a conversation is unloaded
+        """
+        self.directory = directory
+        self.legacy_directory = os.path.join(directory, 'legacy')
+        self.capacity = capacity
+        self.max_loaded = max_loaded
+        self.idle_timeout = idle_timeout
+
+        self._loaded: 'OrderedDict[str, Conversation]' = OrderedDict()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, user_id: Any) -> str:
+        return os.path.join(self.directory, f'{user_id}.jsonl')
+
+    def _legacy_path(self, name: str) -> str:
+        return os.path.join(self.legacy_directory, f"{quote(name, safe='')}.jsonl")
+
+    def _read(self, path: str) -> Conversation:
+        """Load a shard, the ring buffer keeps only its newest messages"""
+        messages: Deque[Dict[str, Any]] = deque(maxlen=self.capacity)
+        lines = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        messages.append(Message.from_dict(json.loads(line)))
+                    except json.JSONDecodeError:
+                        # Torn write at the end of the file
+                        continue
+                    lines += 1
+        except FileNotFoundError:
+            pass
+        return Conversation(messages, lines)
+
+    def _write(self, path: str, messages) -> None:
+        """Atomically replace a shard with the given messages"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(msg, default=json_default) + '\n' for msg in messages)
+        os.replace(tmp_path, path)
+
+    def get(self, user_id: Any, name: Optional[str] = None) -> Deque[Dict[str, Any]]:
+        """
+        Get a user's conversation, loading it if needed
+
+        Args:
+            user_id: Discord ID of the user
+            name: Current user name, adopts a conversation stored under that name by older versions
+
+        Returns:
+            The messages of the conversation, oldest first
+        """
+        key = str(user_id)
+        conversation = self._loaded.get(key)
+        if conversation is None:
+            path = self._path(key)
+            if name is not None and not os.path.exists(path) and os.path.exists(self._legacy_path(name)):
+                os.replace(self._legacy_path(name), path)
+                log(f'[PRIVATE] Adopted the conversation of {name} for user {key}')
+
+            conversation = self._loaded[key] = self._read(path)
+            # Every message is already on disk, unloading only drops the memory
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+        self._loaded.move_to_end(key)
+        conversation.last_used = time.monotonic()
+        return conversation.messages
+
+    def append(self, user_id: Any, msg: Dict[str, Any], name: Optional[str] = None) -> None:
+        """
+        Add a message to a user's conversation and its shard
+
+        Args:
+            user_id: Discord ID of the user
+            msg: The message to add
+            name: Current user name, see get
+        """
+        messages = self.get(user_id, name)
+        messages.append(msg)
+
+        key = str(user_id)
+        conversation = self._loaded[key]
+        with open(self._path(key), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(msg, default=json_default) + '\n')
+        conversation.lines += 1
+
+        # Appends only grow the file, rewrite it with what the ring buffer still holds
+        if conversation.lines >= 2 * self.capacity:
+            self.rewrite(key)
+
+    def rewrite(self, user_id: Any) -> None:
+        """Write a loaded conversation's shard from memory, after it was changed in place"""
+        key = str(user_id)
+        conversation = self._loaded.get(key)
+        if conversation is None:
+            return
+
+        self._write(self._path(key), conversation.messages)
+        conversation.lines = len(conversation.messages)
+
+    def loaded(self) -> Dict[str, Deque[Dict[str, Any]]]:
+        """The conversations in memory by user ID"""
+        return {key: conversation.messages for key, conversation in self._loaded.items()}
+
+    def evict_idle(self) -> int:
+        """
+        Unload conversations without messages for idle_timeout seconds
+
+        Returns:
+            Number of conversations unloaded
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [key for key, conversation in self._loaded.items() if conversation.last_used < cutoff]
+        for key in idle:
+            del self._loaded[key]
+        return len(idle)
+
+    def count(self) -> int:
+        """Number of stored conversations, loaded or not"""
+        return sum(1 for entry in os.scandir(self.directory) if entry.name.endswith('.jsonl'))
+
+    def import_legacy(self, conversations: Dict[str, List[Dict[str, Any]]]) -> None:
+        """
+        Store conversations keyed by user name, as older versions did
+
+        A legacy conversation is adopted by the user with that name on their next DM.
+
+        Args:
+            conversations: Private histories by user name
+        """
+        os.makedirs(self.legacy_directory, exist_ok=True)
+        for name, messages in conversations.items():
+            self._write(self._legacy_path(name), messages[-self.capacity:])
+
+    def clear(self) -> None:
+        """Delete every conversation, including legacy ones"""
+        self._loaded.clear()
+        for directory in (self.directory, self.legacy_directory):
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.jsonl'):
+                    os.remove(entry.path)
@@ -0,0 +1,185 @@
+"""
+Fair request queue in front of the model
+Jobs are scheduled round-robin between users so one user can't monopolize the
+model, with a configurable number of jobs running at the same time
+"""
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+import asyncio
+
+class Job:
+    """A queued request, awaitable for its result"""
+
+    def __init__(self, user_id: Any, run: Callable[[], Awaitable[Any]]):
+        """
+        Initialize the job
+
+        Args:
+            user_id: The user the job is scheduled for
+            run: Coroutine function that performs the request
+        """
+        self.user_id = user_id
+        self.run = run
+        self.started = False
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def __await__(self):
+        return self.future.__await__()
+
+class RequestQueue:
+    """Round-robin job queue with a concurrency limit"""
+
+    def __init__(self,
+                 max_concurrency: int = 1,
+                 max_pending_per_user: int = 3,
+                 on_busy_change: Optional[Callable[[bool], Awaitable[None]]] = None):
+        """
+        Initialize the request queue
+
+        Args:
+            max_concurrency: Maximum number of jobs running at the same time
+            max_pending_per_user: Maximum number of waiting jobs per user
+            on_busy_change: Coroutine function called with True when the queue starts
+                            working and with False when it becomes idle
+        """
+        self._max_concurrency = max(1, max_concurrency)
+        self.max_pending_per_user = max_pending_per_user
+        self.on_busy_change = on_busy_change
+
+        self._queues: Dict[Any, Deque[Job]] = {}
+        self._order: Deque[Any] = deque()  # Users with waiting jobs, next to be served first
+        self._tasks = set()
+        self._busy = False
+        self.active = 0
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value: int) -> None:
+        self._max_concurrency = max(1, value)
+        self._dispatch()
+
+    @property
+    def pending(self) -> int:
+        """Number of jobs waiting to start"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def idle(self) -> bool:
+        """Whether no jobs are running or waiting"""
+        return self.active == 0 and not self._order
+
+    def submit(self, user_id: Any, run: Callable[[], Awaitable[Any]]) -> Job:
+        """
+        Queue a request
+
+        Args:
+            user_id: The user the request is for
+            run: Coroutine function that performs the request
+
+        Returns:
+            The queued job
+
+        Raises:
+            asyncio.QueueFull: If the user already has too many waiting jobs
+        """
+        queue = self._queues.get(user_id)
+        if queue is not None and len(queue) >= self.max_pending_per_user:
+            raise asyncio.QueueFull()
+
+        job = Job(user_id, run)
+
+        if queue is None:
+            self._queues[user_id] = queue = deque()
+            self._order.append(user_id)
+        queue.append(job)
+
+        self._dispatch()
+        return job
+
+    def position(self, job: Job) -> int:
+        """
+        Get the position of a job in the queue
+
+        Args:
+            job: The job to look up
+
+        Returns:
+            0 if the job has started (or finished), otherwise its 1-based position
+        """
+        if job.started or job not in self._queues.get(job.user_id, ()):
+            return 0
+
+        # Replay the round-robin order: first jobs of every user, then second jobs, ...
+        position = 0
+        depth = 0
+        while True:
+            for user_id in self._order:
+                queue = self._queues[user_id]
+                if depth < len(queue):
+                    position += 1
+                    if queue[depth] is job:
+                        return position
+            depth += 1
+
+    def _next_job(self) -> Job:
+        """Take the next job in round-robin order"""
+        user_id = self._order.popleft()
+        queue = self._queues[user_id]
+        job = queue.popleft()
+
+        if queue:
+            # The user still has waiting jobs, they go to the back of the line
+            self._order.append(user_id)
+        else:
+            del self._queues[user_id]
+
+        return job
+
+    def _dispatch(self) -> None:
+        """Start waiting jobs while there are free slots"""
+        while self._order and self.active < self._max_concurrency:
+            job = self._next_job()
+            job.started = True
+            self.active += 1
+            self._set_busy(True)
+
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: Job) -> None:
+        """Run a job and start the next one when it finishes"""
+        try:
+            result = await job.run()
+        except Exception as e:
+            # Reporting the error is up to the job, the queue only passes it on
+            if not job.future.done():
+                job.future.set_exception(e)
+                # Nobody may be waiting for the result, don't warn about it
+                job.future.exception()
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.active -= 1
+            self._dispatch()
+
+            if self.idle:
+                self._set_busy(False)
+
+    def _set_busy(self, busy: bool) -> None:
+        """Call the busy state callback in the background when the state changes"""
+        if busy == self._busy:
+            return
+
+        self._busy = busy
+        if self.on_busy_change is None:
+            return
+
+        task = asyncio.create_task(self.on_busy_change(busy))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,180 @@
+"""
+Response cache for repeated questions
+Caches model responses by channel, normalized prompt and topic, with LRU
+eviction, a time-to-live, and invalidation when the system prompt or model
+settings change. Prompts about the speaker are also keyed by author, and
+prompts about the conversation so far are not cached.
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+import hashlib
+import json
+import re
+import time
+
+from topic_detection import detect_message_topic
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Words of a normalized prompt that make the answer depend on who asks
+SPEAKER_WORDS = frozenset({'i', 'me', 'my', 'mine', 'myself', 'im', 'ive', 'id'})
+
+# Words of a normalized prompt that make the answer depend on the conversation so far
+CONVERSATION_WORDS = frozenset({'above', 'earlier', 'previous', 'previously', 'just', 'said', 'ago', 'before'})
+
+def normalize_prompt(prompt: str, ignore: Iterable[str] = ()) -> str:
+    """
+    Normalize a prompt for exact matching
+
+    Args:
+        prompt: The prompt to normalize
+        ignore: Substrings to remove first, such as the bot's own mention
+
+    Returns:
+        Lowercased prompt without punctuation and with collapsed whitespace
+    """
+    for text in ignore:
+        prompt = prompt.replace(text, ' ')
+
+    prompt = _PUNCTUATION_RE.sub(' ', prompt.lower())
+    return _WHITESPACE_RE.sub(' ', prompt).strip()
+
+class ResponseCache:
+    """LRU cache of model responses keyed by topic, channel and normalized prompt"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0):
+        """
+        Initialize the response cache
+
+        Args:
+            max_entries: Maximum number of cached responses
+            ttl: Seconds a cached response stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries: OrderedDict[Tuple[Any, ...], Tuple[float, str]] = OrderedDict()
+        self._fingerprint: Optional[str] = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def make_key(self,
+                 prompt: str,
+                 ignore: Iterable[str] = (),
+                 channel: Optional[str] = None,
+                 author: Any = None) -> Optional[Tuple[Any, ...]]:
+        """
+        Build the cache key for a prompt
+
+        Answers are built from the channel's history, so the channel is always
+        part of the key. The author is only added for prompts about the speaker.
+
+        Args:
+            prompt: The user's prompt
+            ignore: Substrings to leave out of the key
+            channel: Channel the prompt was sent in
+            author: ID of the user that sent it
+
+        Returns:
+            Tuple of (topic, channel, author, normalized prompt) with author None for
+            prompts not about the speaker, or None if the prompt is empty or refers
+            to the conversation so far
+        """
+        normalized = normalize_prompt(prompt, ignore)
+        if not normalized:
+            return None
+
+        words = set(normalized.split())
+        if words & CONVERSATION_WORDS:
+            return None
+
+        topic, _ = detect_message_topic(normalized)
+        return topic, channel, author if words & SPEAKER_WORDS else None, normalized
+
+    def validate(self, *settings: Any) -> None:
+        """
+        Clear the cache if the settings responses depend on have changed
+
+        Args:
+            settings: Everything that influences responses, e.g. model, system prompt and parameters
+        """
+        fingerprint = hashlib.sha1(
+            json.dumps(settings, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+        if fingerprint != self._fingerprint:
+            if self._fingerprint is not None and self._entries:
+                self.clear()
+            self._fingerprint = fingerprint
+
+    def clear(self) -> None:
+        """Drop every cached response"""
+        self._entries.clear()
+        self.stats['invalidations'] += 1
+
+    def get(self, key: Optional[Tuple[Any, ...]]) -> Optional[str]:
+        """
+        Look up a cached response
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            The cached response, or None on a miss
+        """
+        entry = self._entries.get(key) if key else None
+
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            self.stats['expirations'] += 1
+            entry = None
+
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[1]
+
+    def put(self, key: Optional[Tuple[Any, ...]], response: str) -> None:
+        """
+        Cache a response
+
+        Args:
+            key: Key from make_key
+            response: The model's full response
+        """
+        if not key or not response:
+            return
+
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics
+
+        Returns:
+            Dictionary with hit/miss counters, entry count and hit rate
+        """
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['entries'] = len(self._entries)
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+        return stats
@@ -0,0 +1,225 @@
+"""
+Embedding-based retrieval over message history
+Messages are embedded when they are ingested and kept in a NumPy matrix, so the
+messages most similar to a prompt can be found with one vectorized search
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+import asyncio
+import hashlib
+import re
+
+import numpy as np
+
+from context_manager import get_message_features
+from log_writer import log, WARNING
+
+_WORD_RE = re.compile(r'\w+')
+
+class HashingEmbedder:
+    """Local embedder using feature hashing of words and word pairs, needs no model"""
+
+    def __init__(self, dim: int = 512):
+        """
+        Initialize the embedder
+
+        Args:
+            dim: Number of dimensions of the embeddings
+        """
+        self.dim = dim
+
+    def _bucket(self, feature: str) -> int:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % self.dim
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed a batch of texts in a worker thread, so indexing a long history doesn't block the event loop
+
+        Args:
+            texts: The texts to embed
+
+        Returns:
+            Array of shape (len(texts), dim)
+        """
+        return await asyncio.to_thread(self._embed, list(texts))
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORD_RE.findall(text.lower())
+            for word in words:
+                vectors[row, self._bucket(word)] += 1.0
+            for pair in zip(words, words[1:]):
+                vectors[row, self._bucket(' '.join(pair))] += 0.5
+        return vectors
+
+class OllamaEmbedder:
+    """Embedder using an Ollama embedding model"""
+
+    def __init__(self, client, model: str = 'nomic-embed-text'):
+        """
+        Initialize the embedder
+
+        Args:
+            client: Ollama AsyncClient or OllamaPool instance
+            model: Name of the embedding model
+        """
+        self.client = client
+        self.model = model
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed a batch of texts
+
+        Args:
+            texts: The texts to embed
+
+        Returns:
+            Array of shape (len(texts), dim)
+        """
+        response = await self.client.embed(model=self.model, input=list(texts))
+        return np.asarray(response['embeddings'], dtype=np.float32)
+
+class EmbeddingIndex:
+    """
+    Incrementally growing matrix of normalized message embeddings
+
+    The index keeps its own references to the messages, so messages pruned from
+    the history can still be retrieved until the index is full.
+    """
+
+    def __init__(self, embedder, batch_size: int = 64, max_records: int = 100_000):
+        """
+        Initialize the index
+
+        Args:
+            embedder: Object with an async embed(texts) method returning a 2D array
+            batch_size: Number of messages embedded per call
+            max_records: Number of embedded messages kept, the oldest are dropped first
+        """
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.max_records = max_records
+
+        self._vectors: Optional[np.ndarray] = None  # Rows beyond self._count are spare capacity
+        self._count = 0
+        self._records: List[Dict[str, Any]] = []
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_task: Optional[asyncio.Task] = None  # Shared by every flush and search
+
+    def __len__(self) -> int:
+        return self._count + len(self._pending)
+
+    @staticmethod
+    def _text(record: Dict[str, Any]) -> str:
+        """The text that represents a message in the index"""
+        features = get_message_features(record)
+        return features.get('stripped', record.get('content', ''))
+
+    def add(self, record: Dict[str, Any]) -> None:
+        """
+        Queue a message for embedding, it is embedded once a flush or search starts the background flush
+
+        Args:
+            record: History message to index
+        """
+        if record.get('content'):
+            self._pending.append(record)
+
+    def _append(self, vectors: np.ndarray) -> None:
+        """Append normalized rows, growing the matrix geometrically"""
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        needed = self._count + len(vectors)
+        if self._vectors is None:
+            self._vectors = np.empty((max(needed, 1024), vectors.shape[1]), dtype=np.float32)
+        elif needed > len(self._vectors):
+            grown = np.empty((max(needed, len(self._vectors) * 2), self._vectors.shape[1]), dtype=np.float32)
+            grown[:self._count] = self._vectors[:self._count]
+            self._vectors = grown
+
+        self._vectors[self._count:needed] = vectors
+        self._count = needed
+
+    def _start_flush(self) -> asyncio.Task:
+        """The running background flush, started if there is none"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._embed_pending())
+            self._flush_task.add_done_callback(self._flush_done)
+        return self._flush_task
+
+    @staticmethod
+    def _flush_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log(f"[RETRIEVAL] Embedding failed: {type(task.exception()).__name__}: {task.exception()}", level=WARNING)
+
+    async def flush(self) -> None:
+        """Embed every queued message, sharing the background flush instead of starting another"""
+        while self._pending:
+            await asyncio.shield(self._start_flush())
+
+    async def _embed_pending(self) -> None:
+        """Embed queued messages batch by batch until none are left"""
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            vectors = await self.embedder.embed([self._text(record) for record in batch])
+
+            # Messages may have been queued or dropped while embedding
+            if self._pending[:len(batch)] != batch:
+                continue
+            del self._pending[:len(batch)]
+
+            self._append(vectors)
+            self._records.extend(batch)
+
+            overflow = self._count - self.max_records
+            if overflow > 0:
+                self._vectors[:self.max_records] = self._vectors[overflow:self._count]
+                del self._records[:overflow]
+                self._count = self.max_records
+
+    async def search(self, query: str, k: int) -> List[Dict[str, Any]]:
+        """
+        Find the messages most similar to a query among the ones already embedded
+
+        Queued messages are embedded in the background, a search never waits for
+        them, so the first searches after loading a long history only see part of it.
+
+        Args:
+            query: Text to search for
+            k: Number of messages to return
+
+        Returns:
+            Up to k messages, most similar first
+        """
+        if self._pending:
+            self._start_flush()
+
+        if not self._count or k <= 0:
+            return []
+
+        query_vector = (await self.embedder.embed([query]))[0]
+        norm = np.linalg.norm(query_vector)
+        if norm == 0:
+            return []
+
+        scores = self._vectors[:self._count] @ (query_vector / norm)
+
+        k = min(k, self._count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self._records[i] for i in top]
+
+    def rebuild(self, records: Sequence[Dict[str, Any]]) -> None:
+        """
+        Replace the index contents with the given messages, embedded on the next flush
+
+        Args:
+            records: Messages to index
+        """
+        self._vectors = None
+        self._count = 0
+        self._records = []
+        self._pending = [record for record in records if record.get('content')]
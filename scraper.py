@@ -0,0 +1,335 @@
+"""
+Concurrent channel history scraper
+Fetches the history of several channels at once, splits the token budget
+between channels round-robin, and merges the channels into one history
+ordered by time. The newest message ingested from each channel is
+remembered, so later scrapes only fetch what came after it.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import heapq
+import json
+import os
+
+import discord
+
+from log_writer import log, WARNING
+
+def normalize_mentions(message) -> str:
+    """
+    Replace the raw mention syntax in a message with readable names
+
+    Args:
+        message: discord.Message to convert
+
+    Returns:
+        The content with <@id> -> @name, <#id> -> #channel and <@&id> -> @role
+    """
+    content = message.content
+
+    for mention in message.mentions:
+        content = content.replace(f'<@{mention.id}>', f'@{mention.display_name}')
+    for channel in message.channel_mentions:
+        content = content.replace(f'<#{channel.id}>', f'#{channel.name}')
+    for role in message.role_mentions:
+        content = content.replace(f'<@&{role.id}>', f'@{role.name}')
+
+    return content
+
+def unseen_messages(history: Sequence[Dict[str, Any]], messages: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Find the scraped messages that aren't in a history yet
+
+    Args:
+        history: The history to merge into
+        messages: Scraped history messages, oldest first
+
+    Returns:
+        The messages whose ID isn't in the history, and that don't repeat a message
+        saved without an ID (older versions didn't keep IDs)
+    """
+    known_ids = set()
+    legacy_contents = set()
+    for msg in history:
+        if msg.get('id') is not None:
+            known_ids.add(msg['id'])
+        else:
+            legacy_contents.add(msg['content'])
+
+    unseen = []
+    for msg in messages:
+        if msg['id'] in known_ids or msg['content'] in legacy_contents:
+            continue
+        known_ids.add(msg['id'])
+        unseen.append(msg)
+    return unseen
+
+class ScrapeState:
+    """Per-channel high-water marks: the ID of the newest message ingested from each channel"""
+
+    def __init__(self, path: str = 'scrape_state.json'):
+        """
+        Initialize the scrape state
+
+        Args:
+            path: File the marks are saved to
+        """
+        self.path = path
+        self.marks: Dict[str, int] = {}
+        self.dirty = False
+
+    def load(self) -> None:
+        """Load the marks, starting empty if the file is missing or broken"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.marks = {str(channel): int(message) for channel, message in json.load(f).items()}
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError, ValueError):
+            self.marks = {}
+        self.dirty = False
+
+    def save(self) -> None:
+        """Write the marks if they changed"""
+        if not self.dirty:
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.marks, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, channel_id: int) -> Optional[int]:
+        """The newest message ID ingested from a channel, or None if it was never scraped"""
+        return self.marks.get(str(channel_id))
+
+    def update(self, channel_id: int, message_id: int) -> None:
+        """Move a channel's mark forward to a message ID"""
+        key = str(channel_id)
+        if message_id > self.marks.get(key, 0):
+            self.marks[key] = message_id
+            self.dirty = True
+
+    def reset(self) -> None:
+        """Forget every mark, the next scrape starts from scratch"""
+        self.marks = {}
+        self.dirty = True
+
+class ChannelScraper:
+    """Scrapes channels concurrently within a token budget"""
+
+    def __init__(self,
+                 count_tokens: Callable[[str], int],
+                 max_concurrency: int = 4,
+                 max_retries: int = 3,
+                 ignore_author: Any = None):
+        """
+        Initialize the scraper
+
+        Args:
+            count_tokens: Function counting the tokens of a message
+            max_concurrency: Number of channels fetched at the same time
+            max_retries: Number of times a channel is resumed after being rate limited
+            ignore_author: User whose messages are skipped, usually the bot itself
+        """
+        self.count_tokens = count_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.ignore_author = ignore_author
+
+    async def _fetch_channel(self,
+                             semaphore: asyncio.Semaphore,
+                             channel: discord.TextChannel,
+                             limit: int,
+                             token_cap: Optional[int],
+                             after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Fetch a channel's newest messages, or every message after a mark
+
+        Args:
+            semaphore: Limits how many channels are fetched at once
+            channel: The channel to fetch
+            limit: Maximum number of messages to fetch
+            token_cap: Stop once this many tokens were collected, None for no limit
+            after: Only fetch messages newer than this message ID, oldest first
+
+        Returns:
+            Messages newest first
+        """
+        messages = []
+        tokens = 0
+        fetched = 0
+        resume_from = discord.Object(id=after) if after is not None else None
+        retries = 0
+
+        async with semaphore:
+            while True:
+                if after is None:
+                    pages = channel.history(limit=limit - fetched, before=resume_from)
+                else:
+                    pages = channel.history(limit=limit - fetched, after=resume_from, oldest_first=True)
+
+                try:
+                    async for message in pages:
+                        resume_from = message
+                        fetched += 1
+
+                        if message.author == self.ignore_author or not message.content:
+                            continue
+
+                        content = normalize_mentions(message)
+                        message_tokens = self.count_tokens(content)
+                        tokens += message_tokens
+
+                        messages.append({
+                            'id': message.id,
+                            'author': message.author.name,
+                            'content': content,
+                            'timestamp': message.created_at,
+                            'channel': channel.name,
+                            'channel_id': channel.id,
+                            'tokens': message_tokens
+                        })
+
+                        # More than the whole budget could never be used
+                        if token_cap is not None and tokens >= token_cap:
+                            break
+                    break
+
+                except discord.Forbidden:
+                    log(f"Cannot access channel #{channel.name}", level=WARNING)
+                    break
+
+                except discord.HTTPException as e:
+                    if e.status != 429 or retries >= self.max_retries:
+                        raise
+
+                    # Resume from the last message we got once the rate limit is over
+                    retries += 1
+                    retry_after = float(e.response.headers.get('Retry-After', 1.0))
+                    log(f"Rate limited scraping #{channel.name}, resuming in {retry_after:.1f}s", level=WARNING)
+                    await asyncio.sleep(retry_after)
+
+        if after is not None:
+            messages.reverse()
+        return messages
+
+    async def _seed_mark(self, semaphore: asyncio.Semaphore, channel: discord.TextChannel, state: ScrapeState) -> None:
+        """Mark a channel at its newest message without fetching its history"""
+        async with semaphore:
+            try:
+                async for message in channel.history(limit=1):
+                    state.update(channel.id, message.id)
+            except discord.Forbidden:
+                log(f"Cannot access channel #{channel.name}", level=WARNING)
+
+    @staticmethod
+    def _split_budget(channels: List[List[Dict[str, Any]]], budget: int) -> Tuple[List[List[Dict[str, Any]]], int]:
+        """
+        Take the newest message of every channel in turn until the budget is used up
+
+        Args:
+            channels: Messages of each channel, newest first
+            budget: Number of tokens to take
+
+        Returns:
+            Tuple of (the taken messages of each channel, tokens taken)
+        """
+        taken = [0] * len(channels)
+        active = [i for i, messages in enumerate(channels) if messages]
+        used = 0
+
+        while active and used < budget:
+            for i in list(active):
+                used += channels[i][taken[i]]['tokens']
+                taken[i] += 1
+
+                if taken[i] >= len(channels[i]):
+                    active.remove(i)
+                if used >= budget:
+                    break
+
+        return [messages[:count] for messages, count in zip(channels, taken)], used
+
+    async def scrape(self,
+                     priority_channels: Sequence[discord.TextChannel],
+                     regular_channels: Sequence[discord.TextChannel],
+                     target_tokens: int = 25_000,
+                     messages_per_channel: int = 200,
+                     state: Optional[ScrapeState] = None,
+                     catch_up_limit: int = 1000,
+                     new_channels: bool = True) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Scrape channels into one time-ordered list
+
+        Channels with a mark in the state only have the messages after it
+        fetched. Of the others, priority channels are scraped completely and
+        regular channels share whatever is left of the token budget, unless
+        new_channels is False: then they are only marked at their newest
+        message, so their old messages never end up after newer history.
+
+        Args:
+            priority_channels: Channels scraped regardless of the token budget
+            regular_channels: Channels scraped up to the token budget
+            target_tokens: Approximate number of tokens to collect
+            messages_per_channel: Maximum number of messages to fetch per new channel
+            state: High-water marks to resume from and update, None to scrape everything
+            catch_up_limit: Maximum number of messages fetched after a channel's mark
+            new_channels: Whether channels without a mark are scraped
+
+        Returns:
+            Tuple of (messages oldest first, total tokens)
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        def mark(channel):
+            return state.get(channel.id) if state is not None else None
+
+        marked = [channel for channel in [*priority_channels, *regular_channels] if mark(channel) is not None]
+        new_priority = [channel for channel in priority_channels if mark(channel) is None]
+        new_regular = [channel for channel in regular_channels if mark(channel) is None]
+
+        if not new_channels:
+            if state is not None:
+                await asyncio.gather(*(
+                    self._seed_mark(semaphore, channel, state) for channel in [*new_priority, *new_regular]
+                ))
+            new_priority, new_regular = [], []
+
+        caught_up, priority, regular = await asyncio.gather(
+            asyncio.gather(*(
+                self._fetch_channel(semaphore, channel, catch_up_limit, None, after=mark(channel))
+                for channel in marked
+            )),
+            asyncio.gather(*(
+                self._fetch_channel(semaphore, channel, messages_per_channel, None)
+                for channel in new_priority
+            )),
+            asyncio.gather(*(
+                self._fetch_channel(semaphore, channel, messages_per_channel, target_tokens)
+                for channel in new_regular
+            ))
+        )
+
+        caught_up_tokens = sum(message['tokens'] for messages in caught_up for message in messages)
+        if caught_up:
+            log(f"Caught up on {sum(map(len, caught_up))} new messages in {len(caught_up)} channels ({caught_up_tokens} tokens)")
+
+        priority_tokens = sum(message['tokens'] for messages in priority for message in messages)
+        if priority:
+            log(f"Scraped {sum(map(len, priority))} messages from priority channels ({priority_tokens} tokens)")
+
+        regular, regular_tokens = self._split_budget(list(regular), max(0, target_tokens - priority_tokens))
+
+        channels = [*caught_up, *priority, *regular]
+        if state is not None:
+            for messages in channels:
+                if messages:
+                    state.update(messages[0]['channel_id'], messages[0]['id'])
+
+        # Every channel is already in order, so a k-way merge is enough
+        merged = heapq.merge(
+            *(reversed(messages) for messages in channels),
+            key=lambda message: message['timestamp']
+        )
+        return list(merged), caught_up_tokens + priority_tokens + regular_tokens
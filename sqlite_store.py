@@ -0,0 +1,458 @@
+"""
+SQLite persistence for message history
+Every public message is a row indexed by channel, author, timestamp and role,
+so questions like "what was said in #announcements this week" are index lookups
+instead of scans of the whole history. Rows are never rewritten in full: new
+messages are inserted in batches, and messages leaving the in-memory history
+are only marked inactive, so the database doubles as a searchable archive.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import sqlite3
+import asyncio
+import json
+import time
+import re
+import os
+
+from history_store import HistoryJournal
+from message_record import Message, json_default, snowflake_time
+from log_writer import log
+
+# '[#channel] author: text' for users, '[channel] ChatBot V2: text' for the bot
+_PREFIX_RE = re.compile(r'^\[#?([^\]]+)\] ([^:\n]+?): ')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY,
+    position REAL NOT NULL,
+    active INTEGER NOT NULL,
+    message_id INTEGER,
+    channel TEXT,
+    author TEXT,
+    role TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, position);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (author, position);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE INDEX IF NOT EXISTS messages_role ON messages (role, position);
+CREATE INDEX IF NOT EXISTS messages_active ON messages (active, position);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+"""
+
+# Row columns, in table order
+COLUMNS = ('seq', 'position', 'active', 'message_id', 'channel', 'author', 'role', 'timestamp', 'data')
+Row = Tuple[int, float, int, Optional[int], Optional[str], Optional[str], str, float, str]
+
+def parse_prefix(msg: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """The channel and author in the prefix of a history message, None for parts it doesn't have"""
+    if isinstance(msg, Message):
+        channel, author = msg.channel, msg.author
+        if channel is not None:
+            channel = channel.lstrip('#')
+    else:
+        match = _PREFIX_RE.match(msg.get('content', ''))
+        if not match:
+            return None, None
+        channel, author = match.groups()
+    # Summaries only have a channel
+    return channel, None if 'summary' in msg else author
+
+class SQLiteHistoryStore:
+    """Public message history in an indexed SQLite database, a drop-in for HistoryJournal"""
+
+    def __init__(self,
+                 path: str = 'message_history.db',
+                 legacy: Optional[HistoryJournal] = None,
+                 batch_size: int = 64,
+                 flush_delay: float = 1.0):
+        """
+        Initialize the store
+
+        Args:
+            path: Database file
+            legacy: Snapshot + journal storage migrated into the database when it is empty
+            batch_size: Pending rows written at once without waiting for flush_delay
+            flush_delay: Seconds new rows may wait to be written with others
+        """
+        self.path = path
+        self.legacy = legacy
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+
+        self.seq = 0            # Highest row ID handed out
+        self.position = 0.0     # Highest position handed out, positions order the rows
+        self.needs_compaction = False   # Rows are written in batches, never rewritten in full
+
+        # The in-memory history by row ID, and the messages' row IDs by object identity
+        self._live: Dict[int, Tuple[Dict[str, Any], float, float]] = {}
+        self._seqs: Dict[int, int] = {}
+        self._message_ids: Dict[int, int] = {}
+
+        # Rows waiting to be written, by row ID, only the newest version of a row is kept
+        self._pending: Dict[int, Row] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_delayed = False
+
+        # One writer thread, so batches land in the order they were submitted
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-db')
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.execute('PRAGMA synchronous=NORMAL')
+        self._writer.executescript(SCHEMA)
+        self._reader = sqlite3.connect(path)
+
+    def _track(self, seq: int, msg: Dict[str, Any], position: float, timestamp: float) -> None:
+        """Remember a message of the in-memory history"""
+        self._live[seq] = (msg, position, timestamp)
+        self._seqs[id(msg)] = seq
+        if 'id' in msg:
+            self._message_ids[msg['id']] = seq
+
+    def _untrack(self, seq: int) -> Tuple[Dict[str, Any], float, float]:
+        msg, position, timestamp = self._live.pop(seq)
+        del self._seqs[id(msg)]
+        if self._message_ids.get(msg.get('id')) == seq:
+            del self._message_ids[msg['id']]
+        return msg, position, timestamp
+
+    @staticmethod
+    def _row(seq: int, msg: Dict[str, Any], position: float, timestamp: float, active: bool) -> Row:
+        channel, author = parse_prefix(msg)
+        return (seq, position, int(active), msg.get('id'), channel, author,
+                msg.get('role', ''), timestamp, json.dumps(msg, default=json_default))
+
+    def _row_id_for(self, msg: Dict[str, Any]) -> int:
+        """Row ID for a new message, an archived Discord message keeps its old row"""
+        message_id = msg.get('id')
+        if message_id is not None:
+            seq = self._message_ids.get(message_id)
+            if seq is not None:
+                self._untrack(seq)
+                return seq
+            found = self._reader.execute('SELECT seq FROM messages WHERE message_id = ? LIMIT 1', (message_id,)).fetchone()
+            if found is not None:
+                return found[0]
+
+        self.seq += 1
+        return self.seq
+
+    def _add(self, msg: Dict[str, Any], position: float) -> None:
+        """Track a new message of the in-memory history and queue its row"""
+        seq = self._row_id_for(msg)
+        timestamp = msg.get('timestamp')
+        if timestamp is None:
+            timestamp = snowflake_time(msg['id']) if isinstance(msg.get('id'), int) else time.time()
+        self._track(seq, msg, position, timestamp)
+        self._pending[seq] = self._row(seq, msg, position, timestamp, active=True)
+
+    def load(self) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        """
+        Load the active history, migrating the legacy snapshot and journal into an empty database
+
+        Returns:
+            Tuple of (public history, private history by user name found in the legacy snapshot)
+
+        Raises:
+            FileNotFoundError: If the database is empty and there is nothing to migrate
+        """
+        seq, position = self._reader.execute('SELECT MAX(seq), MAX(position) FROM messages').fetchone()
+        if seq is None:
+            return self._migrate()
+
+        self.seq = seq
+        self.position = position
+
+        public = []
+        for seq, position, timestamp, data in self._reader.execute(
+                'SELECT seq, position, timestamp, data FROM messages WHERE active = 1 ORDER BY position, seq'):
+            msg = Message.from_dict(json.loads(data))
+            self._track(seq, msg, position, timestamp)
+            public.append(msg)
+        return public, {}
+
+    def _migrate(self) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        """Insert the legacy history and move its files aside"""
+        if self.legacy is None:
+            raise FileNotFoundError(self.path)
+
+        public, private = self.legacy.load()
+        self.legacy.close()
+        for msg in public:
+            self.position += 1
+            self._add(msg, self.position)
+        self.flush()
+
+        for path in (self.legacy.snapshot_path, self.legacy.journal_path, self.legacy.rotated_path):
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+
+        log(f'Migrated {len(public)} messages from {self.legacy.snapshot_path} to {self.path}')
+        return public, private
+
+    def append(self, msg: Dict[str, Any]) -> None:
+        """
+        Add a message to the end of the history, it is written with the next batch
+
+        Args:
+            msg: The history message that was just added
+        """
+        self.position += 1
+        self._add(msg, self.position)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        """Write pending rows after flush_delay, or right away once a batch is full"""
+        full = len(self._pending) >= self.batch_size
+        if self._timer is not None:
+            # Only a full batch brings a delayed flush forward
+            if not (full and self._timer_delayed):
+                return
+            self._timer.cancel()
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the event loop, rows wait for the next explicit flush
+            return
+
+        self._timer_delayed = not full
+        self._timer = loop.call_later(0 if full else self.flush_delay,
+                                      lambda: loop.create_task(self.flush_in_background()))
+
+    def _take_pending(self) -> List[Row]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return list(self._pending.values())
+
+    def _written(self, rows: List[Row]) -> None:
+        """Drop written rows from the pending ones, unless they changed again meanwhile"""
+        for row in rows:
+            if self._pending.get(row[0]) is row:
+                del self._pending[row[0]]
+
+    def _write(self, rows: List[Row]) -> None:
+        """Insert or replace rows in one transaction, runs on the writer thread"""
+        with self._writer:
+            self._writer.executemany(f"INSERT OR REPLACE INTO messages VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+
+    def flush(self) -> None:
+        """Write every pending row, blocking until they are committed"""
+        rows = self._take_pending()
+        if rows:
+            self._executor.submit(self._write, rows).result()
+            self._written(rows)
+
+    async def flush_in_background(self) -> None:
+        """Write every pending row on the writer thread"""
+        rows = self._take_pending()
+        if rows:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows)
+            self._written(rows)
+
+    def _sync(self, public: List[Dict[str, Any]]) -> None:
+        """
+        Queue the rows needed to make the active rows match the in-memory history
+
+        Messages that left it are marked inactive. New messages, like summaries
+        replacing a run, are placed between their neighbours.
+        """
+        live = {id(msg) for msg in public}
+        for seq in [seq for key, seq in self._seqs.items() if key not in live]:
+            msg, position, timestamp = self._untrack(seq)
+            self._pending[seq] = self._row(seq, msg, position, timestamp, active=False)
+
+        # Position of the next message that already has a row, for every index
+        following: List[Optional[float]] = [None] * len(public)
+        next_position = None
+        for i in range(len(public) - 1, -1, -1):
+            following[i] = next_position
+            seq = self._seqs.get(id(public[i]))
+            if seq is not None:
+                next_position = self._live[seq][1]
+
+        previous = None
+        for msg, next_position in zip(public, following):
+            seq = self._seqs.get(id(msg))
+            if seq is not None:
+                previous = self._live[seq][1]
+                continue
+
+            if next_position is None:
+                self.position += 1
+                position = self.position
+            elif previous is None:
+                position = next_position - 1
+            else:
+                position = (previous + next_position) / 2
+            self._add(msg, position)
+            previous = position
+
+    def compact(self,
+                public: List[Dict[str, Any]],
+                private: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> None:
+        """
+        Bring the database up to date with the in-memory history and write it
+
+        Args:
+            public: Public message history
+            private: Ignored, private history is stored elsewhere
+        """
+        self._sync(public)
+        self.flush()
+
+    async def compact_in_background(self,
+                                    public: List[Dict[str, Any]],
+                                    private: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> None:
+        """
+        Bring the database up to date with the in-memory history without blocking the event loop
+
+        Only the changed rows are written, on the writer thread.
+
+        Args:
+            public: Public message history
+            private: Ignored, private history is stored elsewhere
+        """
+        self._sync(public)
+        await self.flush_in_background()
+
+    def _matches(self, row: Row, filters: Dict[str, Any]) -> bool:
+        """Whether a pending row passes the filters of a query"""
+        for column, value in filters.items():
+            if column == 'since':
+                if row[7] < value: return False
+            elif column == 'until':
+                if row[7] >= value: return False
+            elif row[COLUMNS.index(column)] != value:
+                return False
+        return True
+
+    def _select(self, filters: Dict[str, Any], limit: int) -> List[Tuple[float, int, Dict[str, Any]]]:
+        """The newest rows passing the filters, including pending ones, as (position, row ID, message)"""
+        clauses = []
+        params: List[Any] = []
+        for column, value in filters.items():
+            if column == 'since':
+                clauses.append('timestamp >= ?')
+            elif column == 'until':
+                clauses.append('timestamp < ?')
+            else:
+                clauses.append(f'{column} = ?')
+            params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+        found: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        for seq, position, data in self._reader.execute(
+                f'SELECT seq, position, data FROM messages {where} ORDER BY position DESC LIMIT ?', (*params, limit)):
+            if seq not in self._pending:
+                found[seq] = (position, data)
+        for seq, row in self._pending.items():
+            if self._matches(row, filters):
+                found[seq] = (row[1], row[8])
+
+        rows = sorted(found.items(), key=lambda item: (item[1][0], item[0]))[-limit:] if limit else []
+        return [
+            (position, seq, self._live[seq][0] if seq in self._live else Message.from_dict(json.loads(data)))
+            for seq, (position, data) in rows
+        ]
+
+    def query(self,
+              channel: Optional[str] = None,
+              author: Optional[str] = None,
+              role: Optional[str] = None,
+              since: Optional[float] = None,
+              until: Optional[float] = None,
+              active: Optional[bool] = None,
+              limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Find the newest messages matching every given filter
+
+        Args:
+            channel: Channel name, without the '#'
+            author: Author name
+            role: 'user' or 'assistant'
+            since: Earliest Unix time
+            until: Unix time the messages are older than
+            active: True for the in-memory history only, False for archived messages only
+            limit: Maximum number of messages
+
+        Returns:
+            The messages, oldest first. Messages of the in-memory history are the same objects.
+        """
+        filters = {
+            column: value for column, value in
+            (('channel', channel), ('author', author), ('role', role), ('since', since), ('until', until))
+            if value is not None
+        }
+        if active is not None:
+            filters['active'] = int(active)
+        return [msg for _, _, msg in self._select(filters, limit)]
+
+    def candidates(self,
+                   channel: Optional[str],
+                   recent: int,
+                   per_channel: int,
+                   include: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """
+        A bounded set of messages to build a context from
+
+        Args:
+            channel: Channel of the prompt
+            recent: Number of latest messages of the in-memory history
+            per_channel: Number of latest messages of the channel, archived ones included
+            include: Messages to add, like retrieved ones. Ones no longer in the
+                     in-memory history go first, they are older than all of it.
+
+        Returns:
+            The messages without duplicates, oldest first
+        """
+        found = {seq: (position, msg) for position, seq, msg in self._select({'active': 1}, recent)}
+        if channel is not None and per_channel:
+            found.update((seq, (position, msg)) for position, seq, msg in self._select({'channel': channel}, per_channel))
+        pruned = []
+        for msg in include or ():
+            seq = self._seqs.get(id(msg))
+            if seq is not None:
+                found[seq] = (self._live[seq][1], msg)
+            else:
+                pruned.append(msg)
+
+        # Archived channel messages were loaded as new objects, so pruned ones are matched by Discord ID
+        found_ids = {msg.get('id') for _, msg in found.values()}
+        pruned = [msg for msg in pruned if msg.get('id') is None or msg.get('id') not in found_ids]
+        pruned.sort(key=lambda msg: msg.get('timestamp', 0))
+        return pruned + [msg for _, (_, msg) in sorted(found.items(), key=lambda item: (item[1][0], item[0]))]
+
+    def count(self, active: Optional[bool] = None) -> int:
+        """
+        Number of messages written to the database
+
+        Args:
+            active: True to count the in-memory history only, False for archived messages only
+        """
+        where, params = ('WHERE active = ?', (int(active),)) if active is not None else ('', ())
+        return self._reader.execute(f'SELECT COUNT(*) FROM messages {where}', params).fetchone()[0]
+
+    def clear(self) -> None:
+        """Delete every message, archived ones included"""
+        self._take_pending()
+        self._pending.clear()
+        self._live.clear()
+        self._seqs.clear()
+        self._message_ids.clear()
+
+        def delete():
+            with self._writer:
+                self._writer.execute('DELETE FROM messages')
+        self._executor.submit(delete).result()
+
+    def close(self) -> None:
+        """Write pending rows and close the database"""
+        self.flush()
+        self._executor.shutdown()
+        self._reader.close()
+        self._writer.close()
@@ -0,0 +1,122 @@
+"""
+In-memory usage statistics with coalesced persistence
+Counters are updated in memory on every message and only written to disk
+(and pushed to the bot's profile) periodically, when they actually changed
+"""
+
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import json
+import time
+
+from log_writer import log, ERROR
+
+class StatsTracker:
+    """Keeps usage counters in memory and flushes them on a fixed cadence"""
+
+    def __init__(self,
+                 path: str = 'stats.json',
+                 flush_interval: float = 30.0,
+                 publish_interval: float = 300.0):
+        """
+        Initialize the stats tracker
+
+        Args:
+            path: File the counters are persisted to
+            flush_interval: Seconds between writes of the stats file
+            publish_interval: Minimum seconds between publishes (bio updates)
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.publish_interval = publish_interval
+
+        try:
+            with open(path, 'r') as f:
+                self.counters: Dict[str, int] = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.counters = {}
+
+        for key in ('seen', 'total', 'public', 'private'):
+            self.counters.setdefault(key, 0)
+
+        self._saved = dict(self.counters)
+        self._published: Optional[Dict[str, int]] = None
+        self._last_publish = 0.0
+
+    def __getitem__(self, key: str) -> int:
+        return self.counters[key]
+
+    def __setitem__(self, key: str, value: int) -> None:
+        self.counters[key] = value
+
+    def increment(self, *keys: str) -> None:
+        """Increment one or more counters by one"""
+        for key in keys:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    @property
+    def dirty(self) -> bool:
+        """Whether the counters changed since they were last written"""
+        return self.counters != self._saved
+
+    def save(self, force: bool = False) -> bool:
+        """
+        Write the counters to disk if they changed
+
+        Args:
+            force: Write even if nothing changed
+
+        Returns:
+            Whether the file was written
+        """
+        if not (force or self.dirty):
+            return False
+
+        with open(self.path, 'w') as f:
+            json.dump(self.counters, f)
+        self._saved = dict(self.counters)
+        return True
+
+    async def publish(self, publisher: Callable[[], Awaitable[None]], force: bool = False) -> bool:
+        """
+        Publish the counters if they changed and the publish interval has passed
+
+        Args:
+            publisher: Coroutine function that publishes the current counters
+            force: Publish regardless of the interval and changes
+
+        Returns:
+            Whether the counters were published
+        """
+        if not force:
+            if self.counters == self._published:
+                return False
+            if time.monotonic() - self._last_publish < self.publish_interval:
+                return False
+
+        snapshot = dict(self.counters)
+        await publisher()
+        self._published = snapshot
+        self._last_publish = time.monotonic()
+        return True
+
+    async def run(self, publisher: Callable[[], Awaitable[None]]) -> None:
+        """
+        Periodically flush the counters to disk and publish them
+
+        Args:
+            publisher: Coroutine function that publishes the current counters
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                self.save()
+            except OSError as e:
+                log(f'Failed to save stats: {e}', level=ERROR)
+
+            try:
+                await self.publish(publisher)
+            except Exception as e:
+                # Rate limited or disconnected, try again on the next tick
+                log(f'Failed to publish stats: {e}', level=ERROR)
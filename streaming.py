@@ -0,0 +1,379 @@
+"""
+Streaming response rendering
+Accumulates streamed tokens without re-scanning the whole response, tracks
+whether the model is thinking or answering, and paces Discord message edits
+according to how fast Discord accepts them. The model stream and the message
+edits run as separate tasks, so a slow edit never holds up generation.
+"""
+
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+import asyncio
+import time
+
+from tracing import NULL_TRACE
+from log_writer import log, WARNING
+
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+
+# Discord rejects every edit of an embed with a longer description
+EMBED_DESCRIPTION_LIMIT = 4096
+
+def fit_embed_description(text: str, limit: int = EMBED_DESCRIPTION_LIMIT) -> str:
+    """
+    Cut a text to the length Discord accepts as an embed description
+
+    Args:
+        text: The text to show
+        limit: Maximum number of characters
+
+    Returns:
+        The text, or its start ending in an ellipsis if it is longer than the limit
+    """
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + '…'
+
+def _partial_tag_length(text: str, tags: List[str]) -> int:
+    """Length of the longest suffix of text that is the start of one of the tags"""
+    longest = 0
+    for tag in tags:
+        for length in range(min(len(tag) - 1, len(text)), longest, -1):
+            if text.endswith(tag[:length]):
+                longest = length
+                break
+    return longest
+
+class ResponseBuffer:
+    """Incremental buffer of a streamed response with a thinking/answer state machine"""
+
+    PREAMBLE = 'preamble'   # Nothing but plain text so far
+    THINKING = 'thinking'   # Inside <think>
+    ANSWER = 'answer'       # After </think>
+
+    def __init__(self):
+        self.state = self.PREAMBLE
+        self.tokens = 0
+
+        self._parts: List[str] = []    # Every token as received
+        self._visible: List[str] = []  # Text shown to the user in the current state
+        self._carry = ''               # End of the last token that may be the start of a tag
+        self._text: Optional[str] = None
+
+    @property
+    def thinking(self) -> bool:
+        """Whether the model has opened a thinking block it hasn't closed yet"""
+        return self.state == self.THINKING
+
+    def feed(self, token: str) -> None:
+        """
+        Add a streamed token
+
+        Args:
+            token: The token text, tags may be split over several tokens
+        """
+        self._parts.append(token)
+        self._text = None
+        self.tokens += 1
+
+        text = self._carry + token
+        self._carry = ''
+
+        while text:
+            tags = [THINK_OPEN, THINK_CLOSE] if self.state == self.PREAMBLE else [THINK_CLOSE]
+            found = [(index, tag) for tag in tags if (index := text.find(tag)) >= 0]
+
+            if found:
+                index, tag = min(found)
+                if self.state != self.THINKING:
+                    self._visible.append(text[:index])
+
+                if tag == THINK_OPEN:
+                    self.state = self.THINKING
+                else:
+                    # Only what follows the closing tag is the answer
+                    self.state = self.ANSWER
+                    self._visible = []
+
+                text = text[index + len(tag):]
+                continue
+
+            # Hold back a possible partial tag until the next token arrives
+            keep = _partial_tag_length(text, tags)
+            if self.state != self.THINKING:
+                self._visible.append(text[:len(text) - keep])
+            self._carry = text[len(text) - keep:]
+            break
+
+    def finish(self) -> None:
+        """Flush text held back as a possible partial tag once the stream has ended"""
+        if self._carry and self.state != self.THINKING:
+            self._visible.append(self._carry)
+        self._carry = ''
+
+    @property
+    def answer(self) -> str:
+        """The text to show the user, everything after </think> once it was seen"""
+        visible = ''.join(self._visible)
+        self._visible = [visible]
+        return visible.strip() if self.state == self.ANSWER else visible
+
+    @property
+    def text(self) -> str:
+        """The full response including the thinking block"""
+        if self._text is None:
+            self._text = ''.join(self._parts)
+            self._parts = [self._text]
+        return self._text
+
+class EditThrottle:
+    """Adaptive interval between message edits based on edit latency and rate limits"""
+
+    def __init__(self, min_interval: float = 0.25, max_interval: float = 10.0, smoothing: float = 0.3):
+        """
+        Initialize the throttle
+
+        Args:
+            min_interval: Shortest time between edits in seconds
+            max_interval: Longest time between edits in seconds
+            smoothing: Weight of the newest latency sample in the moving average
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+
+        self.interval = min_interval
+        self.latency: Optional[float] = None
+        self.rate_limits = 0
+
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def delay(self) -> float:
+        """Seconds until the next edit may be sent"""
+        now = time.monotonic()
+        return max(0.0, self._last_edit + self.interval - now, self._blocked_until - now)
+
+    def ready(self) -> bool:
+        """Whether an edit may be sent now"""
+        return self.delay() == 0
+
+    def record_latency(self, latency: float) -> None:
+        """
+        Adapt the interval to how long an edit took
+
+        discord.py waits out exhausted rate-limit buckets inside the request,
+        so slow edits are the first sign of rate limiting
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        self.interval = self._clamp(max(self.interval * 0.9, self.latency * 2))
+
+    def observe_headers(self, headers) -> None:
+        """
+        Adapt the interval to Discord's rate-limit headers
+
+        Args:
+            headers: Response headers containing X-RateLimit-Remaining and X-RateLimit-Reset-After
+        """
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is None or reset_after is None:
+            return
+
+        # Spread the requests left in the bucket over the time until it resets
+        self.interval = self._clamp(float(reset_after) / (int(float(remaining)) + 1))
+
+    def record_rate_limit(self, retry_after: float) -> None:
+        """
+        Back off after a 429 response
+
+        Args:
+            retry_after: Seconds Discord asked to wait
+        """
+        self.rate_limits += 1
+        self._blocked_until = time.monotonic() + retry_after
+        self.interval = self._clamp(max(self.interval * 2, retry_after))
+
+    async def try_edit(self, edit: Callable[[], Awaitable[Any]]) -> bool:
+        """
+        Send an edit, learning from its latency or rate limit
+
+        Args:
+            edit: Coroutine function performing the edit, the message is only rendered when it is called
+
+        Returns:
+            Whether the edit landed
+        """
+        started = time.monotonic()
+        try:
+            await edit()
+        except Exception as e:
+            if getattr(e, 'status', None) != 429:
+                raise
+
+            headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+            self.observe_headers(headers)
+            self.record_rate_limit(float(headers.get('Retry-After', getattr(e, 'retry_after', 1.0))))
+            return False
+
+        self._last_edit = time.monotonic()
+        self.record_latency(self._last_edit - started)
+        return True
+
+    async def land_edit(self, edit: Callable[[], Awaitable[Any]], attempts: int = 5) -> bool:
+        """
+        Send the final edit, waiting out rate limits until it lands
+
+        Args:
+            edit: Coroutine function performing the edit
+            attempts: Maximum number of tries
+
+        Returns:
+            Whether the edit landed
+        """
+        for _ in range(attempts):
+            await asyncio.sleep(max(0.0, self._blocked_until - time.monotonic()))
+            if await self.try_edit(edit):
+                return True
+        return False
+
+class ChannelClosed(Exception):
+    """Raised when reading from a closed LatestValue with nothing new in it"""
+
+class LatestValue:
+    """Single-slot channel, every put replaces the value and readers only see the newest one"""
+
+    def __init__(self):
+        self._value: Any = None
+        self._fresh = False
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, value: Any) -> None:
+        """Replace the value, waking up a waiting reader"""
+        self._value = value
+        self._fresh = True
+        self._changed.set()
+
+    def close(self) -> None:
+        """Signal that no more values will be put"""
+        self._closed = True
+        self._changed.set()
+
+    async def get(self) -> Any:
+        """
+        Wait for a value that hasn't been read yet
+
+        Returns:
+            The newest value
+
+        Raises:
+            ChannelClosed: If the channel was closed and the newest value was already read
+        """
+        while not self._fresh:
+            if self._closed:
+                raise ChannelClosed()
+            self._changed.clear()
+            await self._changed.wait()
+
+        self._fresh = False
+        return self._value
+
+async def render_stream(stream: AsyncIterator[Any],
+                        edit: Callable[[ResponseBuffer], Awaitable[Any]],
+                        throttle: Optional[EditThrottle] = None,
+                        on_token: Optional[Callable[[str], None]] = None,
+                        trace: Any = NULL_TRACE) -> Tuple[ResponseBuffer, Any]:
+    """
+    Consume a chat stream at full speed while a separate task edits the message
+
+    Args:
+        stream: Ollama chat stream
+        edit: Coroutine function rendering the buffer into the message
+        throttle: Edit throttle, a new one is used if not given
+        on_token: Called with every token as it arrives
+        trace: Trace recording the wait for the first token, the thinking and
+               answering phases and every edit
+
+    Returns:
+        Tuple of (the finished buffer, the last chunk of the stream)
+    """
+    throttle = throttle or EditThrottle()
+    buffer = ResponseBuffer()
+    updates = LatestValue()
+    last_chunk = None
+
+    async def read():
+        nonlocal last_chunk
+        phase = trace.span('first_token')
+        thinking = None  # Unknown until the first token
+        try:
+            async for chunk in stream:
+                token = chunk.message.content
+                if on_token is not None:
+                    on_token(token)
+                buffer.feed(token)
+                updates.put(buffer)
+                last_chunk = chunk
+
+                if buffer.thinking != thinking:
+                    phase.end()
+                    thinking = buffer.thinking
+                    phase = trace.span('think' if thinking else 'answer')
+        finally:
+            phase.end()
+            buffer.finish()
+            updates.close()
+
+            # Frees the stream's pool slot at once if reading stopped early
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+    async def traced_edit():
+        with trace.span('discord_edit'):
+            await edit(buffer)
+
+    async def render():
+        while True:
+            try:
+                await updates.get()
+            except ChannelClosed:
+                return
+
+            # Tokens keep arriving while we wait, the edit shows whatever is newest by then
+            await asyncio.sleep(throttle.delay())
+            if updates.closed:
+                return  # The final edit takes it from here
+
+            try:
+                await throttle.try_edit(traced_edit)
+            except Exception as e:
+                log(f'[STREAM] Edit failed, waiting for the final edit: {e}', level=WARNING)
+                return
+
+    renderer = asyncio.create_task(render())
+    try:
+        await read()
+    except BaseException:
+        renderer.cancel()
+        raise
+    await renderer
+
+    with trace.span('final_edit'):
+        landed = await throttle.land_edit(traced_edit)
+    if not landed:
+        log('[STREAM] Final edit was rate limited too often and did not land', level=WARNING)
+
+    return buffer, last_chunk
@@ -0,0 +1,46 @@
+"""
+Tests of history compaction
+"""
+
+import asyncio
+
+from compaction import HistoryCompactor
+
+class SlowClient:
+    """Answers summary requests after a delay"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def chat(self, model, messages, **kwargs):
+        await asyncio.sleep(self.delay)
+        return {'message': {'content': 'They talked about builds.'}}
+
+def make_history(count: int):
+    return [{'role': 'user', 'content': f'[#general] user{i}: message number {i}'} for i in range(count)]
+
+def make_compactor(client) -> HistoryCompactor:
+    return HistoryCompactor(client, 'model', lambda text: len(text.split()),
+                            keep_recent=10, keep_recent_tokens=0, run_length=10)
+
+def test_summaries_replace_runs():
+    history = make_history(30)
+    compactor = make_compactor(SlowClient(0))
+
+    summaries = asyncio.run(compactor.compact_public(lambda: history, lambda: True))
+
+    assert len(summaries) == 2
+    assert len(history) == 12
+
+def test_interrupt_cancels_summary():
+    history = make_history(30)
+    compactor = make_compactor(SlowClient(10))
+
+    async def run():
+        compaction = asyncio.create_task(compactor.compact_public(lambda: history, lambda: True))
+        await asyncio.sleep(0.01)
+        compactor.interrupt()
+        return await asyncio.wait_for(compaction, 1)
+
+    assert asyncio.run(run()) == []
+    assert len(history) == 30
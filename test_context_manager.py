@@ -0,0 +1,42 @@
+"""
+Tests of stable context assembly
+"""
+
+from context_manager import ContextManager
+
+def make_history(count: int):
+    return [
+        {'role': 'user', 'content': f'[general] user{i}: {i} code error in my build, message number {i}'}
+        for i in range(count)
+    ]
+
+def test_prompt_comes_last_after_rebase():
+    manager = ContextManager(max_tokens=300, assembly_mode='stable')
+    history = make_history(200)
+
+    context = manager.optimize_context(history, retrieved=[history[5], history[7]])
+
+    assert manager.get_prefix_stats()['rebases'] == 1
+    assert context[-1]['content'] == history[-1]['content']
+    assert history[5]['content'] in [msg['content'] for msg in context]
+
+def test_prompt_kept_with_small_budget():
+    manager = ContextManager(max_tokens=30, assembly_mode='stable')
+    history = make_history(50)
+
+    context = manager.optimize_context(history)
+
+    assert context[-1]['content'] == history[-1]['content']
+
+def test_prefix_reused_and_prompt_last_after_new_messages():
+    manager = ContextManager(max_tokens=300, assembly_mode='stable')
+    history = make_history(200)
+    first = manager.optimize_context(history)
+
+    history.append({'role': 'assistant', 'content': '[general] ChatBot V2: try a clean build'})
+    history.append({'role': 'user', 'content': '[general] user1: that fixed it'})
+    second = manager.optimize_context(history, retrieved=[history[3]])
+
+    assert manager.get_prefix_stats()['rebases'] == 1
+    assert second[:len(first) - 1] == first[:-1]
+    assert second[-1]['content'] == history[-1]['content']
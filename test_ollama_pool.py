@@ -0,0 +1,35 @@
+"""
+Tests of OllamaPool backend selection
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('ollama')
+
+from ollama_pool import OllamaBackend, OllamaPool, NoBackendAvailable
+
+def test_single_host_is_retried_while_cooling_down():
+    backend = OllamaBackend('http://localhost:11434', client=object())
+    pool = OllamaPool([backend], retry_after=30.0)
+    backend.mark_unhealthy()
+
+    assert asyncio.run(pool._acquire([])) is backend
+
+def test_least_recently_failed_host_is_preferred():
+    first = OllamaBackend('http://a:11434', client=object())
+    second = OllamaBackend('http://b:11434', client=object())
+    pool = OllamaPool([first, second], retry_after=30.0)
+    first.mark_unhealthy()
+    second.mark_unhealthy()
+
+    assert asyncio.run(pool._acquire([])) is first
+
+def test_tried_hosts_are_not_retried():
+    backend = OllamaBackend('http://localhost:11434', client=object())
+    pool = OllamaPool([backend], retry_after=30.0)
+    backend.mark_unhealthy()
+
+    with pytest.raises(NoBackendAvailable):
+        asyncio.run(pool._acquire([backend]))
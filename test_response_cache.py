@@ -0,0 +1,24 @@
+"""
+Tests of response cache keys
+"""
+
+from response_cache import ResponseCache
+
+def test_personal_questions_not_shared_between_users():
+    cache = ResponseCache()
+    cache.put(cache.make_key("What's my name?", channel='general', author=1), 'Your name is Alice.')
+
+    assert cache.get(cache.make_key("What's my name?", channel='general', author=2)) is None
+    assert cache.get(cache.make_key("what's my name", channel='general', author=1)) == 'Your name is Alice.'
+
+def test_general_questions_shared_within_a_channel():
+    cache = ResponseCache()
+    cache.put(cache.make_key('How do you apply?', channel='general', author=1), 'Submit the form.')
+
+    assert cache.get(cache.make_key('how do you apply', channel='general', author=2)) == 'Submit the form.'
+    assert cache.get(cache.make_key('How do you apply?', channel='help', author=1)) is None
+
+def test_questions_about_the_conversation_not_cached():
+    cache = ResponseCache()
+
+    assert cache.make_key('What did I just say?', channel='general', author=1) is None
@@ -0,0 +1,50 @@
+"""
+Tests of the embedding index
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from retrieval import EmbeddingIndex, HashingEmbedder
+
+class CountingEmbedder(HashingEmbedder):
+    """Hashing embedder that is slow and counts the texts it embeds"""
+
+    def __init__(self, delay: float):
+        super().__init__(dim=64)
+        self.delay = delay
+        self.embedded = 0
+
+    async def embed(self, texts):
+        await asyncio.sleep(self.delay)
+        self.embedded += len(texts)
+        return self._embed(list(texts))
+
+def make_history(count: int):
+    return [{'role': 'user', 'content': f'[#general] user{i}: message about topic {i}'} for i in range(count)]
+
+def test_search_does_not_wait_for_backlog():
+    embedder = CountingEmbedder(0.05)
+    index = EmbeddingIndex(embedder, batch_size=10)
+    index.rebuild(make_history(100))
+
+    async def run():
+        return await asyncio.wait_for(index.search('topic 5', 3), 0.5)
+
+    assert asyncio.run(run()) == []
+
+def test_concurrent_flushes_embed_once():
+    embedder = CountingEmbedder(0.01)
+    index = EmbeddingIndex(embedder, batch_size=10)
+    history = make_history(50)
+    index.rebuild(history)
+
+    async def run():
+        await asyncio.gather(index.flush(), index.flush())
+        return await index.search('message about topic 7', 1)
+
+    assert asyncio.run(run()) == [history[7]]
+    assert embedder.embedded == 50 + 1
@@ -0,0 +1,57 @@
+"""
+Tests of channel scraping and merging scraped messages
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('discord')
+
+from message_record import Message, Role
+from scraper import ChannelScraper, ScrapeState, unseen_messages
+
+class FakeChannel:
+    """A channel serving fixed messages, newest first"""
+
+    def __init__(self, id: int, messages):
+        self.id = id
+        self.name = f'channel{id}'
+        self.messages = messages
+        self.fetched = 0
+
+    async def history(self, limit=None, **kwargs):
+        for message in self.messages[:limit]:
+            self.fetched += 1
+            yield message
+
+class FakeMessage:
+    def __init__(self, id: int):
+        self.id = id
+
+def test_id_less_history_is_not_duplicated():
+    history = [
+        {'role': 'user', 'content': '[#general] alice: hello'},
+        {'role': 'user', 'content': '[#general] bob: hi alice'}
+    ]
+    scraped = [
+        Message(Role.USER, 'hello', '#general', 'alice', 1001, 1.0),
+        Message(Role.USER, 'hi alice', '#general', 'bob', 1002, 2.0),
+        Message(Role.USER, 'anyone here?', '#general', 'carol', 1003, 3.0)
+    ]
+
+    unseen = unseen_messages(history, scraped)
+
+    assert [msg['id'] for msg in unseen] == [1003]
+    assert unseen_messages([*history, *unseen], scraped) == []
+
+def test_unmarked_channels_are_only_marked():
+    channel = FakeChannel(1, [FakeMessage(500), FakeMessage(400)])
+    state = ScrapeState('unused.json')
+    scraper = ChannelScraper(len)
+
+    messages, tokens = asyncio.run(scraper.scrape([], [channel], state=state, new_channels=False))
+
+    assert messages == [] and tokens == 0
+    assert state.get(1) == 500
+    assert channel.fetched == 1
@@ -0,0 +1,33 @@
+"""
+Tests of streamed response rendering
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from streaming import EMBED_DESCRIPTION_LIMIT, EditThrottle, fit_embed_description, render_stream
+
+async def fake_stream(tokens):
+    for token in tokens:
+        yield SimpleNamespace(message=SimpleNamespace(content=token))
+
+def test_short_text_unchanged():
+    assert fit_embed_description('Hello!') == 'Hello!'
+
+def test_long_answer_is_rendered_within_limit():
+    descriptions = []
+
+    async def edit(buffer):
+        # Discord rejects longer descriptions with a 400
+        description = fit_embed_description(buffer.answer)
+        if len(description) > EMBED_DESCRIPTION_LIMIT:
+            raise ValueError('Invalid Form Body')
+        descriptions.append(description)
+
+    tokens = ['<think>hmm</think>'] + ['word '] * 2000
+    buffer, _ = asyncio.run(render_stream(fake_stream(tokens), edit, EditThrottle(min_interval=0)))
+
+    assert len(buffer.answer) > EMBED_DESCRIPTION_LIMIT
+    assert len(descriptions[-1]) == EMBED_DESCRIPTION_LIMIT
+    assert descriptions[-1].endswith('…')
+    assert buffer.answer.startswith(descriptions[-1][:-1])
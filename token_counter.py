@@ -0,0 +1,275 @@
+"""
+Token counting shared by everything that budgets context
+Counts tokens with the model's real BPE vocabulary when a tokenizer.json is
+available, and with a calibrated estimator otherwise. Counts are memoized.
+"""
+
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+import json
+import math
+import os
+import re
+
+# Pre-tokenizer of the Qwen2 tokenizer deepseek-r1:1.5b uses, with \p{L} and
+# \p{N} approximated by the classes Python's re module supports
+_PRETOKENIZE_RE = re.compile(
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)"
+    r"|(?:[^\r\n\w]|_)?[^\W\d_]+"
+    r"|\d"
+    r"| ?(?:[^\s\w]|_)+[\r\n]*"
+    r"|\s*[\r\n]+"
+    r"|\s+(?!\S)"
+    r"|\s+"
+)
+
+# Character classes used by the estimator
+_ESTIMATE_RE = re.compile(
+    r"([A-Za-z]+)"           # ASCII words
+    r"|(\d)"                 # Digits are split one per token
+    r"|([^\sA-Za-z\d\x80-\U0010ffff]+)"  # ASCII punctuation runs
+    r"|([\r\n]+)"            # Line breaks
+    r"|([^\x00-\x7f])"       # Non-ASCII characters
+)
+
+def _bytes_to_unicode() -> Dict[int, str]:
+    """The byte to printable character mapping used by byte-level BPE vocabularies"""
+    printable = list(range(ord('!'), ord('~') + 1)) + list(range(ord('¡'), ord('¬') + 1)) + list(range(ord('®'), ord('ÿ') + 1))
+    chars = printable[:]
+    n = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + n)
+            n += 1
+    return dict(zip(printable, map(chr, chars)))
+
+class BPETokenizer:
+    """Byte-level BPE tokenizer loaded from a Hugging Face tokenizer.json"""
+
+    def __init__(self, path: str, cache_size: int = 50_000):
+        """
+        Load the tokenizer
+
+        Args:
+            path: Path of the tokenizer.json file
+            cache_size: Number of pre-tokenized words whose token count is cached
+
+        Raises:
+            ValueError: If the file doesn't describe a BPE model
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        model = data.get('model', {})
+        if model.get('type') != 'BPE':
+            raise ValueError(f'{path} is not a BPE tokenizer')
+
+        self.name = f'bpe:{os.path.basename(path)}'
+        self.vocab = model['vocab']
+
+        self.ranks: Dict[Tuple[str, str], int] = {}
+        for rank, merge in enumerate(model['merges']):
+            pair = tuple(merge.split(' ', 1)) if isinstance(merge, str) else tuple(merge)
+            self.ranks[pair] = rank
+
+        # Special tokens such as <think> are always a single token
+        added = [token['content'] for token in data.get('added_tokens', [])]
+        self._added_re = re.compile('|'.join(map(re.escape, sorted(added, key=len, reverse=True)))) if added else None
+
+        self._byte_encoder = _bytes_to_unicode()
+        self._cache: Dict[str, int] = {}
+        self._cache_size = cache_size
+
+    def _bpe_length(self, word: str) -> int:
+        """Number of tokens byte-level BPE splits a pre-tokenized word into"""
+        cached = self._cache.get(word)
+        if cached is not None:
+            return cached
+
+        parts = [self._byte_encoder[b] for b in word.encode('utf-8')]
+        if ''.join(parts) in self.vocab:
+            length = 1
+        else:
+            while len(parts) > 1:
+                # Merge the lowest ranked adjacent pair
+                best = None
+                best_rank = None
+                for i in range(len(parts) - 1):
+                    rank = self.ranks.get((parts[i], parts[i + 1]))
+                    if rank is not None and (best_rank is None or rank < best_rank):
+                        best, best_rank = i, rank
+                if best is None:
+                    break
+                parts[best:best + 2] = [parts[best] + parts[best + 1]]
+            length = len(parts)
+
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[word] = length
+        return length
+
+    def count(self, text: str) -> int:
+        """
+        Count the tokens in a text
+
+        Args:
+            text: The text to tokenize
+
+        Returns:
+            Number of tokens
+        """
+        segments = [text]
+        specials = 0
+        if self._added_re is not None:
+            segments = self._added_re.split(text)
+            specials = len(segments) - 1
+
+        return specials + sum(
+            self._bpe_length(word)
+            for segment in segments
+            for word in _PRETOKENIZE_RE.findall(segment)
+        )
+
+def estimate_count(text: str) -> float:
+    """
+    Estimate the token count of a text without a vocabulary
+
+    Tuned on the Qwen2 tokenizer: common words are one token, digits one
+    each, punctuation runs about two characters per token, and non-ASCII text
+    is costed by UTF-8 length, since CJK and emoji take one to three tokens each.
+
+    Args:
+        text: The text to estimate tokens for
+
+    Returns:
+        Estimated token count
+    """
+    tokens = 0.0
+    for word, digit, punctuation, newlines, other in _ESTIMATE_RE.findall(text):
+        if word:
+            tokens += 1 if len(word) <= 8 else math.ceil(len(word) / 5)
+        elif digit:
+            tokens += 1
+        elif punctuation:
+            tokens += math.ceil(len(punctuation) / 2)
+        elif newlines:
+            tokens += 1
+        else:
+            tokens += (len(other.encode('utf-8')) - 1) * 0.6
+    return tokens
+
+class TokenCounter:
+    """Memoized token counter with a real tokenizer or a calibrated estimator"""
+
+    def __init__(self, tokenizer: Optional[BPETokenizer] = None, scale: float = 1.0, cache_size: int = 65_536):
+        """
+        Initialize the token counter
+
+        Args:
+            tokenizer: Real tokenizer to count with, or None to estimate
+            scale: Correction factor applied to estimates
+            cache_size: Number of texts whose count is memoized
+        """
+        self.tokenizer = tokenizer
+        self.scale = scale
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, int] = OrderedDict()
+
+    @property
+    def name(self) -> str:
+        """Identifies how counts are produced, so cached counts can be invalidated"""
+        if self.tokenizer is not None:
+            return self.tokenizer.name
+        return f'estimate:{self.scale:.3f}'
+
+    def count(self, text: str) -> int:
+        """
+        Count the tokens in a text
+
+        Args:
+            text: The text to count tokens for
+
+        Returns:
+            Token count
+        """
+        if not text:
+            return 0
+
+        cached = self._cache.get(text)
+        if cached is not None:
+            self._cache.move_to_end(text)
+            return cached
+
+        if self.tokenizer is not None:
+            count = self.tokenizer.count(text)
+        else:
+            count = max(1, round(estimate_count(text) * self.scale))
+
+        self._cache[text] = count
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return count
+
+    def set_tokenizer(self, tokenizer: Optional[BPETokenizer]) -> None:
+        """Switch to another tokenizer, dropping memoized counts"""
+        self.tokenizer = tokenizer
+        self._cache.clear()
+
+    def calibrate(self, texts: Sequence[str], tokenizer: BPETokenizer) -> float:
+        """
+        Fit the estimator's scale to a real tokenizer
+
+        The bot calls this when the history is loaded with a tokenizer and saves the
+        scale, so estimates stay close to real counts if the tokenizer goes missing.
+
+        Args:
+            texts: Sample texts, ideally taken from the message history
+            tokenizer: Tokenizer giving the true counts
+
+        Returns:
+            The new scale
+        """
+        estimated = sum(estimate_count(text) for text in texts)
+        actual = sum(tokenizer.count(text) for text in texts)
+        if estimated:
+            self.scale = actual / estimated
+            self._cache.clear()
+        return self.scale
+
+# Shared counter used by every caller
+_counter = TokenCounter()
+
+def get_token_counter() -> TokenCounter:
+    """Get the shared token counter"""
+    return _counter
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in text with the shared counter
+
+    Args:
+        text: The text to count tokens for
+
+    Returns:
+        Token count
+    """
+    return _counter.count(text)
+
+def load_tokenizer(path: str = 'tokenizer.json') -> bool:
+    """
+    Make the shared counter use a tokenizer vocabulary from a local file
+
+    Args:
+        path: Path of a Hugging Face tokenizer.json
+
+    Returns:
+        Whether the tokenizer was loaded
+    """
+    try:
+        tokenizer = BPETokenizer(path)
+    except (FileNotFoundError, ValueError, KeyError, json.JSONDecodeError):
+        return False
+
+    _counter.set_tokenizer(tokenizer)
+    return True
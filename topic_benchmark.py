@@ -0,0 +1,122 @@
+"""
+Micro-benchmark for topic detection
+Compares the per-keyword regex implementation topic detection used to have
+with the precompiled single-pass matcher, and checks both give identical results
+
+Usage: python topic_benchmark.py [--messages N] [--repeat N]
+"""
+
+import argparse
+import json
+import random
+import re
+import time
+from typing import Callable, List, Tuple
+
+from topic_detection import TOPICS, detect_message_topic, get_topic_keywords, score_message_relevance
+
+def legacy_detect_message_topic(message: str) -> Tuple[str, float]:
+    """detect_message_topic as it was before the precompiled matcher"""
+    message = message.lower()
+    scores = {}
+
+    for topic, topic_info in TOPICS.items():
+        score = 0
+        weight = topic_info.get("weight", 1.0)
+
+        for keyword in topic_info["keywords"]:
+            pattern = r'\b' + re.escape(keyword) + r'\b'
+            matches = re.findall(pattern, message)
+            score += len(matches) * weight
+
+        scores[topic] = score
+
+    best_topic = max(scores.items(), key=lambda x: x[1])
+
+    if best_topic[1] == 0:
+        return "general", 0.1
+
+    total_score = sum(scores.values())
+    confidence = best_topic[1] / total_score if total_score > 0 else 0
+
+    return best_topic[0], min(confidence, 1.0)
+
+def legacy_score_message_relevance(message: str, current_topic: str) -> float:
+    """score_message_relevance as it was before the precompiled matcher"""
+    keywords = get_topic_keywords(current_topic)
+
+    if not keywords:
+        return 0.5
+
+    message = message.lower()
+
+    matches = 0
+    for keyword in keywords:
+        pattern = r'\b' + re.escape(keyword) + r'\b'
+        if re.search(pattern, message):
+            matches += 1
+
+    relevance = 0.3 + (0.7 * min(matches / (len(keywords) * 0.3), 1.0))
+
+    return min(relevance, 1.0)
+
+def load_messages(count: int) -> List[str]:
+    """Load message texts from message_history.json, padded with synthetic ones"""
+    messages = []
+    try:
+        with open('message_history.json', 'r') as f:
+            data = json.load(f)
+        messages = [msg['content'] for msg in data.get('public', []) if msg.get('content')]
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    # Synthetic messages made of topic keywords and filler words
+    rng = random.Random(0)
+    vocabulary = [kw for topic_info in TOPICS.values() for kw in topic_info["keywords"]]
+    vocabulary += ["the", "a", "is", "it", "fall", "ender", "lol", "idk", "Minecraft!", "SMP's", "damage,"]
+    while len(messages) < count:
+        messages.append(' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 40))))
+
+    return messages[:count]
+
+def measure(func: Callable[[str], object], messages: List[str], repeat: int) -> float:
+    """Return the best messages/sec over several runs"""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            func(message)
+        elapsed = time.perf_counter() - start
+        best = max(best, len(messages) / elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000, help='Number of messages to process')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    messages = load_messages(args.messages)
+
+    # Results must be identical before comparing speed
+    for message in messages:
+        assert detect_message_topic(message) == legacy_detect_message_topic(message), message
+        for topic in TOPICS:
+            assert score_message_relevance(message, topic) == legacy_score_message_relevance(message, topic), message
+
+    benchmarks = [
+        ("detect_message_topic", legacy_detect_message_topic, detect_message_topic),
+        ("score_message_relevance",
+         lambda m: legacy_score_message_relevance(m, "minecraft"),
+         lambda m: score_message_relevance(m, "minecraft")),
+    ]
+
+    print(f"{len(messages)} messages, best of {args.repeat} runs")
+    for name, before, after in benchmarks:
+        before_rate = measure(before, messages, args.repeat)
+        after_rate = measure(after, messages, args.repeat)
+        print(f"{name:<25} before: {before_rate:>10.0f} msg/s  "
+              f"after: {after_rate:>10.0f} msg/s  ({after_rate / before_rate:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,98 @@ TOPICS = {
     }
 }
 
+# Matches maximal runs of word characters, the same units \b...\b delimits
+_WORD_RE = re.compile(r'\w+')
+_PHRASE_RE = re.compile(r'\w+( \w+)*')
+
+# Keyword matcher state, built once from TOPICS by rebuild_keyword_matcher()
+_single_keywords: Set[str] = set()
+_phrases: Dict[str, List[Tuple[str, Tuple[str, ...]]]] = {}
+_fallback_patterns: List[Tuple[str, "re.Pattern"]] = []
+
+def rebuild_keyword_matcher() -> None:
+    """
+    Rebuild the precompiled keyword matcher from TOPICS
+    Must be called again if TOPICS is modified at runtime
+    """
+    _single_keywords.clear()
+    _phrases.clear()
+    _fallback_patterns.clear()
+
+    keywords = {kw for topic_info in TOPICS.values() for kw in topic_info["keywords"]}
+
+    for keyword in keywords:
+        if _WORD_RE.fullmatch(keyword):
+            _single_keywords.add(keyword)
+        elif _PHRASE_RE.fullmatch(keyword):
+            # Multi-word keywords are matched as runs of tokens separated by one space
+            words = tuple(keyword.split(' '))
+            _phrases.setdefault(words[0], []).append((keyword, words))
+        else:
+            # Keywords with punctuation keep their original regex
+            pattern = re.compile(r'\b' + re.escape(keyword) + r'\b')
+            _fallback_patterns.append((keyword, pattern))
+
+def count_keyword_hits(message: str) -> Counter:
+    """
+    Count whole-word occurrences of every topic keyword in a single pass
+
+    Gives the same counts as running a whole-word re.findall for each keyword.
+
+    Args:
+        message: The message to analyze
+
+    Returns:
+        Counter mapping each matched keyword to its number of occurrences
+    """
+    message = message.lower()
+    hits = Counter()
+
+    tokens = [(m.group(), m.start(), m.end()) for m in _WORD_RE.finditer(message)]
+    phrase_next = {}  # Token index where each phrase may match again (findall doesn't overlap)
+
+    for i, (word, _, end) in enumerate(tokens):
+        if word in _single_keywords:
+            hits[word] += 1
+
+        for keyword, words in _phrases.get(word, ()):
+            if i < phrase_next.get(keyword, 0) or i + len(words) > len(tokens):
+                continue
+
+            # Every following word must match and be separated by exactly one space
+            prev_end = end
+            for j in range(1, len(words)):
+                next_word, next_start, next_end = tokens[i + j]
+                if next_word != words[j] or next_start != prev_end + 1 or message[prev_end] != ' ':
+                    break
+                prev_end = next_end
+            else:
+                hits[keyword] += 1
+                phrase_next[keyword] = i + len(words)
+
+    for keyword, pattern in _fallback_patterns:
+        count = len(pattern.findall(message))
+        if count:
+            hits[keyword] += count
+
+    return hits
+
+def count_topic_hits(message: str) -> Dict[str, int]:
+    """
+    Count keyword occurrences per topic
+
+    Args:
+        message: The message to analyze
+
+    Returns:
+        Dictionary mapping each topic to its total number of keyword hits
+    """
+    hits = count_keyword_hits(message)
+    return {
+        topic: sum(hits.get(keyword, 0) for keyword in topic_info["keywords"])
+        for topic, topic_info in TOPICS.items()
+    }
+
 def detect_message_topic(message: str) -> Tuple[str, float]:
     """
     Detect the most likely topic of a message using keyword matching
@@ -55,9 +147,18 @@ def detect_message_topic(message: str) -> Tuple[str, float]:
     Returns:
         Tuple of (topic_name, confidence_score)
     """
-    # Normalize the message
-    message = message.lower()
-    
+    return detect_topic_from_hits(count_keyword_hits(message))
+
+def detect_topic_from_hits(hits: Counter) -> Tuple[str, float]:
+    """
+    Detect the most likely topic from precomputed keyword hits
+
+    Args:
+        hits: Keyword counts as returned by count_keyword_hits
+
+    Returns:
+        Tuple of (topic_name, confidence_score)
+    """
     # Calculate scores for each topic
     scores = {}
     
@@ -66,10 +167,7 @@ def detect_message_topic(message: str) -> Tuple[str, float]:
         weight = topic_info.get("weight", 1.0)
         
         for keyword in topic_info["keywords"]:
-            # Check for whole word matches
-            pattern = r'\b' + re.escape(keyword) + r'\b'
-            matches = re.findall(pattern, message)
-            score += len(matches) * weight
+            score += hits.get(keyword, 0) * weight
         
         scores[topic] = score
     
@@ -98,6 +196,43 @@ def get_topic_keywords(topic: str) -> Set[str]:
     """
     return set(TOPICS.get(topic, {}).get("keywords", []))
 
+def count_topic_matches(hits: Counter) -> Dict[str, int]:
+    """
+    Count how many distinct keywords of each topic occur in a message
+
+    Args:
+        hits: Keyword counts as returned by count_keyword_hits
+
+    Returns:
+        Dictionary mapping each topic to its number of matched keywords
+    """
+    return {
+        topic: sum(1 for keyword in get_topic_keywords(topic) if keyword in hits)
+        for topic in TOPICS
+    }
+
+def relevance_from_matches(matches: int, current_topic: str) -> float:
+    """
+    Turn a number of matched topic keywords into a relevance score (0-1)
+
+    Args:
+        matches: Number of distinct keywords of the topic found in the message
+        current_topic: The current conversation topic
+
+    Returns:
+        Relevance score between 0 and 1
+    """
+    keywords = TOPICS.get(current_topic, {}).get("keywords", [])
+
+    # If no keywords found for the topic, assume moderate relevance
+    if not keywords:
+        return 0.5
+
+    # Base relevance (0.3) plus keyword match contribution
+    relevance = 0.3 + (0.7 * min(matches / (len(set(keywords)) * 0.3), 1.0))
+
+    return min(relevance, 1.0)
+
 def score_message_relevance(message: str, current_topic: str) -> float:
     """
     Score a message's relevance to the current topic (0-1)
@@ -116,24 +251,11 @@ def score_message_relevance(message: str, current_topic: str) -> float:
     if not keywords:
         return 0.5
     
-    # Normalize the message
-    message = message.lower()
+    # Count keywords that occur at least once
+    hits = count_keyword_hits(message)
+    matches = sum(1 for keyword in keywords if keyword in hits)
     
-    # Count keyword matches
-    matches = 0
-    for keyword in keywords:
-        pattern = r'\b' + re.escape(keyword) + r'\b'
-        if re.search(pattern, message):
-            matches += 1
-    
-    # Calculate relevance score
-    if not keywords:
-        return 0.5
-    
-    # Base relevance (0.3) plus keyword match contribution
-    relevance = 0.3 + (0.7 * min(matches / (len(keywords) * 0.3), 1.0))
-    
-    return min(relevance, 1.0)
+    return relevance_from_matches(matches, current_topic)
 
 def analyze_conversation_topics(messages: List[str]) -> Dict[str, float]:
     """
@@ -165,4 +287,6 @@ def analyze_conversation_topics(messages: List[str]) -> Dict[str, float]:
     
     return topic_weights
     
+rebuild_keyword_matcher()
+
 # All hallucination control functions have been removed
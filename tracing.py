@@ -0,0 +1,303 @@
+"""
+Request tracing
+Records how long each stage of handling a message takes, as spans with
+monotonic timestamps grouped into one trace per message. A rolling window of
+finished traces is kept in memory and can be exported as JSON lines and as a
+Prometheus text file. A disabled tracer hands out a shared no-op trace, so
+instrumented code costs next to nothing when tracing is off.
+"""
+
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import asyncio
+import itertools
+import json
+import os
+import time
+
+# Quantiles of the stage durations exported to Prometheus
+QUANTILES = (0.5, 0.9, 0.99)
+
+class Span:
+    """A timed stage of a trace, usable as a context manager or ended explicitly"""
+
+    __slots__ = ('name', 'start', 'end_time', 'attrs')
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end_time: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        """Seconds the span took, or has taken so far if it's still open"""
+        return (self.end_time if self.end_time is not None else time.perf_counter()) - self.start
+
+    def end(self) -> None:
+        """End the span, only the first call counts"""
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.end()
+
+class Trace:
+    """The spans of handling one message"""
+
+    def __init__(self, tracer: 'Tracer', trace_id: int, kind: str, attrs: Dict[str, Any]):
+        """
+        Initialize the trace, use Tracer.start instead
+
+        Args:
+            tracer: The tracer the trace is recorded by when it finishes
+            trace_id: Sequence number of the trace
+            kind: What is being handled, like 'public', 'private' or 'plain'
+            attrs: Attributes describing the trace
+        """
+        self.tracer = tracer
+        self.id = trace_id
+        self.kind = kind
+        self.attrs = attrs
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self.spans: List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time if self.end_time is not None else time.perf_counter()) - self.start
+
+    def span(self, name: str, **attrs) -> Span:
+        """
+        Start a span
+
+        Args:
+            name: Name of the stage
+            **attrs: Attributes of the span
+
+        Returns:
+            The started span, end it with end() or use it in a with statement
+        """
+        span = Span(name, attrs)
+        self.spans.append(span)
+        return span
+
+    def set(self, **attrs) -> None:
+        """Add attributes to the trace"""
+        self.attrs.update(attrs)
+
+    def finish(self) -> None:
+        """End the trace and every span still open, and record it"""
+        if self.end_time is not None:
+            return
+
+        for span in self.spans:
+            span.end()
+        self.end_time = time.perf_counter()
+        self.tracer.record(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The trace as JSON-serializable data, span times in milliseconds from the start of the trace"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'timestamp': self.timestamp,
+            'duration_ms': self.duration * 1000,
+            **self.attrs,
+            'spans': [
+                {
+                    'name': span.name,
+                    'start_ms': (span.start - self.start) * 1000,
+                    'duration_ms': span.duration * 1000,
+                    **span.attrs
+                }
+                for span in self.spans
+            ]
+        }
+
+class NullSpan:
+    """Span that records nothing"""
+
+    __slots__ = ()
+
+    name = ''
+    duration = 0.0
+
+    def end(self) -> None:
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+class NullTrace:
+    """Trace that records nothing, handed out when tracing is disabled"""
+
+    __slots__ = ()
+
+    kind = ''
+    duration = 0.0
+
+    def span(self, name: str, **attrs) -> NullSpan:
+        return NULL_SPAN
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+NULL_SPAN = NullSpan()
+NULL_TRACE = NullTrace()
+
+class Tracer:
+    """Hands out traces and keeps a rolling window of the finished ones"""
+
+    def __init__(self, window: int = 500, enabled: bool = True):
+        """
+        Initialize the tracer
+
+        Args:
+            window: Number of finished traces kept per kind
+            enabled: Whether traces are recorded at all
+        """
+        self.window = window
+        self.enabled = enabled
+
+        self.windows: Dict[str, Deque[Trace]] = {}
+        # Cumulative (count, sum of seconds) per (kind, stage), they never drop out of the window
+        self.totals: Dict[Tuple[str, str], List[float]] = {}
+        self.exporting = False
+
+        self._ids = itertools.count(1)
+
+    def start(self, kind: str, **attrs):
+        """
+        Start a trace
+
+        Args:
+            kind: What is being handled, like 'public', 'private' or 'plain'
+            **attrs: Attributes describing the trace
+
+        Returns:
+            The trace, or NULL_TRACE if tracing is disabled
+        """
+        if not self.enabled:
+            return NULL_TRACE
+        return Trace(self, next(self._ids), kind, attrs)
+
+    def record(self, trace: Trace) -> None:
+        """Add a finished trace to the window, called by Trace.finish"""
+        window = self.windows.get(trace.kind)
+        if window is None:
+            window = self.windows[trace.kind] = deque(maxlen=self.window)
+        window.append(trace)
+
+        for name, duration in [('total', trace.duration), *((span.name, span.duration) for span in trace.spans)]:
+            total = self.totals.setdefault((trace.kind, name), [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+
+    def traces(self) -> List[Trace]:
+        """Every trace in the window, oldest first"""
+        return sorted((trace for window in self.windows.values() for trace in window), key=lambda trace: trace.start)
+
+    def summary(self,
+                windows: Optional[Dict[str, List[Trace]]] = None,
+                totals: Optional[Dict[Tuple[str, str], List[float]]] = None) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Summarize the stage durations
+
+        The quantiles are over the traces in the window, count and sum over
+        every trace ever recorded. The whole trace is summarized as stage 'total'.
+
+        Args:
+            windows: Snapshot of the windows to summarize instead of the live ones
+            totals: Snapshot of the cumulative totals to use instead of the live ones
+
+        Returns:
+            Dictionary mapping kind -> stage -> count, sum and quantiles in seconds
+        """
+        windows = windows if windows is not None else self.windows
+        totals = totals if totals is not None else self.totals
+
+        durations: Dict[Tuple[str, str], List[float]] = {}
+        for kind, window in windows.items():
+            for trace in window:
+                durations.setdefault((kind, 'total'), []).append(trace.duration)
+                for span in trace.spans:
+                    durations.setdefault((kind, span.name), []).append(span.duration)
+
+        summary: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (kind, stage), (count, total) in totals.items():
+            values = sorted(durations.get((kind, stage), ()))
+            stats = {'count': count, 'sum': total}
+            for quantile in QUANTILES:
+                stats[str(quantile)] = values[min(len(values) - 1, int(quantile * len(values)))] if values else 0.0
+            summary.setdefault(kind, {})[stage] = stats
+        return summary
+
+    @staticmethod
+    def _write(path: str, lines: List[str]) -> None:
+        """Replace a file, scrapers never see it half written"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+    def export_jsonl(self, path: str = 'traces.jsonl', traces: Optional[List[Trace]] = None) -> None:
+        """Write the traces in the window as JSON lines, oldest first"""
+        traces = traces if traces is not None else self.traces()
+        self._write(path, [json.dumps(trace.to_dict()) + '\n' for trace in traces])
+
+    def export_prometheus(self, path: str = 'metrics.prom', summary: Optional[Dict[str, Dict[str, Dict[str, float]]]] = None) -> None:
+        """Write the stage durations in the Prometheus text format"""
+        summary = summary if summary is not None else self.summary()
+        lines = [
+            '# HELP chatbot_stage_seconds Time spent in each stage of handling a message\n',
+            '# TYPE chatbot_stage_seconds summary\n'
+        ]
+        for kind, stages in sorted(summary.items()):
+            for stage, stats in sorted(stages.items()):
+                labels = f'kind="{kind}",stage="{stage}"'
+                for quantile in QUANTILES:
+                    lines.append(f'chatbot_stage_seconds{{{labels},quantile="{quantile}"}} {stats[str(quantile)]:.6f}\n')
+                lines.append(f'chatbot_stage_seconds_sum{{{labels}}} {stats["sum"]:.6f}\n')
+                lines.append(f'chatbot_stage_seconds_count{{{labels}}} {stats["count"]}\n')
+        self._write(path, lines)
+
+    async def export_in_background(self, jsonl_path: str = 'traces.jsonl', prom_path: str = 'metrics.prom') -> None:
+        """
+        Export both files without blocking the event loop
+
+        The window is copied synchronously, summarizing, serializing and
+        writing happen in a thread.
+
+        Args:
+            jsonl_path: File for the traces as JSON lines
+            prom_path: File for the Prometheus metrics
+        """
+        if self.exporting or not self.enabled:
+            return
+
+        self.exporting = True
+        try:
+            windows = {kind: list(window) for kind, window in self.windows.items()}
+            totals = {key: list(total) for key, total in self.totals.items()}
+            traces = sorted((trace for window in windows.values() for trace in window), key=lambda trace: trace.start)
+
+            def export():
+                self.export_jsonl(jsonl_path, traces)
+                self.export_prometheus(prom_path, self.summary(windows, totals))
+
+            await asyncio.to_thread(export)
+        finally:
+            self.exporting = False
@@ -0,0 +1,152 @@
+"""
+Model warmup and readiness
+Loads the model on every Ollama backend in the background, measures how long
+loading and the first generated token take, and tells requests when they can
+be served
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import time
+
+from ollama_pool import CONNECTION_ERRORS, OllamaBackend, OllamaPool
+from log_writer import log, ERROR
+
+class ModelWarmup:
+    """Background model loading with a readiness state requests can wait on"""
+
+    COLD = 'cold'
+    LOADING = 'loading'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self,
+                 pool: OllamaPool,
+                 model: str,
+                 probe_prompt: str = 'Hi',
+                 on_state_change: Optional[Callable[[str], Awaitable[None]]] = None):
+        """
+        Initialize the warmup
+
+        Args:
+            pool: The Ollama backends to warm up
+            model: Name of the model to load
+            probe_prompt: Prompt of the timed generation measuring the first token latency
+            on_state_change: Coroutine function called with the new state whenever it changes,
+                             also when a retried warmup succeeds
+        """
+        self.pool = pool
+        self.model = model
+        self.probe_prompt = probe_prompt
+        self.on_state_change = on_state_change
+
+        self.state = self.COLD
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+        self._settled = asyncio.Event()  # Set once a backend is ready or every backend failed
+        self._task: Optional[asyncio.Task] = None
+        self._tasks = set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == self.READY
+
+    def _set_state(self, state: str) -> None:
+        """Change the state, calling the state callback in the background"""
+        if state == self.state:
+            return
+
+        self.state = state
+        if self.on_state_change is None:
+            return
+
+        task = asyncio.create_task(self.on_state_change(state))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm_backend(self, backend: OllamaBackend) -> bool:
+        """Load the model on one backend and time a one-token generation"""
+        result = self.results[backend.host] = {}
+        try:
+            # A chat without messages only loads the model
+            started = time.perf_counter()
+            await backend.client.chat(self.model, keep_alive=-1)
+            result['load_time'] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            stream = await backend.client.chat(
+                self.model,
+                [{'role': 'user', 'content': self.probe_prompt}],
+                stream=True,
+                options={'num_predict': 1},
+                keep_alive=-1
+            )
+            async for _ in stream:
+                if 'first_token' not in result:
+                    result['first_token'] = time.perf_counter() - started
+        except Exception as e:
+            result['error'] = str(e)
+            if isinstance(e, CONNECTION_ERRORS):
+                backend.mark_unhealthy()
+            log(f'[WARMUP] {backend.host} failed to load {self.model}: {e}', level=ERROR)
+            return False
+
+        backend.mark_healthy()
+        log(f"[WARMUP] {backend.host} loaded {self.model} in {result['load_time']:.2f}s, "
+              f"first token after {result.get('first_token', 0):.2f}s")
+
+        # One backend is enough to start serving requests
+        self._set_state(self.READY)
+        self._settled.set()
+        return True
+
+    async def run(self) -> bool:
+        """
+        Warm up every backend concurrently
+
+        Returns:
+            Whether at least one backend is ready
+        """
+        self._set_state(self.LOADING)
+        self._settled.clear()
+        self.results = {}
+
+        results = await asyncio.gather(*(self._warm_backend(backend) for backend in self.pool.backends))
+
+        if not any(results):
+            self._set_state(self.FAILED)
+            self._settled.set()
+        return self.ready
+
+    def start(self) -> asyncio.Task:
+        """
+        Start warming up in the background, unless it is already running or done
+
+        Returns:
+            The warmup task
+        """
+        if self._task is None or (self._task.done() and not self.ready):
+            self._set_state(self.LOADING)
+            self._settled.clear()
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the model can serve requests
+
+        Args:
+            timeout: Maximum seconds to wait, None to wait as long as it takes
+
+        Returns:
+            Whether the model is ready, False if warmup failed or timed out
+        """
+        # A failed warmup is retried, the backend may be back by now
+        if self.state in (self.COLD, self.FAILED):
+            self.start()
+
+        try:
+            await asyncio.wait_for(self._settled.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.ready